@@ -0,0 +1,152 @@
+import numpy as np
+
+from etm import get_plant_rhs, get_last_breakpoint, OutputRecorder
+from utils import generate_square_signal
+
+
+def get_gama(X, X_hat, Ψ, Ξ):
+  """
+  Calculates the value of Γ for every lane of a batch.
+
+  Parameters:
+                  X (array): Current states, shape (N, 2).
+                  X_hat (array): Last sent states, shape (N, 2).
+                  Ψ (array): Ψ matrices, shape (N, 2, 2).
+                  Ξ (array): Ξ matrices, shape (N, 2, 2).
+
+  Returns:
+                  array: Values of Γ, shape (N,).
+  """
+  E = X_hat - X
+  return np.einsum('ni,nij,nj->n', X, Ψ, X) - np.einsum('ni,nij,nj->n', E, Ξ, E)
+
+
+def batch_closed_loop_simulate(converter, K, Ψ, Ξ, params, end_time,
+                               perturbation_signal_data=None,
+                               x0_factor=[1.5, 0.13], step=1e-5,
+                               θ=None, λ=None, stop=None, recorder=None):
+  """
+  Simulate N closed loops in lockstep on stacked arrays.
+
+  Each lane has its own gain K and triggering matrices Ψ and Ξ (and θ, λ for the dynamic
+  ETM). The states of all lanes are advanced together by a fixed-step RK4 integrator with
+  the sent states held over the step, and the triggering condition is checked for every lane
+  at each grid point, so the event times are resolved to the step. Only the grid indices of
+  the events are kept, and the outputs are stored as set by `output`. The converter model is
+  evaluated once per stage for the whole batch, with the lanes stacked along the last axis.
+
+  Parameters:
+                  converter: Instance of the converter system (shifted non-linear or linearized).
+                  K (array): State feedback gains, shape (N, 2) or (N, 1, 2).
+                  Ψ (array): Ψ matrices, shape (N, 2, 2) or (2, 2) for all lanes.
+                  Ξ (array): Ξ matrices, shape (N, 2, 2) or (2, 2) for all lanes.
+                  params (dict): Dictionary of system parameters.
+                  end_time (float): End time of simulation.
+                  perturbation_signal_data (list): List of tuples representing perturbation signal data.
+                  x0_factor (list): Factor to multiply the initial state values, shape (2,) or (N, 2).
+                  step (float): Time step for simulation.
+                  θ (array): Threshold parameters of the dynamic ETM, shape (N,) or scalar. None for the static ETM.
+                  λ (array): Decay rates of the dynamic ETM, shape (N,) or scalar. None for the static ETM.
+                  stop (SteadyStateStop): Criterion to end the simulation once every lane has settled.
+                  recorder (OutputRecorder): How the outputs are stored. If None, every point of the grid.
+                                             Event samples are not supported, as the lanes have
+                                             different event instants.
+
+  Returns:
+                  tuple: A tuple containing the following arrays:
+                                  - t (array): Array of time points for simulation, up to the stop time.
+                                  - y (array): Array of system outputs, shape (N, n_outputs, T).
+                                  - inter_event_times (list): Inter-event times for each lane.
+                                  - event_times (list): Event times for each lane.
+  """
+  if recorder is not None and recorder.events:
+    raise ValueError('The batched simulation does not support event samples in the outputs')
+
+  plant_rhs = get_plant_rhs(converter, params)
+
+  K = np.asarray(K, dtype=float).reshape(-1, 2)
+  N = len(K)
+  Ψ = np.broadcast_to(np.asarray(Ψ, dtype=float), (N, 2, 2))
+  Ξ = np.broadcast_to(np.asarray(Ξ, dtype=float), (N, 2, 2))
+
+  dynamic = λ is not None
+  if dynamic:
+    θ = np.broadcast_to(np.asarray(θ, dtype=float), (N,))
+    λ = np.broadcast_to(np.asarray(λ, dtype=float), (N,))
+
+  X_OP = np.array([params['op']['iL'], params['op']['vC']])
+  timepts = np.arange(0, end_time + step, step)
+
+  x0_factor = np.broadcast_to(np.asarray(x0_factor, dtype=float), (N, 2))
+  X = x0_factor * X_OP - X_OP
+
+  if perturbation_signal_data == None:
+    perturbation_signal_data = [(0., params['op']['Pcpl'])]
+  P_CPL = generate_square_signal(
+      timepts, perturbation_signal_data) - params['op']['Pcpl']
+
+  def rhs(t, Z, X_hat, U):
+    dX = plant_rhs(t, Z[:, :2].T, U).T
+    if dynamic:
+      dn = -λ * Z[:, 2] + get_gama(Z[:, :2], X_hat, Ψ, Ξ)
+      return np.column_stack((dX, dn))
+    return dX
+
+  Z = np.column_stack((X, np.zeros(N))) if dynamic else X.copy()
+  X_hat = X.copy()
+
+  output = (recorder or OutputRecorder()).open(
+      timepts, (N, 4 if dynamic else 3), 1 if stop is None else stop.tail_length(step))
+  sample = np.empty((N, 4 if dynamic else 3, 1))
+  event_lanes, event_steps = [np.arange(N)], [np.zeros(N, dtype=int)]
+  U = np.empty((2, N))
+
+  if stop is not None:
+    last_breakpoint = get_last_breakpoint(perturbation_signal_data, timepts[-1])
+    check_interval = stop.check_interval(step)
+    last_event = np.zeros(N)
+
+  for k, t in enumerate(timepts):
+    U[0] = np.einsum('ni,ni->n', K, X_hat)
+    U[1] = P_CPL[k]
+
+    sample[:, :2, 0] = Z[:, :2]
+    sample[:, 2, 0] = U[0]
+    if dynamic:
+      sample[:, 3, 0] = Z[:, 2]
+    output.write(k, sample)
+
+    if k == len(timepts) - 1:
+      break
+
+    if stop is not None and k > 0 and k % check_interval == 0 and \
+            np.all(stop.is_output_settled(output, k, X_OP,
+                                          np.maximum(last_event, last_breakpoint))):
+      break
+
+    k1 = rhs(t, Z, X_hat, U)
+    k2 = rhs(t + step / 2, Z + step / 2 * k1, X_hat, U)
+    k3 = rhs(t + step / 2, Z + step / 2 * k2, X_hat, U)
+    k4 = rhs(t + step, Z + step * k3, X_hat, U)
+    Z = Z + step / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+    trigger = get_gama(Z[:, :2], X_hat, Ψ, Ξ)
+    if dynamic:
+      trigger = Z[:, 2] + θ * trigger
+
+    fired = trigger < 0
+    X_hat[fired] = Z[fired, :2]
+    if fired.any():
+      event_lanes.append(np.flatnonzero(fired))
+      event_steps.append(np.full(len(event_lanes[-1]), k + 1))
+    if stop is not None:
+      last_event[fired] = timepts[k + 1]
+
+  lanes = np.concatenate(event_lanes)
+  steps = np.concatenate(event_steps)[np.argsort(lanes, kind='stable')]
+  event_times = np.split(timepts[steps], np.cumsum(np.bincount(lanes, minlength=N))[:-1])
+  inter_event_times = [np.concatenate(([0.], np.diff(et))) for et in event_times]
+
+  t, y = output.result(k)
+
+  return t, y, inter_event_times, event_times
@@ -0,0 +1,408 @@
+import os
+import re
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import numpy as np
+import scipy
+import control as ct
+import cvxpy as cp
+
+import utils
+import etm
+import simu
+import converters
+from cache import DesignCache
+
+DEFAULT_HORIZONS = (0.005, 0.01, 0.02)
+DEFAULT_STEPS = (1e-5, 2e-5)
+DEFAULT_METHODS = ('interconnect', 'hybrid', 'analytic', 'periodic')
+SWEEP_POINTS = (0.2, 0.5, 0.8)
+
+# Import of the simulation entry point: time budget in seconds, and the heavy modules it must
+# not load (they are imported when a design is solved, a figure is rendered or the results
+# are stored). matplotlib is not in the list because python-control imports it.
+IMPORT_MODULE = 'simu'
+IMPORT_BUDGET = 2.
+LAZY_MODULES = ('cvxpy', 'pandas', 'tables', 'numba')
+IMPORT_SCRIPT = '''
+import sys, json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'time': time.perf_counter() - start,
+                  'loaded': [name for name in {lazy!r} if name in sys.modules]}}))
+'''
+
+
+class Benchmark:
+  """
+  Class to represent a benchmark case: a function to time and the parameters it was built with.
+
+  Parameters:
+                  name (str): Name of the benchmark.
+                  function (callable): Function to time, called without arguments.
+                  **params: Parameters of the case, such as the horizon and the step.
+  """
+
+  def __init__(self, name, function, **params):
+    self.name = name
+    self.function = function
+    self.params = params
+
+  @property
+  def id(self):
+    """
+    Identifier of the case, unique in a report.
+    """
+    return self.name + ''.join(f'[{key}={value}]' for key, value in sorted(self.params.items()))
+
+  def measure(self, repeat=5, warmup=1):
+    """
+    Times the function.
+
+    Parameters:
+                    repeat (int): Number of timed calls.
+                    warmup (int): Number of untimed calls before the timed ones.
+
+    Returns:
+                    dict: Entry of the report, with the times of the calls in seconds.
+    """
+    for _ in range(warmup):
+      self.function()
+
+    times = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      self.function()
+      times += [time.perf_counter() - start]
+
+    return {
+        'id': self.id,
+        'name': self.name,
+        'params': self.params,
+        'repeat': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.,
+        'times': times,
+    }
+
+
+def load_benchmark_scenario(json_file, tag=None):
+  """
+  Read the scenario used by the benchmarks.
+
+  Parameters:
+                  json_file (str): Path of the JSON file of scenarios.
+                  tag (str): Tag of the scenario. If None, the first scenario not ignored.
+
+  Returns:
+                  dict: Scenario (see `simu.load_scenario`).
+  """
+  with open(json_file, 'r') as file:
+    data = json.load(file)
+
+  for entry in data.values():
+    if (tag is None and not entry['ignore']) or entry['tag'] == tag:
+      return simu.load_scenario(entry)
+
+  raise ValueError(f'Scenario not found: {tag}')
+
+
+def create_benchmarks(scenario, horizons=DEFAULT_HORIZONS, steps=DEFAULT_STEPS,
+                      methods=DEFAULT_METHODS, solver=etm.DEFAULT_SOLVER):
+  """
+  Create the benchmark cases.
+
+  The simulation cases are repeated for every horizon and step, so the scaling with the number
+  of time points is visible in the report.
+
+  Parameters:
+                  scenario (dict): Scenario (see `simu.load_scenario`).
+                  horizons (tuple): Simulation horizons, in seconds.
+                  steps (tuple): Step sizes, in seconds.
+                  methods (tuple): Closed-loop simulation engines.
+                  solver (str): cvxpy solver of the design problems.
+
+  Returns:
+                  list: Benchmark cases.
+  """
+  params = scenario['params']
+  models = simu.create_models(params, scenario['converter'])
+  names = converters.model_names(scenario['converter'])
+  linearized = models[names[-1]]
+  A, B = linearized.system.A, linearized.system.B[:, 0]
+  pcpl_signal_data = scenario['pcpl_signal_data']
+  initial_factor = scenario['initial_states_factor']
+
+  design = etm.ETMDesign(A, B, solver)
+  K, Ξ, Ψ = etm.get_etm_parameters(A, B, 0.5, design)
+  if K is None:
+    raise RuntimeError(f'The design problem of the scenario is not feasible ({design.status})')
+
+  design_cache = DesignCache(os.path.join(tempfile.gettempdir(), 'etm_bench_designs.sqlite'))
+  etm.get_etm_parameters(A, B, 0.5, etm.ETMDesign(A, B, solver), design_cache)
+
+  benchmarks = [
+      Benchmark('get_etm_parameters', lambda: etm.get_etm_parameters(
+          A, B, 0.5, etm.ETMDesign(A, B, solver)), mode='cold'),
+      Benchmark('get_etm_parameters', lambda: etm.get_etm_parameters(A, B, 0.5, design),
+                mode='warm'),
+      Benchmark('get_etm_parameters', lambda: etm.get_etm_parameters(
+          A, B, 0.5, design, design_cache), mode='cached'),
+  ]
+
+  mechanisms = {'static': etm.StaticETM('etm', Ψ, Ξ),
+                'dynamic': etm.DynamicETM('etm', Ψ, Ξ, θ=1, λ=100)}
+  square_signal = [(t, 50. + 25. * (i % 2)) for i, t in enumerate(np.linspace(0, 1, 64))]
+
+  for horizon in horizons:
+    for step in steps:
+      size = {'horizon': horizon, 'step': step, 'T': int(round(horizon / step)) + 1}
+      timepts = np.linspace(0, horizon, size['T'])
+      signal = np.exp(-timepts / (horizon / 5)) * np.cos(timepts * 2e3) + 28.
+
+      for name in names:
+        benchmarks += [Benchmark(
+            'simulate', lambda converter=models[name], horizon=horizon, step=step: simu.simulate(
+                converter, params, pcpl_signal_data, horizon, step, initial_factor),
+            model=name, **size)]
+
+      for etm_type, mechanism in mechanisms.items():
+        for name in names[1:]:
+          for method in methods:
+            if method == 'analytic' and name != names[-1]:
+              continue
+            benchmarks += [Benchmark(
+                'closed_loop_simulate',
+                lambda converter=models[name], mechanism=mechanism, horizon=horizon, step=step,
+                method=method: etm.closed_loop_simulate(
+                    converter, mechanism, K, params, horizon, pcpl_signal_data, initial_factor,
+                    step=step, method=method),
+                etm=etm_type, model=name, method=method, **size)]
+
+      benchmarks += [
+          Benchmark('generate_square_signal',
+                    lambda timepts=timepts: utils.generate_square_signal(
+                        timepts * (1 / horizon), square_signal), **size),
+          Benchmark('get_settling_time',
+                    lambda signal=signal, timepts=timepts: utils.get_settling_time(signal, timepts),
+                    **size),
+      ]
+
+  horizon = min(horizons)
+  sweep_method = 'hybrid' if 'hybrid' in methods else methods[0]
+  benchmarks += [Benchmark(
+      'rho_sweep', lambda: simu.rho_sweep_chunk(
+          [(ρ, 1, 100) for ρ in SWEEP_POINTS], linearized, params, horizon,
+          pcpl_signal_data, initial_factor, method=sweep_method, solver=solver),
+      points=len(SWEEP_POINTS), method=sweep_method, horizon=horizon)]
+
+  return benchmarks
+
+
+def measure_import(module=IMPORT_MODULE, repeat=5, lazy_modules=LAZY_MODULES):
+  """
+  Times the import of a module in fresh interpreters, as paid by each run of a script and by
+  each worker process that is not forked.
+
+  Parameters:
+                  module (str): Name of the module.
+                  repeat (int): Number of interpreters.
+                  lazy_modules (tuple): Modules the import must not load.
+
+  Returns:
+                  dict: Entry of the report, like the ones of `Benchmark.measure`, with the lazy
+                        modules that were loaded.
+  """
+  directory = os.path.dirname(os.path.abspath(__file__))
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+      [os.path.dirname(directory), directory] + [os.environ.get('PYTHONPATH', '')]))
+  script = IMPORT_SCRIPT.format(module=module, lazy=tuple(lazy_modules))
+
+  times = []
+  loaded = set()
+  for _ in range(repeat):
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            env=env, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    times += [result['time']]
+    loaded.update(result['loaded'])
+
+  return {
+      'id': f'import[module={module}]',
+      'name': 'import',
+      'params': {'module': module},
+      'repeat': repeat,
+      'min': min(times),
+      'median': statistics.median(times),
+      'mean': statistics.fmean(times),
+      'stdev': statistics.stdev(times) if len(times) > 1 else 0.,
+      'times': times,
+      'loaded': sorted(loaded),
+  }
+
+
+def check_import(entry, budget=IMPORT_BUDGET):
+  """
+  Checks an import entry against the import-time budget.
+
+  Parameters:
+                  entry (dict): Entry of `measure_import`.
+                  budget (float): Maximum median import time, in seconds.
+
+  Returns:
+                  list: Descriptions of the violations, empty if the import is within budget.
+  """
+  violations = []
+  if entry['median'] > budget:
+    violations += [f'{entry["id"]} took {entry["median"]:.3f} s (budget {budget:g} s)']
+  if entry['loaded']:
+    violations += [f'{entry["id"]} loaded {", ".join(entry["loaded"])}']
+  return violations
+
+
+def environment():
+  """
+  Describes the environment of a benchmark run.
+
+  Returns:
+                  dict: Versions of Python and of the libraries, platform, CPUs and git commit.
+  """
+  try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            timeout=10).stdout.strip() or None
+  except (OSError, subprocess.SubprocessError):
+    commit = None
+
+  return {
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'scipy': scipy.__version__,
+      'control': ct.__version__,
+      'cvxpy': cp.__version__,
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'commit': commit,
+      'created': time.time(),
+  }
+
+
+def compare(report, baseline, threshold=1.1):
+  """
+  Compares a report with a baseline.
+
+  Parameters:
+                  report (dict): Benchmark report.
+                  baseline (dict): Baseline report.
+                  threshold (float): Ratio of the medians above which a case is a regression.
+
+  Returns:
+                  list: Tuples (id, baseline median, median, ratio, regression) for the cases present
+                        in both reports.
+  """
+  reference = {entry['id']: entry for entry in baseline['results']}
+  rows = []
+  for entry in report['results']:
+    if entry['id'] in reference:
+      base = reference[entry['id']]['median']
+      ratio = entry['median'] / base if base > 0 else float('inf')
+      rows += [(entry['id'], base, entry['median'], ratio, ratio > threshold)]
+  return rows
+
+
+def main(args):
+  horizons = tuple(float(value) for value in args.horizons.split(','))
+  steps = tuple(float(value) for value in args.steps.split(','))
+  methods = tuple(args.methods.split(','))
+
+  scenario = load_benchmark_scenario(args.json_file, args.scenario)
+  benchmarks = create_benchmarks(scenario, horizons, steps, methods, args.solver)
+  if args.filter:
+    benchmarks = [benchmark for benchmark in benchmarks if re.search(args.filter, benchmark.id)]
+
+  results = []
+  violations = []
+  if args.import_repeat > 0 and (not args.filter or re.search(args.filter, 'import')):
+    entry = measure_import(IMPORT_MODULE, args.import_repeat)
+    results += [entry]
+    violations = check_import(entry, args.import_budget)
+    print(f'{entry["id"]:<110} median {entry["median"] * 1e3:10.3f} ms   '
+          f'min {entry["min"] * 1e3:10.3f} ms')
+    for violation in violations:
+      print(f'IMPORT BUDGET EXCEEDED: {violation}')
+
+  for benchmark in benchmarks:
+    entry = benchmark.measure(args.repeat, args.warmup)
+    results += [entry]
+    print(f'{entry["id"]:<110} median {entry["median"] * 1e3:10.3f} ms   '
+          f'min {entry["min"] * 1e3:10.3f} ms')
+
+  report = {'environment': environment(), 'scenario': scenario['tag'], 'results': results}
+
+  if args.output:
+    with open(args.output, 'w') as file:
+      json.dump(report, file, indent=2)
+
+  if args.baseline is None:
+    return 1 if violations and args.fail_on_regression else 0
+
+  with open(args.baseline, 'r') as file:
+    baseline = json.load(file)
+
+  rows = compare(report, baseline, args.threshold)
+  print(f'\nComparison with {args.baseline} (regression above x{args.threshold:g}):')
+  for case, base, median, ratio, regression in rows:
+    print(f'{case:<110} {base * 1e3:10.3f} -> {median * 1e3:10.3f} ms  x{ratio:6.2f}'
+          f'{"  REGRESSION" if regression else ""}')
+
+  regressions = sum(regression for *_, regression in rows)
+  print(f'{len(rows)} cases compared, {regressions} regressions')
+  return 1 if (regressions or violations) and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description='Benchmark the simulation and design hot paths.')
+  parser.add_argument('json_file', type=str, nargs='?', default='./buck/scenarios.json',
+                      help='Path to the JSON file of scenarios')
+  parser.add_argument('--scenario', type=str, default=None,
+                      help='Tag of the benchmarked scenario (default: the first one not ignored)')
+  parser.add_argument('--horizons', type=str, default=','.join(map(str, DEFAULT_HORIZONS)),
+                      help='Comma-separated simulation horizons (s)')
+  parser.add_argument('--steps', type=str, default=','.join(map(str, DEFAULT_STEPS)),
+                      help='Comma-separated step sizes (s)')
+  parser.add_argument('--methods', type=str, default=','.join(DEFAULT_METHODS),
+                      help='Comma-separated closed-loop simulation engines')
+  parser.add_argument('--solver', type=str, default=etm.DEFAULT_SOLVER,
+                      help='cvxpy solver of the design problems')
+  parser.add_argument('--filter', type=str, default=None,
+                      help='Regular expression selecting the cases to run, by identifier')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='Number of timed calls of each case')
+  parser.add_argument('--warmup', type=int, default=1,
+                      help='Number of untimed calls before the timed ones')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Path of the JSON report')
+  parser.add_argument('--baseline', type=str, default=None,
+                      help='Path of a JSON report to compare with')
+  parser.add_argument('--threshold', type=float, default=1.1,
+                      help='Ratio of the medians above which a case is reported as a regression')
+  parser.add_argument('--fail-on-regression', action='store_true',
+                      help='Exit with status 1 if any case regressed or the import exceeded its '
+                      'budget')
+  parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                      help=f'Maximum median time to import {IMPORT_MODULE} (s)')
+  parser.add_argument('--import-repeat', type=int, default=5,
+                      help=f'Number of fresh interpreters timing the import of {IMPORT_MODULE} '
+                      '(0 skips it)')
+  args = parser.parse_args()
+  sys.exit(main(args))
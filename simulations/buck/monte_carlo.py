@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import argparse
+
+import etm
+import instrument
+import simu
+import converters
+import ensemble
+from cache import DesignCache
+
+
+def parse_range(text):
+  """
+  Parses a range given as 'first,second'.
+  """
+  first, second = (float(value) for value in text.split(','))
+  return first, second
+
+
+def run_ensemble(scenario, etm_type, model, x0_factors, ρ=0.5, θ=1, λ=100, end_time=None,
+                 stop=None, batch_size=256, workers=None, solver=etm.DEFAULT_SOLVER, design_cache=None):
+  """
+  Simulate the closed loop of a scenario from an ensemble of initial conditions.
+
+  Parameters:
+                  scenario (dict): Scenario (see `simu.load_scenario`).
+                  etm_type (str): ETM type ('static' or 'dynamic').
+                  model (str): Kind of converter model ('shifted_nonlinear' or 'linearized'),
+                               of the topology of the scenario.
+                  x0_factors (array): Factors of the initial states, shape (N, 2).
+                  ρ (float): Weight of the design objective.
+                  θ (float): Threshold parameter of the dynamic ETM.
+                  λ (float): Decay rate of the dynamic ETM.
+                  end_time (float): End time of simulation. If None, the one of the scenario.
+                  stop (etm.SteadyStateStop): Criterion to end each batch once all its lanes have settled.
+                  batch_size (int): Number of lanes simulated together.
+                  workers (int): Number of worker processes. If None, the number of CPUs is used.
+                  solver (str): cvxpy solver of the design problem.
+                  design_cache (DesignCache): Persistent cache of ETM design results.
+
+  Returns:
+                  tuple: Lanes and pooled inter-event times (see
+                         `ensemble.ensemble_closed_loop_simulate`).
+  """
+  params = scenario['params']
+  models = simu.create_models(params, scenario['converter'])
+  linearized = models[f'{scenario["converter"]}_linearized']
+  converter = models[f'{scenario["converter"]}_{model}']
+  A, B = linearized.system.A, linearized.system.B[:, 0]
+
+  K, Ξ, Ψ = etm.get_etm_parameters(A, B, ρ, etm.ETMDesign(A, B, solver), design_cache)
+  if K is None:
+    raise RuntimeError(f'The design problem of scenario {scenario["tag"]} is not feasible')
+
+  mechanism = etm.DynamicETM('etm', Ψ, Ξ, θ, λ) if etm_type == 'dynamic' \
+      else etm.StaticETM('etm', Ψ, Ξ)
+
+  return ensemble.ensemble_closed_loop_simulate(
+      converter, mechanism, K, params, end_time or scenario['end_time'], x0_factors,
+      scenario['pcpl_signal_data'], scenario['step'], stop, batch_size=batch_size,
+      workers=workers)
+
+
+def main(args):
+  with open(args.json_file, 'r') as file:
+    data = json.load(file)
+
+  design_cache = None if args.no_design_cache else DesignCache(args.design_cache)
+  stop = etm.SteadyStateStop(args.settle_tolerance, args.settle_window) \
+      if args.stop_when_settled else None
+  x0_factors = ensemble.sample_initial_factors(
+      args.count, parse_range(args.il_range), parse_range(args.vc_range), args.distribution,
+      args.seed)
+
+  for entry in data.values():
+    if args.scenario is None and entry['ignore'] or \
+            args.scenario is not None and entry['tag'] != args.scenario:
+      continue
+
+    scenario = simu.load_scenario(entry)
+    path = args.output or scenario['path']
+    os.makedirs(path, exist_ok=True)
+
+    for etm_type in args.etm.split(','):
+      name = f'ensemble_{etm_type}_etm_{scenario["converter"]}_{args.model}'
+      instrument.log.info(f'[{scenario["tag"]}]\t{etm_type.capitalize()} ETM ensemble of '
+                          f'{args.count} initial conditions started')
+      start = time.perf_counter()
+      lanes, inter_event_times = run_ensemble(
+          scenario, etm_type, args.model, x0_factors, args.rho, args.theta, args.lam,
+          args.end_time, stop, args.batch_size, args.workers or None, args.solver, design_cache)
+      summary = ensemble.summarize_ensemble(lanes, inter_event_times)
+
+      lanes.to_csv(os.path.join(path, name + '.csv'), index=False)
+      summary.to_csv(os.path.join(path, name + '_summary.csv'), index=False)
+      instrument.log.info(f'[{scenario["tag"]}]\t{etm_type.capitalize()} ETM ensemble finalized '
+                          f'in {time.perf_counter() - start:.1f} s')
+      print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description='Simulate the closed loops from an ensemble of initial conditions.')
+  parser.add_argument('json_file', type=str, nargs='?', default='./buck/scenarios.json',
+                      help='Path to the JSON file of scenarios')
+  parser.add_argument('--scenario', type=str, default=None,
+                      help='Tag of the scenario (default: every scenario not ignored)')
+  parser.add_argument('--count', type=int, default=1000,
+                      help='Number of initial conditions')
+  parser.add_argument('--distribution', type=str, default='uniform',
+                      choices=ensemble.DISTRIBUTIONS,
+                      help='Distribution of the initial conditions')
+  parser.add_argument('--il-range', type=str, default='0.5,1.5',
+                      help='Range "low,high" of the factor of the initial iL over its operating '
+                      'value, or "mean,std" for the normal distribution')
+  parser.add_argument('--vc-range', type=str, default='0.5,1.5',
+                      help='Range of the factor of the initial vC, as for --il-range')
+  parser.add_argument('--seed', type=int, default=None,
+                      help='Seed of the random initial conditions')
+  parser.add_argument('--etm', type=str, default='static,dynamic',
+                      help='Comma-separated ETM types')
+  parser.add_argument('--model', type=str, default='linearized',
+                      choices=converters.MODEL_KINDS[1:],
+                      help='Kind of converter model, of the topology of each scenario')
+  parser.add_argument('--rho', type=float, default=0.5,
+                      help='Weight of the design objective')
+  parser.add_argument('--theta', type=float, default=1.,
+                      help='Threshold parameter of the dynamic ETM')
+  parser.add_argument('--lam', type=float, default=100.,
+                      help='Decay rate of the dynamic ETM')
+  parser.add_argument('--end-time', type=float, default=None,
+                      help='End time of the simulations (default: the one of the scenario)')
+  parser.add_argument('--batch-size', type=int, default=256,
+                      help='Number of initial conditions simulated together')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='Number of worker processes (0 uses all CPUs)')
+  parser.add_argument('--solver', type=str, default=etm.DEFAULT_SOLVER,
+                      help='cvxpy solver of the design problem')
+  parser.add_argument('--design-cache', type=str, default='./buck/cache/etm_designs.sqlite',
+                      help='Path of the persistent cache of ETM design results')
+  parser.add_argument('--no-design-cache', action='store_true',
+                      help='Always solve the ETM design problem')
+  parser.add_argument('--output', type=str, default=None,
+                      help='Directory of the CSV files (default: the results directory of each '
+                      'scenario)')
+  parser.add_argument('--stop-when-settled', action='store_true',
+                      help='End each batch once all its simulations have settled')
+  parser.add_argument('--settle-tolerance', type=float, default=5e-3,
+                      help='Settling band around the current state, relative to the operating point')
+  parser.add_argument('--settle-window', type=float, default=5e-3,
+                      help='Time the states must stay in the band, without events, to stop (s)')
+  args = parser.parse_args()
+  instrument.configure_logging()
+  main(args)
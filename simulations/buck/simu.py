@@ -1,590 +1,1010 @@
 import os
-import matplotlib
+import sys
+import copy
 import numpy as np
-import matplotlib.pyplot as plt
 import control as ct
-import control.optimal as opt
-from control.matlab import *
-import cvxpy as cp
 import math
-import pandas as pd
 import json
 import argparse
+import functools
 
 import utils
 import etm
+import converters
+import instrument
+import batch
+import metrics
+import render
+from cache import DesignCache, StageCache, source_version
+from sweep import split_chunks
+from pipeline import Pipeline, PipelineError
 
-ct.use_fbs_defaults()
-matplotlib.use('Agg')
+STAGES = ('open_loop', 'static_etm', 'dynamic_etm', 'rho_sweep', 'figures')
+DEFAULT_STAGES = ('rho_sweep', 'figures')
 
 
-class NonlinearBuckConverter:
+def simulate(converter, params, perturbation_signal_data=None, end_time=0.1, step=1e-5, initial_factor=[1.5, 0.13],
+             solve_ivp_method='RK45', stop=None):
   """
-  Classe para criar e gerenciar o modelo não linear de um conversor Buck.
+  Simulate the system based on the provided parameters and time settings.
+
+  Parameters:
+                  params (dict): Dictionary of system parameters obtained from the `create_params` of the converter.
+                  end_time (float): End time of simulation.
+                  step (float): Time step for simulation.
+                  initial_factor (float): Factor to multiply the initial state values to obtain the initial conditions.
+                  perturb_factor (float): Factor to multiply the perturbation values to obtain the perturbed conditions.
+                  solve_ivp_method (str): Integration method. Implicit methods ('Radau', 'BDF', 'LSODA')
+                                          use the analytic Jacobian of the converter.
+                  stop (etm.SteadyStateStop): Criterion to end the simulation once it has settled. If None,
+                                              the simulation runs until `end_time`.
 
-  Parâmetros:
-                  name (str): Nome do sistema.
+  Returns:
+                  tuple: A tuple containing the following arrays:
+                                  - timepts (array): Array of time points for simulation, up to the stop time.
+                                  - U (array): Array of system inputs for simulation.
+                                  - X0 (array): Array of initial states for simulation.
+                                  - δU (array): Array of perturbations in system inputs.
+                                  - δX0 (array): Array of perturbations in initial states.
+                                  - params (dict): Dictionary of system parameters.
   """
 
-  def __init__(self, name):
-    self.name = name
-    self.inputs = ('D', 'P_CPL')
-    self.outputs = ('iL', 'vC')
-    self.states = ('iL', 'vC')
-    self.system = ct.NonlinearIOSystem(
-        self.update, self.output, name=self.name,
-        inputs=self.inputs, outputs=self.outputs, states=self.states
-    )
+  # Ponto de operação de cada entrada e estado do sistema
+  U_OP = np.array([params['op']['d'], params['op']['Pcpl']])
+  X_OP = np.array([params['op']['iL'], params['op']['vC']])
 
-  def update(self, t, x, u, params):
-    """
-    Função de atualização para a representação em espaço de estados do conversor Buck.
+  # Instantes de tempo
+  timepts = np.arange(0, end_time + step, step)
 
-    Parâmetros:
-                    t (float): Tempo.
-                    x (array): Estados do sistema.
-                    u (array): Entradas do sistema.
-                    params (dict): Dicionário de parâmetros do sistema.
+  # Entradas do Sistema
+  if perturbation_signal_data == None:
+    perturbation_signal_data = [(0., U_OP[1])]
+  P_CPL = utils.generate_square_signal(timepts, perturbation_signal_data)
 
-    Retorna:
-                    dx (array): Derivada dos estados do sistema.
-    """
-    V_IN = params.get('Vin', 0)  # Tensão de entrada
-    RL = params.get('rL', 0)     # Resistência (indutor)
-    RC = params.get('rC', 0)     # Resistência (capacitor)
-    L = params.get('L', 1)       # Indutância
-    C = params.get('C', 1)       # Capacitância
+  D = [params['op']['d'] for _ in range(len(timepts))]
+  U = [D, P_CPL.tolist()]
 
-    D, P_CPL = u
+  # Estados Iniciais do Sistema
+  IL_INIT = initial_factor[0] * params['op']['iL']
+  VC_INIT = initial_factor[1] * params['op']['vC']
+  X0 = np.array([IL_INIT, VC_INIT])
 
-    IL, VC = x
+  INPUT, INITIAL_STATE = U, X0
 
-    diL = (V_IN / L) * D - (RL / L) * IL - VC / L
-    dvC = IL / C - VC / (C * RC) - P_CPL / (C * VC)
+  if not isinstance(converter, converters.NonlinearConverter):
+    INPUT = U - U_OP[:, np.newaxis]
+    INITIAL_STATE = X0 - X_OP
+  else:
+    INPUT = U
+    INITIAL_STATE = X0
 
-    dx = np.array([diL, dvC])
-    return dx
+  system = converter.system
+  if instrument.enabled():
+    system = copy.copy(converter.system)
+    system._rhs = instrument.counted('rhs_evaluations', system._rhs)
 
-  def output(self, t, x, u, params):
-    """
-    Função de saída para a representação em espaço de estados do conversor Buck.
+  if stop is not None:
+    last_breakpoint = etm.get_last_breakpoint(perturbation_signal_data, end_time)
 
-    Parâmetros:
-                    t (float): Tempo.
-                    x (array): Estados do sistema.
-                    u (array): Entradas do sistema.
-                    params (dict): Dicionário de parâmetros do sistema.
+    def response(**kwargs):
+      with instrument.span('integration', engine='open_loop'):
+        return etm.input_output_response_until_settled(
+            system, timepts, INPUT, INITIAL_STATE, stop, X_OP,
+            lambda: last_breakpoint, **kwargs)
+  else:
+    def response(**kwargs):
+      with instrument.span('integration', engine='open_loop'):
+        return ct.input_output_response(
+            sys=system, T=timepts, U=INPUT, X0=INITIAL_STATE, **kwargs)
 
-    Retorna:
-                    array: Saída do sistema.
-    """
-    return x[0:2]
+  if isinstance(converter, converters.LinearizedConverter):
+    return response(solve_ivp_method=solve_ivp_method)
 
+  solve_ivp_kwargs = {}
+  if solve_ivp_method in etm.IMPLICIT_METHODS:
+    U_ARRAY = np.asarray(INPUT, dtype=float)
+    solve_ivp_kwargs['jac'] = lambda t, x: converter.jacobian(
+        t, x, (np.interp(t, timepts, U_ARRAY[0]), np.interp(t, timepts, U_ARRAY[1])), params)
 
-class ShiftedNonlinearBuckConverter:
+  return response(
+      params=params,
+      solve_ivp_method=solve_ivp_method,
+      solve_ivp_kwargs=solve_ivp_kwargs,
+  )
+
+
+def save_run(store, tag, converter, results, params, etm_type='none', design=None, method='',
+             stage='', **kwargs):
   """
-  Classe para criar e gerenciar o modelo não linear deslocado de um sistema.
+  Store a run, with its metrics for closed-loop runs, if a result store is given.
 
-  Parâmetros:
-                  name (str): Nome do sistema.
+  Parameters:
+                  store (ResultStore): Result store, or None.
+                  tag (str): Scenario tag.
+                  converter: Instance of the converter system.
+                  results (tuple): Results of `simulate` or `etm.closed_loop_simulate`.
+                  params (dict): Dictionary of system parameters.
+                  etm_type (str): ETM type ('static', 'dynamic' or 'none' for open-loop runs).
+                  design (tuple): ETM design (K, Ξ, Ψ).
+                  method (str): Simulation engine.
+                  stage (str): Stage that produced the run.
+                  **kwargs: ρ, θ and λ of the run.
   """
+  if store is None:
+    return
 
-  def __init__(self, name):
-    self.name = name
-    self.inputs = ('δd', 'δPcpl')
-    self.outputs = ('δiL', 'δvC')
-    self.states = ('δiL', 'δvC')
-    self.system = ct.NonlinearIOSystem(
-        self.update, self.output, name=self.name,
-        inputs=self.inputs, outputs=self.outputs, states=self.states
-    )
+  if etm_type == 'none':
+    t, y = results
+    store.write_run(tag, converter.system.name, t, y, method=method, stage=stage, **kwargs)
+    return
 
-  def update(self, t, x, u, params):
-    """
-    Função de atualização para a representação em espaço de estados do sistema não linear deslocado.
+  t, y, iet, et, *trace = results
+  store.write_run(
+      tag, converter.system.name, t, y, etm_type, trace[0] if trace else et, design,
+      method=method, metrics=metrics.closed_loop_metrics(t, y, iet, params['op']['vC']),
+      stage=stage, **kwargs)
 
-    Parâmetros:
-                    t (float): Tempo.
-                    x (array): Estados do sistema.
-                    u (array): Entradas do sistema.
-                    params (dict): Dicionário de parâmetros do sistema.
 
-    Retorna:
-                    dx (array): Derivada dos estados do sistema.
-    """
-    V_IN = params.get('Vin', 0)  # Tensão de entrada
-    RL = params.get('rL', 0)     # Resistência (indutor)
-    RC = params.get('rC', 0)     # Resistência (capacitor)
-    L = params.get('L', 1)       # Indutância
-    C = params.get('C', 1)       # Capacitância
-    OP = params.get('op', {'Pcpl': 0, 'vC': 0})  # Ponto de operação
+def open_loop_figures(path, op, nonlinear=None, shifted_nonlinear=None, linearized=None,
+                      converter='buck'):
+  """
+  Build the figures of the open-loop simulations.
 
-    # print(params)
+  Parameters:
+                  path (str): Directory of the figures.
+                  op (dict): Operating point.
+                  nonlinear (tuple): Time points and outputs of the non-linear model, or None.
+                  shifted_nonlinear (tuple): Time points and outputs of the shifted non-linear model, or None.
+                  linearized (tuple): Time points and outputs of the linearized model, or None.
+                  converter (str): Converter topology, which names the figures.
 
-    δD, δP_CPL = u
-    δIL, δVC = x
+  Returns:
+                  list: Figures to render (see `render.FigureJob`).
+  """
+  title = converters.get_converter(converter).title
+  jobs = []
+
+  if nonlinear is not None:
+    t_nonlinear, y_nonlinear = nonlinear
+    jobs += [render.FigureJob(
+        'create_figure_two_by_one', f'{converter}_nonlinear_states', path,
+        title_figure=f'Non-linear {title} Converter: States $i_L$ and $v_C$',
+        data_1={
+            'x': t_nonlinear, 'y': y_nonlinear[0],
+            'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
+            'title': 'Inductor Current $i_L(t)$'
+        },
+        data_2={
+            'x': t_nonlinear, 'y': y_nonlinear[1],
+            'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
+            'title': 'Capacitor Voltage $v_C(t)$'
+        },
+        fig_name=f'{converter}_nonlinear_states'
+    )]
+
+  if shifted_nonlinear is not None:
+    t_shifted_nonlinear, y_shifted_nonlinear = shifted_nonlinear
+    jobs += [render.FigureJob(
+        'create_figure_two_by_one', f'{converter}_shifted_nonlinear_states', path,
+        title_figure=f'Shifted Non-linear {title} Converter: States $i_L$ and $v_C$',
+        data_1={
+            'x': t_shifted_nonlinear,
+            'y': y_shifted_nonlinear[0] + op['iL'],
+            'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
+            'title': 'Inductor Current $i_L(t)$'
+        },
+        data_2={
+            'x': t_shifted_nonlinear,
+            'y': y_shifted_nonlinear[1] + op['vC'],
+            'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
+            'title': 'Capacitor Voltage $v_C(t)$'
+        },
+        fig_name=f'{converter}_shifted_nonlinear_states'
+    )]
+
+  if linearized is not None:
+    t_linearized, y_linearized = linearized
+    jobs += [render.FigureJob(
+        'create_figure_two_by_one', f'{converter}_linearized_states', path,
+        title_figure=f'Linearized {title} Converter: States $i_L$ and $v_C$',
+        data_1={
+            'x': t_linearized,
+            'y': y_linearized[0] + op['iL'],
+            'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
+            'title': 'Inductor Current $i_L(t)$'
+        },
+        data_2={
+            'x': t_linearized,
+            'y': y_linearized[1] + op['vC'],
+            'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
+            'title': 'Capacitor Voltage $v_C(t)$'
+        },
+        fig_name=f'{converter}_linearized_states'
+    )]
+
+  if shifted_nonlinear is not None and linearized is not None:
+    jobs += [render.FigureJob(
+        'create_figure_two_by_two', f'{converter}_nonlinear_vs_linearized_states', path,
+        title_figure=f'Non-linear vs Linearized {title} Converter: States $i_L$ and $v_C$',
+        data_1={
+            'x1': t_shifted_nonlinear, 'x2': t_linearized,
+            'y1': y_shifted_nonlinear[0] + op['iL'],
+            'y2': y_linearized[0] + op['iL'],
+            'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
+            'title': 'Inductor Current $i_L(t)$'
+        },
+        data_2={
+            'x1': t_shifted_nonlinear, 'x2': t_linearized,
+            'y1': y_shifted_nonlinear[1] + op['vC'],
+            'y2': y_linearized[1] + op['vC'],
+            'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
+            'title': 'Capacitor Voltage $v_C(t)$'
+        },
+        legends=['Non-linear', 'Linearized'],
+        fig_name=f'{converter}_nonlinear_vs_linearized_states'
+    )]
+
+  return jobs
+
+
+def etm_figures(path, op, etm_type, nonlinear, linearized, converter='buck'):
+  """
+  Build the figures of the closed-loop simulations under an ETM.
 
-    DELTA_IL_DOT = - (RL / L) * δIL - δVC / L + (V_IN / L) * δD
-    DELTA_VC_DOT = - δVC / (C * RC) + δIL / C + \
-        (OP['Pcpl'] * δVC - OP['vC'] * δP_CPL) / \
-        (C * OP['vC'] * (OP['vC'] + δVC))
+  Parameters:
+                  path (str): Directory of the figures.
+                  op (dict): Operating point.
+                  etm_type (str): ETM type ('static' or 'dynamic').
+                  nonlinear (tuple): t, y, inter-event times and event times of the non-linear model.
+                  linearized (tuple): t, y, inter-event times and event times of the linearized model.
+                  converter (str): Converter topology, which names the figures.
 
-    dx = np.array([DELTA_IL_DOT, DELTA_VC_DOT])
-    return dx
+  Returns:
+                  list: Figures to render (see `render.FigureJob`).
+  """
+  t_nl, y_nl, iet_nl, et_nl = nonlinear[:4]
+  t_l, y_l, iet_l, et_l = linearized[:4]
+  return [render.FigureJob(
+      'create_etm_results_figures', f'{converter}_under_{etm_type}_etm', path,
+      title=f'{converters.get_converter(converter).title} Converter Under '
+            f'{etm_type.capitalize()} ETM',
+      fig_prefix=f'{converter}_under_{etm_type}_etm', op=op,
+      t_etm_nl=t_nl, y_etm_nl=y_nl, iet_etm_nl=iet_nl, et_etm_nl=et_nl,
+      t_etm_l=t_l, y_etm_l=y_l, iet_etm_l=iet_l, et_etm_l=et_l
+  )]
+
+
+def rho_variation_figures(path, ρ_arr, ts_arr, iet_arr, converter='buck'):
+  """
+  Build the figure of the ρ sweep.
 
-  def output(self, t, x, u, params):
-    """
-    Função de saída para a representação em espaço de estados do sistema não linear deslocado.
+  Parameters:
+                  path (str): Directory of the figure.
+                  ρ_arr (array): Values of ρ.
+                  ts_arr (array): Settling time of each design.
+                  iet_arr (array): Mean inter-event time of each design.
+                  converter (str): Converter topology, which names the figure.
 
-    Parâmetros:
-                    t (float): Tempo.
-                    x (array): Estados do sistema.
-                    u (array): Entradas do sistema.
-                    params (dict): Dicionário de parâmetros do sistema.
+  Returns:
+                  list: Figures to render (see `render.FigureJob`).
+  """
+  return [render.FigureJob(
+      'create_figure_two_by_one', f'{converter}_linearized_rho_variation', path,
+      title_figure=f'Linearized {converters.get_converter(converter).title} Converter: '
+                   'Variation of ρ',
+      data_1={
+          'x': ρ_arr, 'y': ts_arr,
+          'x_label': 'ρ', 'y_label': '$t_s$ (s)',
+          'title': 'Settling Time $t_s(ρ)$'
+      },
+      data_2={
+          'x': ρ_arr, 'y': iet_arr,
+          'x_label': 'ρ', 'y_label': '$\overline{IET}(ρ) $ (s)',
+          'title': 'Inter-event Times Mean $\overline{IET}$'
+      },
+      fig_name=f'{converter}_linearized_rho_variation'
+  )]
 
-    Retorna:
-                    array: Saída do sistema.
-    """
-    return x[:2]
 
+def latest_sweep(store, tag, model):
+  """
+  Read the runs of the latest ρ sweep of a scenario from a result store.
+
+  The store keeps every sweep ever run, with other engines, θ, λ or ρ grids. The sweep
+  recorded in the scenario information by `add_scenario_stages` is selected, or, in stores
+  without it, the configuration of the latest stored sweep run, and the latest run of each ρ
+  is kept.
+
+  Parameters:
+                  store (ResultStore): Result store.
+                  tag (str): Scenario tag.
+                  model (str): Name of the linearized model of the scenario.
 
-class LinearizedBuckConverter:
+  Returns:
+                  DataFrame: Runs of the sweep, sorted by ρ.
   """
-  Classe para criar e gerenciar o modelo linearizado de um sistema.
+  runs = store.query(tag, model, 'dynamic', stage='rho_sweep')
+  if not len(runs):
+    return runs
+
+  latest = runs.loc[runs['run_id'].idxmax()]
+  sweep = store.load_scenario(tag).get('rho_sweep') or \
+      {'method': latest['method'], 'theta': latest['theta'], 'lam': latest['lam']}
+  selected = (runs['method'] == sweep['method']) & np.isclose(runs['theta'], sweep['theta']) & \
+      np.isclose(runs['lam'], sweep['lam'])
+  if 'rho' in sweep:
+    selected &= np.isclose(runs['rho'].to_numpy()[:, None], sweep['rho']).any(axis=1)
+  return runs[selected].sort_values('rho').reset_index(drop=True)
 
-  Parâmetros:
-                  name (str): Nome do sistema.
-                  params (dict): Dicionário de parâmetros do sistema e ponto de operação.
+
+def stored_figures(store, tag, path, converter='buck'):
   """
+  Build the figures of a scenario from the runs in a result store.
 
-  def __init__(self, name, params):
-    self.name = name
-    self.params = params
-    self.system = self.create_system()
+  The latest run of each figure input is used, and figures without stored runs are left out.
 
-  def create_system(self):
-    """
-    Cria o modelo linearizado do sistema com base nos parâmetros fornecidos.
+  Parameters:
+                  store (ResultStore): Result store.
+                  tag (str): Scenario tag.
+                  path (str): Directory of the figures.
+                  converter (str): Converter topology of the scenario.
 
-    Retorna:
-                    system: Representação do sistema em espaço de estados linearizado.
-    """
-    OP = self.params['op']
+  Returns:
+                  list: Figures to render (see `render.FigureJob`).
+  """
+  op = store.load_scenario(tag).get('op')
+  if op is None:
+    return []
+
+  def load(model, stage, etm_type='none'):
+    runs = store.query(tag, model, etm_type, stage=stage)
+    if not len(runs):
+      return None
+    run_id = int(runs['run_id'].iloc[-1])
+    t, y = store.load_trajectory(run_id)
+    if etm_type == 'none':
+      return t, y
+    et = store.load_events(run_id)['t']
+    return t, y, np.diff(et, prepend=et[:1]), et
+
+  nonlinear_model, shifted_model, linearized_model = converters.model_names(converter)
+  jobs = open_loop_figures(
+      path, op, load(nonlinear_model, 'open_loop'), load(shifted_model, 'open_loop'),
+      load(linearized_model, 'open_loop'), converter)
+
+  for etm_type in ('static', 'dynamic'):
+    nonlinear = load(shifted_model, 'closed_loop', etm_type)
+    linearized = load(linearized_model, 'closed_loop', etm_type)
+    if nonlinear is not None and linearized is not None:
+      jobs += etm_figures(path, op, etm_type, nonlinear, linearized, converter)
+
+  sweep = latest_sweep(store, tag, linearized_model)
+  if len(sweep):
+    jobs += rho_variation_figures(
+        path, sweep['rho'].to_numpy(), sweep['settling_time'].to_numpy(),
+        sweep['iet_mean'].to_numpy(), converter)
+
+  return jobs
+
+
+def render_figures(jobs):
+  """
+  Render figures in the current process, in EPS with every sample, skipping the figures whose
+  inputs did not change.
+  """
+  render.FigureRenderer(workers=1, max_points=None).render(jobs)
+
+
+def batch_rho_variable_simulation(
+        buck_linearized, params, end_time, pcpl_signal_data, initial_states_factor, ρ_start, ρ_step, ρ_end, θ, λ,
+        design_cache=None, stop=None, store=None, tag='', keep_runs=False):
+  """
+  Run the ρ sweep with every design simulated in a single batch.
+
+  Parameters:
+                  store (ResultStore): Result store for the run of each design, or None.
+                  tag (str): Scenario tag of the stored runs.
+                  keep_runs (bool): Also return the results and the design of each simulation.
+
+  Returns:
+                  tuple: List of ρ values, table of metrics (see `metrics.closed_loop_metrics`)
+                         and, if `keep_runs`, a list of tuples (results, design).
+  """
+  ρ_arr, designs = [], []
+  design = etm.ETMDesign(buck_linearized.system.A, buck_linearized.system.B[:, 0])
 
-    # Elementos da matriz de estados
-    A11 = - (self.params['rL'] / self.params['L'])
-    A12 = - (1. / self.params['L'])
-    A21 = 1. / self.params['C']
-    A22 = (1. / self.params['C']) * (OP['Pcpl'] /
-                                     (OP['vC'] ** 2) - 1. / self.params['rC'])
+  for ρ in np.arange(ρ_start, ρ_end + ρ_step, ρ_step):
+    if ρ >= 1.:
+      break
+
+    K, Ξ, Ψ = etm.get_etm_parameters(buck_linearized.system.A,
+                                     buck_linearized.system.B[:, 0], ρ, design, design_cache)
+    if K is None:
+      continue
 
-    # Elementos da matriz de entrada
-    B11 = self.params['Vin'] / self.params['L']
-    B12 = 0.
-    B21 = 0.
-    B22 = - 1.0 / (self.params['C'] * OP['vC'])
+    ρ_arr += [ρ]
+    designs += [(K, Ξ, Ψ)]
 
-    # Matriz de estados: iL e vC
-    A = [[A11, A12], [A21, A22]]
+  if not designs:
+    return ([], metrics.stack_metrics([])) + (([],) if keep_runs else ())
 
-    # Matriz de entrada: δd e δP_cpl
-    B = [[B11, B12], [B21, B22]]
+  K, Ξ, Ψ = (np.array(m) for m in zip(*designs))
 
-    # Matriz de saída: iL e vC
-    C = [[1., 0], [0., 1]]
+  t, y, iet, et = batch.batch_closed_loop_simulate(
+      buck_linearized, K, Ψ, Ξ, params, end_time,
+      pcpl_signal_data, initial_states_factor, θ=θ, λ=λ, stop=stop)
 
-    # Matriz de alimentação direta: nula
-    D = [[0., 0.], [0., 0.]]
+  runs = [((t, y[lane], iet[lane], et[lane]), design) for lane, design in enumerate(designs)]
+  for ρ, run in zip(ρ_arr, runs):
+    save_run(store, tag, buck_linearized, run[0], params, 'dynamic', run[1], 'batch',
+             'rho_sweep', ρ=ρ, θ=θ, λ=λ)
 
-    # Criando o sistema linearizado
-    system = ct.ss2io(ct.ss(A, B, C, D), name=self.name, inputs=(
-        'δd', 'δPcpl'), outputs=('δiL', 'δvC'), states=('δiL', 'δvC'))
-    return system
+  table = metrics.closed_loop_metrics(t, y, iet, params['op']['vC'])
+  return (ρ_arr, table) + ((runs,) if keep_runs else ())
 
 
-def create_params(V_IN, RL, RC, L, C, PCPL_OP, VC_OP):
+def rho_sweep_chunk(
+        points, buck_linearized, params, end_time, pcpl_signal_data, initial_states_factor,
+        method='interconnect', solve_ivp_method='RK45', design_cache=None, solver_threads=None,
+        stop=None, keep_runs=False, on_point=None, solver=etm.DEFAULT_SOLVER, period=None):
   """
-  Create a dictionary of parameters for the system model.
+  Evaluate a chunk of points of the ρ sweep, reusing one design problem for the chunk.
 
   Parameters:
-                  V_IN (float): Input voltage.
-                  RL (float): Resistance of the inductor.
-                  RC (float): Resistance of the capacitor.
-                  L (float): Inductance.
-                  C (float): Capacitance.
-                  PCPL_OP (float): Operating power of the CPL.
-                  VC_OP (float): Operating voltage of the capacitor.
+                  points (list): Tuples (ρ, θ, λ).
+                  solver_threads (int): Maximum number of MOSEK threads. If None, the solver default is kept.
+                  stop (etm.SteadyStateStop): Criterion to end each simulation once it has settled.
+                  keep_runs (bool): Return the results and the design of each simulation.
+                  on_point (function): Called as on_point(index, result) as soon as each point is evaluated.
+                  solver (str): cvxpy solver of the design problem.
+                  period (float): Sampling period of the 'periodic' engine.
 
   Returns:
-                  dict: Dictionary of system parameters.
+                  list: Tuples (metrics, run) for each point, with the metrics from
+                        `metrics.closed_loop_metrics` and the run as a tuple (results with the
+                        event trace, design) if `keep_runs`, else None. (None, None) for
+                        infeasible designs.
+  """
+  design = etm.ETMDesign(buck_linearized.system.A, buck_linearized.system.B[:, 0], solver)
+  if solver_threads is not None and design.solver == 'MOSEK':
+    design.solver_kwargs = {'mosek_params': {'MSK_IPAR_NUM_THREADS': solver_threads}}
+  results = []
+
+  for ρ, θ, λ in points:
+    K, Ξ, Ψ = etm.get_etm_parameters(buck_linearized.system.A,
+                                     buck_linearized.system.B[:, 0], ρ, design, design_cache)
+    if K is None:
+      results += [(None, None)]
+      if on_point is not None:
+        on_point(len(results) - 1, results[-1])
+      continue
+
+    detm = etm.DynamicETM('etm', Ψ, Ξ, θ, λ)
 
+    run = etm.closed_loop_simulate(
+        buck_linearized, detm, K, params, end_time,
+        pcpl_signal_data, initial_states_factor, method=method,
+        solve_ivp_method=solve_ivp_method, stop=stop, return_trace=keep_runs, period=period)
+    t_detm_l, y_detm_l, iet_detm_l, et_detm_l = run[:4]
+
+    results += [(metrics.closed_loop_metrics(t_detm_l, y_detm_l, iet_detm_l, params['op']['vC']),
+                 (run, (K, Ξ, Ψ)) if keep_runs else None)]
+    if on_point is not None:
+      on_point(len(results) - 1, results[-1])
+
+  return results
+
+
+def save_rho_variation(path, ρ_arr, table, converter='buck'):
   """
-  # Calculate the operating point (OP) values for inductor current and duty cycle
-  IL_OP = (VC_OP / RC) + PCPL_OP / VC_OP
-  D_OP = (RL * IL_OP) / V_IN + VC_OP / V_IN
+  Write the table of the ρ sweep to a CSV file.
 
-  # Create the dictionary of parameters
-  params = {
-      "Vin": V_IN,
-      "rL": RL,
-      "rC": RC,
-      "L": L,
-      "C": C,
-      "op": {"Pcpl": PCPL_OP, "vC": VC_OP, "iL": IL_OP, "d": D_OP},
-  }
+  Parameters:
+                  path (str): Directory of the file.
+                  ρ_arr (list): Values of ρ.
+                  table (dict): Metrics of each design.
+                  converter (str): Converter topology, which names the file.
 
-  return params
+  Returns:
+                  dict: Table with the ρ column first.
+  """
+  import pandas as pd
 
+  table = {'ρ': np.array(ρ_arr, dtype=float), **table}
+  pd.DataFrame(table).to_csv(path + f'/{converter}_linearized_rho_variation.csv', index=False)
+  return table
 
-def simulate(converter, params, perturbation_signal_data=None, end_time=0.1, step=1e-5, initial_factor=[1.5, 0.13]):
+
+def scenario_stages(entry, stages=None):
   """
-  Simulate the system based on the provided parameters and time settings.
+  Read the stages to run in a scenario of the JSON file.
 
   Parameters:
-                  params (dict): Dictionary of system parameters obtained from create_params function.
-                  end_time (float): End time of simulation.
-                  step (float): Time step for simulation.
-                  initial_factor (float): Factor to multiply the initial state values to obtain the initial conditions.
-                  perturb_factor (float): Factor to multiply the perturbation values to obtain the perturbed conditions.
+                  entry (dict): Scenario of the JSON file.
+                  stages (list): Stages to run. If None, the 'stages' list of the scenario, or
+                                 DEFAULT_STAGES.
 
   Returns:
-                  tuple: A tuple containing the following arrays:
-                                  - timepts (array): Array of time points for simulation.
-                                  - U (array): Array of system inputs for simulation.
-                                  - X0 (array): Array of initial states for simulation.
-                                  - δU (array): Array of perturbations in system inputs.
-                                  - δX0 (array): Array of perturbations in initial states.
-                                  - params (dict): Dictionary of system parameters.
+                  tuple: Names of the stages, among STAGES.
   """
+  stages = tuple(stages or entry.get('stages', DEFAULT_STAGES))
 
-  # Ponto de operação de cada entrada e estado do sistema
-  U_OP = np.array([params['op']['d'], params['op']['Pcpl']])
-  X_OP = np.array([params['op']['iL'], params['op']['vC']])
+  unknown = [stage for stage in stages if stage not in STAGES]
+  if unknown:
+    raise ValueError(f'Unknown stages: {", ".join(unknown)} (available: {", ".join(STAGES)})')
 
-  # Instantes de tempo
-  timepts = np.arange(0, end_time + step, step)
+  return stages
 
-  # Entradas do Sistema
-  if perturbation_signal_data == None:
-    perturbation_signal_data = [(0., U_OP[1])]
-  P_CPL = utils.generate_square_signal(timepts, perturbation_signal_data)
 
-  D = [params['op']['d'] for _ in range(len(timepts))]
-  U = [D, P_CPL.tolist()]
+def load_scenario(entry):
+  """
+  Read a scenario of the JSON file.
 
-  # Estados Iniciais do Sistema
-  IL_INIT = initial_factor[0] * params['op']['iL']
-  VC_INIT = initial_factor[1] * params['op']['vC']
-  X0 = np.array([IL_INIT, VC_INIT])
+  Every value of the scenario is an input of its stages, so it is part of their cache keys.
 
-  INPUT, INITIAL_STATE = U, X0
+  Parameters:
+                  entry (dict): Scenario of the JSON file.
 
-  if not isinstance(converter, NonlinearBuckConverter):
-    INPUT = U - U_OP[:, np.newaxis]
-    INITIAL_STATE = X0 - X_OP
-  else:
-    INPUT = U
-    INITIAL_STATE = X0
+  Returns:
+                  dict: Scenario with the keys tag, converter, path, params, end_time, step,
+                        initial_states_factor and pcpl_signal_data.
+  """
+  converter = entry.get('converter', 'buck')
+
+  return {
+      'tag': entry['tag'],
+      'converter': converter,
+      'path': f'./{converter}/results/' + entry['tag'],
+      'params': converters.get_converter(converter).scenario_params(
+          entry['circuit_params'], entry['desired_values']),
+      'end_time': entry['end_time_simulation'],
+      'step': entry.get('step', 1e-5),
+      'initial_states_factor': entry['initial_states_factor'],
+      'pcpl_signal_data': [(d['t'], d['pcpl']) for d in entry['pcpl_signal_data']],
+  }
 
-  if isinstance(converter, LinearizedBuckConverter):
-    return ct.input_output_response(
-        sys=converter.system, T=timepts,
-        U=INPUT, X0=INITIAL_STATE,
-    )
 
-  return ct.input_output_response(
-      sys=converter.system, T=timepts,
-      U=INPUT, X0=INITIAL_STATE, params=params,
-  )
+def create_models(params, converter='buck'):
+  """
+  Create the converter models of a scenario.
 
+  Parameters:
+                  params (dict): Dictionary of system parameters.
+                  converter (str): Converter topology (see `converters.CONVERTERS`).
 
-def open_loop_simulation(
-    tag, path, step, buck_nonlinear, buck_shifted_nonlinear, buck_linearized, params, end_time, initial_states_factor, pcpl_signal_data
-):
-  print(f'[{tag}]\tNon-linear buck converter simulation start')
-  t_nonlinear, y_nonlinear = simulate(
-      converter=buck_nonlinear,
-      params=params,
-      end_time=end_time,
-      initial_factor=initial_states_factor,
-      perturbation_signal_data=pcpl_signal_data,
-      step=step,
-  )
-  print(f'[{tag}]\tNon-linear buck converter simulation finalized')
+  Returns:
+                  dict: Non-linear, shifted non-linear and linearized models, by name, such as
+                        'buck_linearized'.
+  """
+  return converters.create_models(converter, params)
 
-  utils.create_figure_two_by_one(
-      title_figure='Non-linear Buck Converter: States $i_L$ and $v_C$',
-      data_1={
-          'x': t_nonlinear, 'y': y_nonlinear[0],
-          'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
-          'title': 'Inductor Current $i_L(t)$'
-      },
-      data_2={
-          'x': t_nonlinear, 'y': y_nonlinear[1],
-          'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
-          'title': 'Capacitor Voltage $v_C(t)$'
-      },
-      fig_name='buck_nonlinear_states',
-      path=path
-  )
 
-  print(f'[{tag}]\tNon-linear buck converter simulation result saved\n')
+def linearized_model(scenario):
+  """
+  Create the linearized model of a scenario.
+  """
+  name = converters.model_names(scenario['converter'])[-1]
+  return converters.LinearizedConverter(
+      converters.get_converter(scenario['converter']), name, scenario['params'])
 
-  print(f'[{tag}]\tShifted non-linear buck converter simulation start')
-  t_shifted_nonlinear, y_shifted_nonlinear = simulate(
-      converter=buck_shifted_nonlinear,
-      params=params,
-      end_time=end_time,
-      initial_factor=initial_states_factor,
-      perturbation_signal_data=pcpl_signal_data,
-      step=step,
-  )
 
-  print(f'[{tag}]\tShifted non-linear buck converter simulation finalized')
-  utils.create_figure_two_by_one(
-      title_figure='Shifted Non-linear Buck Converter: States $i_L$ and $v_C$',
-      data_1={
-          'x': t_shifted_nonlinear,
-          'y': y_shifted_nonlinear[0] + params['op']['iL'],
-          'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
-          'title': 'Inductor Current $i_L(t)$'
-      },
-      data_2={
-          'x': t_shifted_nonlinear,
-          'y': y_shifted_nonlinear[1] + params['op']['vC'],
-          'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
-          'title': 'Capacitor Voltage $v_C(t)$'
-      },
-      fig_name='buck_shifted_nonlinear_states',
-      path=path
-  )
-  print(
-      f'[{tag}]\tShifted non-linear buck converter simulation result saved')
+def design_stage(scenario, ρ=0.5, design_cache=None):
+  """
+  Stage solving the ETM design problem of a scenario.
 
-  t_linearized, y_linearized = simulate(
-      converter=buck_linearized,
-      params=params,
-      end_time=end_time,
-      initial_factor=initial_states_factor,
-      perturbation_signal_data=pcpl_signal_data,
-      step=step,
-  )
+  Returns:
+                  tuple: K, Ξ and Ψ.
+  """
+  linearized = linearized_model(scenario)
+  return etm.get_etm_parameters(linearized.system.A, linearized.system.B[:, 0], ρ,
+                                cache=design_cache)
 
-  print(f'\n[{tag}]\tLinearized buck converter simulation started')
-  utils.create_figure_two_by_one(
-      title_figure='Linearized Buck Converter: States $i_L$ and $v_C$',
-      data_1={
-          'x': t_linearized,
-          'y': y_linearized[0] + params['op']['iL'],
-          'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
-          'title': 'Inductor Current $i_L(t)$'
-      },
-      data_2={
-          'x': t_linearized,
-          'y': y_linearized[1] + params['op']['vC'],
-          'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
-          'title': 'Capacitor Voltage $v_C(t)$'
-      },
-      fig_name='buck_linearized_states',
-      path=path
-  )
 
-  print(f'[{tag}]\tLinearized buck converter simulation finalized')
-  utils.create_figure_two_by_two(
-      title_figure='Non-linear vs Linearized Buck Converter: States $i_L$ and $v_C$',
-      data_1={
-          'x1': t_shifted_nonlinear, 'x2': t_linearized,
-          'y1': y_shifted_nonlinear[0] + params['op']['iL'],
-          'y2': y_linearized[0] + params['op']['iL'],
-          'x_label': 'Time (s)', 'y_label': '$i_L$ (A)',
-          'title': 'Inductor Current $i_L(t)$'
-      },
-      data_2={
-          'x1': t_shifted_nonlinear, 'x2': t_linearized,
-          'y1': y_shifted_nonlinear[1] + params['op']['vC'],
-          'y2': y_linearized[1] + params['op']['vC'],
-          'x_label': 'Time (s)', 'y_label': '$v_C$ (V)',
-          'title': 'Capacitor Voltage $v_C(t)$'
-      },
-      legends=['Non-linear', 'Linearized'],
-      fig_name='buck_nonlinear_vs_linearized_states',
-      path=path
+def open_loop_stage(scenario, model, solve_ivp_method='RK45'):
+  """
+  Stage simulating a model of a scenario in open loop.
+
+  Returns:
+                  tuple: Time points and outputs.
+  """
+  return simulate(
+      converter=create_models(scenario['params'], scenario['converter'])[model],
+      params=scenario['params'],
+      end_time=scenario['end_time'],
+      initial_factor=scenario['initial_states_factor'],
+      perturbation_signal_data=scenario['pcpl_signal_data'],
+      step=scenario['step'],
+      solve_ivp_method=solve_ivp_method,
   )
-  print(f'[{tag}]\tLinearized buck converter simulation result saved')
 
 
-def closed_loop_simulation(
-    tag, path, buck_linearized, buck_shifted_nonlinear, params, end_time, pcpl_signal_data, initial_states_factor
-):
-  print(f'\n[{tag}]\tSolving the optimization problem to obtain the ETM design parameters.')
+def closed_loop_stage(design, scenario, model, etm_type, method='interconnect',
+                      solve_ivp_method='RK45', θ=1, λ=100, period=None):
+  """
+  Stage simulating a model of a scenario under the static or the dynamic ETM.
 
-  K, Ξ, Ψ = etm.get_etm_parameters(buck_linearized.system.A,
-                                   buck_linearized.system.B[:, 0])
+  The analytic engine only applies to the linearized model; the non-linear models then use
+  the hybrid engine.
 
-  print(f'[{tag}]\tDesign parameters obtained\n')
+  Returns:
+                  tuple: Results of `etm.closed_loop_simulate`, with the event trace.
+  """
+  K, Ξ, Ψ = design
+  mechanism = etm.StaticETM('etm', Ψ, Ξ) if etm_type == 'static' else \
+      etm.DynamicETM('etm', Ψ, Ξ, θ=θ, λ=λ)
+  converter = create_models(scenario['params'], scenario['converter'])[model]
+  if method == 'analytic' and not isinstance(converter, converters.LinearizedConverter):
+    method = 'hybrid'
 
-  print(
-      f'[{tag}]\tNon-linear buck converter under static etm simulation start')
+  return etm.closed_loop_simulate(
+      converter, mechanism, K, scenario['params'],
+      scenario['end_time'], scenario['pcpl_signal_data'], scenario['initial_states_factor'],
+      step=scenario['step'], method=method, solve_ivp_method=solve_ivp_method,
+      return_trace=True, period=period)
 
-  setm = etm.StaticETM('etm', Ψ, Ξ)
 
-  t_setm_nl, y_setm_nl, iet_setm_nl, et_setm_nl = etm.closed_loop_simulate(
-      buck_shifted_nonlinear, setm, K, params, end_time,
-      pcpl_signal_data, initial_states_factor)
+def rho_chunk_stage(scenario, points, cache=None, **kwargs):
+  """
+  Stage evaluating a chunk of points of the ρ sweep of a scenario (see `rho_sweep_chunk`).
 
-  print(
-      f'[{tag}]\tNon-linear buck converter under static etm simulation finalized')
+  With a stage cache every point is cached as soon as it is evaluated, so an interrupted sweep
+  resumes from the points it had completed, whatever the chunks.
 
-  print(
-      f'[{tag}]\tLinearized buck converter under static etm simulation start')
+  Parameters:
+                  scenario (dict): Scenario (see `load_scenario`).
+                  points (list): Tuples (ρ, θ, λ).
+                  cache (StageCache): Cache of the points, or None.
+                  **kwargs: Keyword arguments of `rho_sweep_chunk`.
+  """
+  params = scenario['params']
+  point_inputs = {name: value for name, value in kwargs.items() if name != 'solver_threads'}
+  keys = [cache.key(rho_sweep_chunk, scenario, point, point_inputs) if cache is not None else None
+          for point in points]
+  results = [cache.get(key) if cache is not None else StageCache.MISSING for key in keys]
+  missing = [index for index, result in enumerate(results) if result is StageCache.MISSING]
 
-  t_setm_l, y_setm_l, iet_setm_l, et_setm_l = etm.closed_loop_simulate(
-      buck_linearized, setm, K, params, end_time,
-      pcpl_signal_data, initial_states_factor,)
-  print(
-      f'[{tag}]\tLinearized buck converter under static etm simulation finalized')
+  def on_point(index, result):
+    results[missing[index]] = result
+    if cache is not None:
+      cache.put(keys[missing[index]], result)
 
-  utils.create_etm_results_figures(
-      'Buck Converter Under Static ETM',
-      'buck_under_static_etm', path, params['op'],
-      t_setm_nl, y_setm_nl, iet_setm_nl, et_setm_nl,
-      t_setm_l, y_setm_l, iet_setm_l, et_setm_l
-  )
+  if missing:
+    rho_sweep_chunk(
+        [points[index] for index in missing], linearized_model(scenario),
+        params, scenario['end_time'], scenario['pcpl_signal_data'],
+        scenario['initial_states_factor'], on_point=on_point, **kwargs)
 
-  print(
-      f'[{tag}]\tBuck converter under static etm simulation result saved')
+  return results
 
-  print(
-      f'[{tag}]\tNon-linear buck converter under static etm simulation start')
 
-  detm = etm.DynamicETM('etm', Ψ, Ξ, θ=1, λ=100)
+def rho_batch_stage(scenario, ρ_start, ρ_step, ρ_end, θ, λ, design_cache=None, stop=None,
+                    keep_runs=False):
+  """
+  Stage simulating every design of the ρ sweep of a scenario in a single batch
+  (see `batch_rho_variable_simulation`).
 
-  t_detm_nl, y_detm_nl, iet_detm_nl, et_detm_nl = etm.closed_loop_simulate(
-      buck_shifted_nonlinear, detm, K, params, end_time,
-      pcpl_signal_data, initial_states_factor)
+  Returns:
+                  list: Tuples (ρ, metrics, run) for each feasible design, with the metrics and
+                        the run in the format of `rho_sweep_chunk`.
+  """
+  params = scenario['params']
+  ρ_arr, table, runs = batch_rho_variable_simulation(
+      linearized_model(scenario), params, scenario['end_time'],
+      scenario['pcpl_signal_data'], scenario['initial_states_factor'], ρ_start, ρ_step, ρ_end,
+      θ, λ, design_cache, stop, keep_runs=True)
 
-  print(
-      f'[{tag}]\tNon-linear buck converter under dynamic etm simulation finalized')
+  return [(ρ, {column: values[lane] for column, values in table.items()},
+           runs[lane] if keep_runs else None) for lane, ρ in enumerate(ρ_arr)]
 
-  print(
-      f'[{tag}]\tLinearized buck converter under dynamic etm simulation start')
 
-  t_detm_l, y_detm_l, iet_detm_l, et_detm_l = etm.closed_loop_simulate(
-      buck_linearized, detm, K, params, end_time,
-      pcpl_signal_data, initial_states_factor,)
-  print(
-      f'[{tag}]\tLinearized buck converter under dynamic etm simulation finalized')
+def rho_sweep_stage(*chunks, scenario, points, method='interconnect', store=None):
+  """
+  Stage gathering the chunks of the ρ sweep of a scenario: stores the runs and writes the table.
 
-  utils.create_etm_results_figures(
-      'Buck Converter Under Dynamic ETM',
-      'buck_under_dynamic_etm', path, params['op'],
-      t_detm_nl, y_detm_nl, iet_detm_nl, et_detm_nl,
-      t_detm_l, y_detm_l, iet_detm_l, et_detm_l
-  )
+  Returns:
+                  dict: Table of the sweep, with the ρ column first.
+  """
+  if method == 'batch':
+    rows = {ρ: (row, run) for ρ, row, run in chunks[0]}
+    results = [rows.get(ρ, (None, None)) for ρ, _, _ in points]
+  else:
+    results = [result for chunk in chunks for result in chunk]
 
-  print(f'[{tag}]\tBuck converter under dynamic etm simulation result saved')
+  linearized = linearized_model(scenario)
+  for (ρ, θ, λ), (_, run) in zip(points, results):
+    if run is not None:
+      save_run(store, scenario['tag'], linearized, run[0], scenario['params'], 'dynamic',
+               run[1], method, 'rho_sweep', ρ=ρ, θ=θ, λ=λ)
 
+  return save_rho_variation(scenario['path'], [ρ for ρ, _, _ in points],
+                            metrics.stack_metrics([row for row, _ in results]),
+                            scenario['converter'])
 
-def rho_variable_simulation(
-        tag, path, buck_linearized, params, end_time, pcpl_signal_data, initial_states_factor, ρ_start=0.01, ρ_step=1e-1, ρ_end=0.99,
-        θ=1, λ=100):
 
-  ρ_arr, ts_arr, iet_arr = [], [], []
+def store_stage(results, *design, store, scenario, model, etm_type='none', method='',
+                stage='', **kwargs):
+  """
+  Stage writing the results of a simulation to the result store (see `save_run`).
+  """
+  save_run(store, scenario['tag'], create_models(scenario['params'], scenario['converter'])[model], results,
+           scenario['params'], etm_type, design[0] if design else None, method, stage, **kwargs)
 
-  print(f'[{tag}]\tVariation of ρ simulation started')
 
-  for ρ in np.arange(ρ_start, ρ_end + ρ_step, ρ_step):
-    if ρ >= 1.:
-      break
+def open_loop_figures_stage(nonlinear, shifted_nonlinear, linearized, scenario):
+  """
+  Stage rendering the figures of the open-loop simulations of a scenario.
+  """
+  render_figures(open_loop_figures(scenario['path'], scenario['params']['op'], nonlinear,
+                                   shifted_nonlinear, linearized, scenario['converter']))
 
-    K, Ξ, Ψ = etm.get_etm_parameters(buck_linearized.system.A,
-                                     buck_linearized.system.B[:, 0], ρ)
 
-    detm = etm.DynamicETM('etm', Ψ, Ξ, θ, λ)
+def etm_figures_stage(nonlinear, linearized, scenario, etm_type):
+  """
+  Stage rendering the figures of the closed-loop simulations of a scenario under an ETM.
+  """
+  render_figures(etm_figures(scenario['path'], scenario['params']['op'], etm_type, nonlinear,
+                             linearized, scenario['converter']))
 
-    t_detm_l, y_detm_l, iet_detm_l, et_detm_l = etm.closed_loop_simulate(
-        buck_linearized, detm, K, params, end_time,
-        pcpl_signal_data, initial_states_factor,)
 
-    ts = utils.get_settling_time(y_detm_l[1] + params['op']['vC'], t_detm_l)
-    iet_mean = np.mean(np.array(iet_detm_l))
+def rho_figures_stage(table, scenario):
+  """
+  Stage rendering the figure of the ρ sweep of a scenario.
 
-    ρ_arr += [ρ]
-    ts_arr += [ts]
-    iet_arr += [iet_mean]
+  The figure is skipped when no design of the sweep is feasible, since the table then has no
+  metrics to plot.
+  """
+  if 'settling_time' not in table:
+    instrument.log.warning(
+        f'[{scenario["tag"]}]\tρ sweep figure skipped: no design of the sweep is feasible')
+    return
+  render_figures(rho_variation_figures(scenario['path'], table['ρ'], table['settling_time'],
+                                       table['iet_mean'], scenario['converter']))
 
-  print(f'[{tag}]\tVariation of ρ simulation finalized')
-  utils.create_figure_two_by_one(
-      title_figure='Linearized Buck Converter: Variation of ρ',
-      data_1={
-          'x': ρ_arr, 'y': ts_arr,
-          'x_label': 'ρ', 'y_label': '$t_s$ (s)',
-          'title': 'Settling Time $t_s(ρ)$'
-      },
-      data_2={
-          'x': ρ_arr, 'y': iet_arr,
-          'x_label': 'ρ', 'y_label': '$\overline{IET}(ρ) $ (s)',
-          'title': 'Inter-event Times Mean $\overline{IET}$'
-      },
-      fig_name='buck_linearized_rho_variation',
-      path=path
-  )
-  print(f'[{tag}]\tVariation of ρ simulation result save')
+
+def add_scenario_stages(pipeline, scenario, stages, method='interconnect', solve_ivp_method='RK45',
+                        batched=False, design_cache=None, stop=None, store=None, chunksize=None,
+                        ρ=0.5, θ=1, λ=100, ρ_start=0.1, ρ_step=1e-1, ρ_end=1., period=None):
+  """
+  Add the stages of a scenario to a pipeline.
+
+  The selected stages of the scenario expand into a graph: the ETM design precedes the four
+  closed-loop simulations, the ρ sweep is split into chunks of points gathered by a final
+  stage, the results are written to the store by local stages, and, without a store, the
+  figures are rendered by stages depending on the simulations. With a store, the figures are
+  rendered from the stored runs once the pipeline has finished. The stages writing the store
+  and the ρ sweep table are not cached, so the files are written again on every run from the
+  cached simulations. The stages carry the scenario tag as an instrumentation label.
+
+  Parameters:
+                  pipeline (Pipeline): Pipeline receiving the stages.
+                  scenario (dict): Scenario (see `load_scenario`).
+                  stages (tuple): Stages to run (see `scenario_stages`).
+                  method (str): Closed-loop simulation engine.
+                  solve_ivp_method (str): Integration method.
+                  batched (bool): Simulate all designs of the ρ sweep in a single batch.
+                  design_cache (DesignCache): Persistent cache of ETM design results.
+                  stop (etm.SteadyStateStop): Criterion to end each ρ sweep simulation once settled.
+                  store (ResultStore): Result store, or None.
+                  chunksize (int): Number of ρ sweep points in each stage. If None, the points are
+                                   spread evenly over the workers.
+                  ρ (float): Weight of the design objective of the closed-loop simulations.
+                  θ (float): Threshold parameter of the dynamic ETM.
+                  λ (float): Decay rate of the dynamic ETM.
+                  ρ_start (float): First value of the ρ sweep.
+                  ρ_step (float): Step of the ρ sweep.
+                  ρ_end (float): Last value of the ρ sweep.
+                  period (float): Sampling period of the 'periodic' engine. If None, the step.
+  """
+  tag = scenario['tag']
+  models = converters.model_names(scenario['converter'])
+  figures = 'figures' in stages and store is None
+  add = functools.partial(pipeline.add, labels={'scenario': tag})
+
+  if 'open_loop' in stages:
+    for model in models:
+      name = add(f'{tag}/open_loop/{model}', open_loop_stage, scenario=scenario,
+                 model=model, solve_ivp_method=solve_ivp_method)
+      if store is not None:
+        add(f'{tag}/store/open_loop/{model}', store_stage, [name], local=True, cached=False,
+            store=store, scenario=scenario, model=model, method='open_loop',
+            stage='open_loop')
+    if figures:
+      add(f'{tag}/figures/open_loop', open_loop_figures_stage,
+          [f'{tag}/open_loop/{model}' for model in models], cached=False,
+          scenario=scenario)
+
+  for etm_type in ('static', 'dynamic'):
+    if f'{etm_type}_etm' not in stages:
+      continue
+
+    design = f'{tag}/design'
+    if design not in pipeline:
+      add(design, design_stage, scenario=scenario, ρ=ρ, design_cache=design_cache)
+
+    names = []
+    for model in models[1:]:
+      model_method = 'hybrid' if method == 'analytic' and model != models[-1] else method
+      etm_parameters = {'θ': θ, 'λ': λ} if etm_type == 'dynamic' else {}
+      names += [add(
+          f'{tag}/{etm_type}_etm/{model}', closed_loop_stage, [design], scenario=scenario,
+          model=model, etm_type=etm_type, method=method, solve_ivp_method=solve_ivp_method,
+          period=period, **etm_parameters)]
+      if store is not None:
+        add(f'{tag}/store/{etm_type}_etm/{model}', store_stage, [names[-1], design],
+            local=True, cached=False, store=store, scenario=scenario, model=model,
+            etm_type=etm_type, method=model_method, stage='closed_loop', ρ=ρ, **etm_parameters)
+    if figures:
+      add(f'{tag}/figures/{etm_type}_etm', etm_figures_stage, names, cached=False,
+          scenario=scenario, etm_type=etm_type)
+
+  if 'rho_sweep' in stages:
+    points = [(ρ_point, θ, λ) for ρ_point in np.arange(ρ_start, ρ_end + ρ_step, ρ_step)
+              if ρ_point < 1.]
+
+    if batched:
+      chunks = [add(f'{tag}/rho_sweep/batch', rho_batch_stage, scenario=scenario,
+                    ρ_start=ρ_start, ρ_step=ρ_step, ρ_end=ρ_end, θ=θ, λ=λ,
+                    design_cache=design_cache, stop=stop, keep_runs=store is not None)]
+    else:
+      chunks = [
+          add(f'{tag}/rho_sweep/chunk_{index}', rho_chunk_stage, scenario=scenario,
+              points=chunk, method=method, solve_ivp_method=solve_ivp_method,
+              design_cache=design_cache, solver_threads=1 if pipeline.workers != 1 else None,
+              stop=stop, keep_runs=store is not None, cache=pipeline.cache, period=period)
+          for index, chunk in enumerate(split_chunks(
+              points, chunksize or max(1, math.ceil(len(points) / pipeline.workers))))]
+
+    sweep_method = 'batch' if batched else method
+    if store is not None:
+      store.write_scenario(tag, rho_sweep={'method': sweep_method, 'theta': θ, 'lam': λ,
+                                           'rho': [ρ_point for ρ_point, _, _ in points]})
+    sweep = add(f'{tag}/rho_sweep', rho_sweep_stage, chunks, local=True, cached=False,
+                scenario=scenario, points=points, method=sweep_method, store=store)
+    if figures:
+      add(f'{tag}/figures/rho_sweep', rho_figures_stage, [sweep], cached=False,
+          scenario=scenario)
 
 
 def main(args):
   with open(args.json_file, 'r') as file:
     data = json.load(file)
 
-  for scenario in data:
+  design_cache = None if args.no_design_cache else DesignCache(args.design_cache)
+  stop = etm.SteadyStateStop(args.settle_tolerance, args.settle_window) \
+      if args.stop_when_settled else None
+  if args.no_store:
+    store = None
+  else:
+    from store import ResultStore
+    store = ResultStore(args.store)
+  stages = args.stages.split(',') if args.stages else None
+  instrument.enable(args.instrument is not None)
+
+  stage_cache = None if args.no_stage_cache else StageCache(
+      args.stage_cache, source_version(os.path.dirname(os.path.abspath(etm.__file__)),
+                                       os.path.dirname(os.path.abspath(__file__))))
+  pipeline = Pipeline(args.workers or None, cache=stage_cache)
+  scenarios = []
+
+  for entry in data.values():
 
-    if data[scenario]['ignore']:
+    if entry['ignore']:
       continue
 
-    end_time = data[scenario]['end_time_simulation']
-    scenario_tag = data[scenario]['tag']
-    initial_states_factor = data[scenario]['initial_states_factor']
-    circuit_params = data[scenario]['circuit_params']
-    desired_values = data[scenario]['desired_values']
-    pcpl_signal_data = [(d['t'], d['pcpl'])
-                        for d in data[scenario]['pcpl_signal_data']]
-    params = create_params(
-        V_IN=circuit_params['input_voltage'],
-        RC=circuit_params['constant_resistance_load'],
-        RL=circuit_params['inductor_winding_resistance'],
-        L=circuit_params['inductance'],
-        C=circuit_params['capacitance'],
-        PCPL_OP=desired_values['pcpl_power'],
-        VC_OP=desired_values['capacitor_voltage']
-    )
-    step = 1e-5
-    path = './buck/results/' + scenario_tag
-    os.makedirs(path, exist_ok=True)
-
-    print(f'[{scenario_tag}]\tNew simulation started!')
-
-    buck_nonlinear = NonlinearBuckConverter('buck_nonlinear')
-    buck_shifted_nonlinear = ShiftedNonlinearBuckConverter(
-        'buck_shifted_nonlinear')
-    buck_linearized = LinearizedBuckConverter(
-        'buck_linearized', params)
-
-    # open_loop_simulation(
-    #     scenario_tag, path, step, buck_nonlinear, buck_shifted_nonlinear, buck_linearized, params, end_time, initial_states_factor, pcpl_signal_data
-    # )
-
-    # closed_loop_simulation(
-    #     scenario_tag, path, buck_linearized, buck_shifted_nonlinear, params, end_time, pcpl_signal_data, initial_states_factor
-    # )
-
-    rho_variable_simulation(
-        scenario_tag, path, buck_linearized, params, end_time, pcpl_signal_data, initial_states_factor,  ρ_start=0.1, ρ_end=1. )
-
-    print('\n')
+    scenario = load_scenario(entry)
+    selected = tuple(stage for stage in scenario_stages(entry, stages)
+                     if not (args.no_figures and stage == 'figures'))
+    os.makedirs(scenario['path'], exist_ok=True)
+    if store is not None:
+      store.write_scenario(scenario['tag'], op=scenario['params']['op'])
+
+    instrument.log.info(f'[{scenario["tag"]}]\tStages: {", ".join(selected)}')
+
+    add_scenario_stages(
+        pipeline, scenario, selected, method=args.method, solve_ivp_method=args.solver,
+        batched=args.batched, design_cache=design_cache, stop=stop, store=store,
+        chunksize=args.chunksize, period=args.period)
+    scenarios += [(scenario, selected)]
+
+  try:
+    pipeline.run()
+    failed = {}
+  except PipelineError as error:
+    failed = error.failed
+
+  if store is not None:
+    renderer = render.FigureRenderer(args.render_workers or None, args.figure_format,
+                                     args.figure_dpi, args.max_points or None, args.force_figures)
+    jobs = []
+    for scenario, selected in scenarios:
+      if 'figures' not in selected:
+        continue
+      if any(name.startswith(scenario['tag'] + '/') for name in failed):
+        instrument.log.warning(
+            f'[{scenario["tag"]}]\tFigures skipped: a stage of the scenario failed')
+        continue
+      jobs += stored_figures(store, scenario['tag'], scenario['path'], scenario['converter'])
+    with instrument.labels(stage='figures'):
+      rendered, skipped = renderer.render(jobs)
+    instrument.log.info(f'Figures rendered: {rendered}, unchanged: {skipped}')
+
+  if args.instrument is not None:
+    os.makedirs(os.path.dirname(args.instrument) or '.', exist_ok=True)
+    instrument.write_json(args.instrument + '.json')
+    instrument.write_prometheus(args.instrument + '.prom')
+    instrument.log.info(f'Instrumentation report: {args.instrument}.json, {args.instrument}.prom')
+
+  if failed:
+    instrument.log.error(f'Failed stages: {", ".join(failed)}')
+    return 1
+  return 0
 
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Process a JSON file.')
   parser.add_argument('json_file', type=str, help='Path to the JSON file')
+  parser.add_argument('--method', type=str, default='interconnect',
+                      choices=['interconnect', 'hybrid', 'fused', 'analytic', 'periodic'],
+                      help='Closed-loop simulation engine (analytic applies to the linearized model; '
+                      'the non-linear model then uses hybrid; periodic checks the trigger every '
+                      '--period seconds)')
+  parser.add_argument('--period', type=float, default=None,
+                      help='Sampling period of the trigger of the periodic engine, a multiple of '
+                      'the step of the scenario (default: the step)')
+  parser.add_argument('--solver', type=str, default='RK45',
+                      choices=['RK45', 'RK23', 'DOP853', 'Radau', 'BDF', 'LSODA'],
+                      help='Integration method (implicit methods use the analytic Jacobians)')
+  parser.add_argument('--batched', action='store_true',
+                      help='Simulate all designs of the ρ sweep in a single batch')
+  parser.add_argument('--stages', type=str, default=None,
+                      help='Comma-separated stages to run in every scenario, among '
+                      f'{", ".join(STAGES)} (default: the "stages" list of each scenario, '
+                      f'or {",".join(DEFAULT_STAGES)})')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='Number of worker processes running the stages (0 uses all CPUs)')
+  parser.add_argument('--chunksize', type=int, default=None,
+                      help='Number of ρ sweep points evaluated by each stage')
+  parser.add_argument('--design-cache', type=str, default='./buck/cache/etm_designs.sqlite',
+                      help='Path of the persistent cache of ETM design results')
+  parser.add_argument('--no-design-cache', action='store_true',
+                      help='Always solve the ETM design problems')
+  parser.add_argument('--stage-cache', type=str, default='./buck/cache/stages',
+                      help='Directory of the cache of stage results, keyed by the stage inputs '
+                      'and the code version')
+  parser.add_argument('--no-stage-cache', action='store_true',
+                      help='Run every stage, even if its inputs did not change')
+  parser.add_argument('--store', type=str, default='./buck/results/results.h5',
+                      help='Path of the HDF5 store of trajectories, events, designs and metrics')
+  parser.add_argument('--no-store', action='store_true',
+                      help='Do not store the numeric results (the figures are then rendered inline)')
+  parser.add_argument('--no-figures', action='store_true',
+                      help='Do not render the figures')
+  parser.add_argument('--figure-format', type=str, default='eps',
+                      choices=render.VECTOR_FORMATS + render.RASTER_FORMATS,
+                      help='File format of the figures rendered from the result store')
+  parser.add_argument('--figure-dpi', type=float, default=None,
+                      help='Resolution of raster figures')
+  parser.add_argument('--max-points', type=int, default=2000,
+                      help='Maximum number of points of each plotted line, downsampled with LTTB '
+                      '(0 plots every sample)')
+  parser.add_argument('--render-workers', type=int, default=0,
+                      help='Number of worker processes rendering the figures (0 uses all CPUs)')
+  parser.add_argument('--force-figures', action='store_true',
+                      help='Render every figure, even if its inputs did not change')
+  parser.add_argument('--instrument', type=str, nargs='?', default=None,
+                      const='./buck/results/instrumentation',
+                      help='Count the RHS, ETM output and Γ evaluations and the events, time the '
+                      'stages, design solves, integration and plotting, and write the report to '
+                      'INSTRUMENT.json and INSTRUMENT.prom (Prometheus text format)')
+  parser.add_argument('--stop-when-settled', action='store_true',
+                      help='End each ρ sweep simulation once the closed loop has settled')
+  parser.add_argument('--settle-tolerance', type=float, default=5e-3,
+                      help='Settling band around the current state, relative to the operating point')
+  parser.add_argument('--settle-window', type=float, default=5e-3,
+                      help='Time the states must stay in the band, without events, to stop (s)')
+  parser.add_argument('--log-level', type=str, default='INFO',
+                      choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                      help='Lowest level of the progress messages shown')
   args = parser.parse_args()
-  main(args)
+  instrument.configure_logging(args.log_level)
+  sys.exit(main(args))
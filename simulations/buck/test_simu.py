@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+
+import simu
+import converters
+from store import ResultStore
+
+
+def test_infeasible_rho_sweep_skips_the_figure(tmp_path, buck_params, caplog):
+  scenario = {'tag': 'scenario-2', 'converter': 'buck', 'path': str(tmp_path),
+              'params': buck_params}
+  points = [(ρ, 1, 100) for ρ in (0.1, 0.2, 0.3)]
+
+  table = simu.rho_sweep_stage([(None, None)] * 2, [(None, None)], scenario=scenario,
+                               points=points)
+  assert list(table) == ['ρ']
+  assert os.path.exists(tmp_path / 'buck_linearized_rho_variation.csv')
+
+  simu.rho_figures_stage(table, scenario)
+  assert 'no design of the sweep is feasible' in caplog.text
+  assert not [name for name in os.listdir(tmp_path) if not name.endswith('.csv')]
+
+
+def test_stored_figures_plot_only_the_latest_rho_sweep(tmp_path):
+  store = ResultStore(str(tmp_path / 'results.h5'))
+  model = converters.model_names('buck')[2]
+  t = np.linspace(0., 1., 5)
+  for method, θ, ρ_values, settling_time in (('analytic', 1., (0.1, 0.2, 0.3), 1.),
+                                             ('interconnect', 2., (0.1, 0.2, 0.3), 2.),
+                                             ('periodic', 1., (0.1, 0.3), 3.),
+                                             ('periodic', 1., (0.1, 0.3), 4.)):
+    for ρ in ρ_values:
+      store.write_run('scenario-1', model, t, [t], 'dynamic', ρ=ρ, θ=θ, λ=0.1, method=method,
+                      stage='rho_sweep', metrics={'settling_time': settling_time + ρ, 'iet_mean': ρ})
+  store.write_scenario('scenario-1', op={})
+  store.write_scenario('scenario-1', rho_sweep={'method': 'periodic', 'theta': 1., 'lam': 0.1,
+                                                'rho': [0.1, 0.3]})
+
+  jobs = simu.stored_figures(store, 'scenario-1', str(tmp_path))
+  data = next(job.kwargs for job in jobs if 'rho_variation' in job.name)
+  np.testing.assert_allclose(data['data_1']['x'], [0.1, 0.3])
+  np.testing.assert_allclose(data['data_1']['y'], [4.1, 4.3])
+  np.testing.assert_allclose(data['data_2']['y'], [0.1, 0.3])
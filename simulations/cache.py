@@ -0,0 +1,317 @@
+import io
+import os
+import json
+import time
+import pickle
+import hashlib
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+
+
+def to_blob(matrix):
+  """
+  Serializes a matrix to bytes in the .npy format.
+
+  Parameters:
+                  matrix (array): Matrix to serialize, or None.
+
+  Returns:
+                  bytes: Serialized matrix, or None.
+  """
+  if matrix is None:
+    return None
+  buffer = io.BytesIO()
+  np.save(buffer, np.asarray(matrix), allow_pickle=False)
+  return buffer.getvalue()
+
+
+def from_blob(blob):
+  """
+  Deserializes a matrix stored by `to_blob`.
+
+  Parameters:
+                  blob (bytes): Serialized matrix, or None.
+
+  Returns:
+                  array: Deserialized matrix, or None.
+  """
+  if blob is None:
+    return None
+  return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+def update_digest(digest, value):
+  """
+  Feeds a nested structure of arrays, sequences, dictionaries, objects and scalars to a hash.
+
+  Objects are hashed by their attributes and functions by their qualified name, so the digest
+  does not depend on memory addresses and is the same in every process.
+  """
+  if isinstance(value, dict):
+    for key in sorted(value, key=repr):
+      digest.update(repr(key).encode())
+      update_digest(digest, value[key])
+  elif isinstance(value, (list, tuple)):
+    digest.update(f'{type(value).__name__}{len(value)}'.encode())
+    for item in value:
+      update_digest(digest, item)
+  elif isinstance(value, np.ndarray) and value.dtype != object:
+    array = np.ascontiguousarray(value)
+    digest.update(f'{array.dtype}{array.shape}'.encode())
+    digest.update(array.tobytes())
+  elif isinstance(value, np.ndarray):
+    update_digest(digest, value.tolist())
+  elif callable(value) and hasattr(value, '__qualname__'):
+    digest.update(f'{value.__module__}.{value.__qualname__}'.encode())
+  elif hasattr(value, '__dict__'):
+    digest.update(type(value).__qualname__.encode())
+    update_digest(digest, vars(value))
+  else:
+    digest.update(repr(value).encode())
+
+
+def source_version(*directories):
+  """
+  Calculates a version of the code from the Python sources of some directories.
+
+  Parameters:
+                  *directories (str): Directories whose .py files are hashed, not recursively.
+
+  Returns:
+                  str: Hexadecimal SHA-256 digest of the file names and contents.
+  """
+  digest = hashlib.sha256()
+  for directory in directories:
+    for file_name in sorted(os.listdir(directory)):
+      if file_name.endswith('.py'):
+        digest.update(file_name.encode())
+        with open(os.path.join(directory, file_name), 'rb') as file:
+          digest.update(file.read())
+  return digest.hexdigest()
+
+
+class StageCache:
+  """
+  Class to represent a persistent, content-addressed cache of stage results.
+
+  Each result is pickled to its own file, named after a hash of the inputs of the stage and
+  of the version of the code, and written atomically, so an interrupted run leaves only
+  complete entries and several processes can share the cache. Entries are never evicted:
+  delete the directory to reclaim the space.
+
+  Parameters:
+                  path (str): Directory of the cache.
+                  version (str): Version of the code, part of every key (see `source_version`).
+  """
+
+  MISSING = object()
+
+  def __init__(self, path, version=''):
+    self.path = path
+    self.version = version
+    os.makedirs(path, exist_ok=True)
+
+  def key(self, *inputs):
+    """
+    Calculates the key of a result from its inputs.
+
+    Parameters:
+                    *inputs: Inputs of the result (see `update_digest`).
+
+    Returns:
+                    str: Hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256(self.version.encode())
+    update_digest(digest, inputs)
+    return digest.hexdigest()
+
+  def file_name(self, key):
+    return os.path.join(self.path, key[:2], key + '.pkl')
+
+  def __contains__(self, key):
+    return os.path.exists(self.file_name(key))
+
+  def get(self, key, default=MISSING):
+    """
+    Looks up a result.
+
+    Parameters:
+                    key (str): Key of the result.
+                    default: Value returned if the result is not cached.
+
+    Returns:
+                    Result, or the default value.
+    """
+    try:
+      with open(self.file_name(key), 'rb') as file:
+        return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return default
+
+  def put(self, key, result):
+    """
+    Stores a result.
+
+    Parameters:
+                    key (str): Key of the result.
+                    result: Picklable result.
+    """
+    file_name = self.file_name(key)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    temporary = f'{file_name}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+      pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, file_name)
+
+
+# Solver settings that change how a design problem is solved, but not its result. They are left
+# out of the design keys, so serial and parallel runs share the entries.
+EXECUTION_OPTIONS = frozenset({'verbose', 'MSK_IPAR_NUM_THREADS', 'threads', 'num_threads'})
+
+
+def design_settings(solver_kwargs):
+  """
+  Removes the execution-only options (see `EXECUTION_OPTIONS`) from nested solver settings.
+
+  Parameters:
+                  solver_kwargs (dict): Settings passed to the solver, or None.
+
+  Returns:
+                  dict: Settings that affect the design result. Dictionaries left empty are removed.
+  """
+  settings = {}
+  for name, value in (solver_kwargs or {}).items():
+    if name in EXECUTION_OPTIONS:
+      continue
+    if isinstance(value, dict):
+      value = design_settings(value)
+      if not value:
+        continue
+    settings[name] = value
+  return settings
+
+
+class DesignCache:
+  """
+  Class to represent a persistent, content-addressed cache of ETM design results.
+
+  Entries are keyed by a hash of A, B, ρ, the solver name and the solver settings that affect
+  the result (see `design_settings`), and hold
+  K, Ξ, Ψ, the problem status and the solve time. The cache is an SQLite database, so it can
+  be shared by several processes, and the least recently used entries are evicted when the
+  stored size exceeds the limit.
+
+  Parameters:
+                  path (str): Path of the database file.
+                  max_bytes (int): Maximum size of the stored matrices, in bytes.
+  """
+
+  def __init__(self, path, max_bytes=64 * 1024 ** 2):
+    self.path = path
+    self.max_bytes = max_bytes
+
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+
+    with closing(self.connect()) as connection, connection:
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute(
+          'CREATE TABLE IF NOT EXISTS designs ('
+          'key TEXT PRIMARY KEY, K BLOB, Ξ BLOB, Ψ BLOB, status TEXT, '
+          'solve_time REAL, size INTEGER, last_access REAL)')
+      connection.execute(
+          'CREATE INDEX IF NOT EXISTS designs_last_access ON designs (last_access)')
+
+  def connect(self):
+    """
+    Opens a connection to the database in autocommit mode.
+    """
+    return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+  def key(self, Asys, Bsys, ρ, solver, solver_kwargs=None):
+    """
+    Calculates the key of a design problem.
+
+    Parameters:
+                    Asys (array): State matrix of the linearized system.
+                    Bsys (array): Input matrix of the control input.
+                    ρ (float): Weight between Ξ̃ and Ψ̃ in the objective.
+                    solver (str): cvxpy solver name.
+                    solver_kwargs (dict): Additional settings passed to the solver. The
+                                          execution-only options are ignored.
+
+    Returns:
+                    str: Hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    for matrix in (Asys, Bsys):
+      matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+      digest.update(str(matrix.shape).encode())
+      digest.update(matrix.tobytes())
+    digest.update(np.float64(ρ).tobytes())
+    digest.update(str(solver).encode())
+    digest.update(json.dumps(design_settings(solver_kwargs), sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+  def get(self, key):
+    """
+    Looks up a design result and marks it as recently used.
+
+    Parameters:
+                    key (str): Key of the design problem.
+
+    Returns:
+                    dict: Entry with K, Ξ, Ψ, status and solve_time, or None if not cached.
+    """
+    with closing(self.connect()) as connection:
+      row = connection.execute(
+          'SELECT K, Ξ, Ψ, status, solve_time FROM designs WHERE key = ?',
+          (key,)).fetchone()
+      if row is None:
+        return None
+      connection.execute(
+          'UPDATE designs SET last_access = ? WHERE key = ?', (time.time(), key))
+
+    K, Ξ, Ψ, status, solve_time = row
+    return {'K': from_blob(K), 'Ξ': from_blob(Ξ), 'Ψ': from_blob(Ψ),
+            'status': status, 'solve_time': solve_time}
+
+  def put(self, key, K, Ξ, Ψ, status, solve_time):
+    """
+    Stores a design result, evicting the least recently used entries if needed.
+
+    Parameters:
+                    key (str): Key of the design problem.
+                    K (array): State feedback gain, or None.
+                    Ξ (array): Ξ matrix, or None.
+                    Ψ (array): Ψ matrix, or None.
+                    status (str): Status of the optimization problem.
+                    solve_time (float): Solver time, in seconds.
+    """
+    blobs = [to_blob(matrix) for matrix in (K, Ξ, Ψ)]
+    size = sum(len(blob) for blob in blobs if blob is not None)
+
+    with closing(self.connect()) as connection:
+      connection.execute('BEGIN IMMEDIATE')
+      try:
+        connection.execute(
+            'INSERT OR REPLACE INTO designs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, *blobs, status, solve_time, size, time.time()))
+
+        total, = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM designs').fetchone()
+        for old_key, old_size in connection.execute(
+                'SELECT key, size FROM designs WHERE key != ? ORDER BY last_access',
+                (key,)).fetchall():
+          if total <= self.max_bytes:
+            break
+          connection.execute('DELETE FROM designs WHERE key = ?', (old_key,))
+          total -= old_size
+
+        connection.execute('COMMIT')
+      except BaseException:
+        connection.execute('ROLLBACK')
+        raise
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import converters
+
+# Scenario 2 of buck/scenarios.json (unstable operating point with a constant CPL)
+BUCK_CIRCUIT = {
+    'input_voltage': 48,
+    'inductor_winding_resistance': 0.1,
+    'constant_resistance_load': 20,
+    'inductance': 1e-3,
+    'capacitance': 2.2e-3,
+}
+BUCK_DESIRED = {'capacitor_voltage': 28, 'pcpl_power': 250}
+
+# ETM design of the linearized buck converter of scenario 2 for ρ = 0.5, so the tests do not
+# depend on an LMI solver
+BUCK_DESIGN = (
+    np.array([[-0.00754163808623398, -0.00405852495569888]]),
+    np.array([[1.3816960685588722e+10, 7.5439435573492079e+09],
+              [7.5439435573492069e+09, 2.5727699792019745e+10]]),
+    np.array([[1.3960708548117578e+06, -4.5629416447402008e+01],
+              [-4.5629416447402015e+01, 1.3989397097299672e+06]]),
+)
+
+
+@pytest.fixture
+def buck_params():
+  return converters.get_converter('buck').scenario_params(BUCK_CIRCUIT, BUCK_DESIRED)
+
+
+@pytest.fixture
+def buck_linearized(buck_params):
+  return converters.LinearizedConverter(converters.get_converter('buck'), 'buck_linearized',
+                                        buck_params)
+
+
+@pytest.fixture
+def buck_design():
+  return BUCK_DESIGN
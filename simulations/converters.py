@@ -0,0 +1,557 @@
+import abc
+import functools
+import importlib.util
+
+import numpy as np
+import control as ct
+
+NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
+
+MODEL_KINDS = ('nonlinear', 'shifted_nonlinear', 'linearized')
+
+
+def stack(*rows):
+  """
+  Stacks the rows of a vector or a matrix whose entries may be scalars or arrays of different
+  but broadcastable shapes.
+
+  Parameters:
+                  *rows: Entries of a vector, or tuples of entries of a matrix.
+
+  Returns:
+                  array: Array of shape (2,) + shape or (2, 2) + shape, where shape is the
+                         broadcast shape of the entries.
+  """
+  if isinstance(rows[0], tuple):
+    return np.stack([stack(*row) for row in rows])
+  # Scalar entries, as in the single-trajectory engines, skip the broadcasting
+  if all(np.ndim(row) == 0 for row in rows):
+    return np.array(rows, dtype=float)
+  return np.stack(np.broadcast_arrays(*rows))
+
+
+class Converter(abc.ABC):
+  """
+  Class to represent a converter topology with a constant power load (CPL).
+
+  A topology is defined once, by its averaged dynamics f(iL, vC, d, Pcpl), their Jacobians and
+  its operating point, and the non-linear, shifted non-linear and linearized models are built
+  from it (see `create_models`). The dynamics and the Jacobians are plain arithmetic on their
+  arguments, so the same functions evaluate one point, a batch of lanes stacked along the last
+  axis, or run under Numba in the compiled closed-loop kernels.
+
+  Subclasses define `name`, `title` and `PARAMETERS`, and implement the abstract `dynamics`,
+  `jacobian`, `input_jacobian`, `create_params` and `scenario_params`, so an incomplete
+  topology fails when it is instantiated.
+  """
+
+  name = None
+  title = None
+  PARAMETERS = ()
+
+  def coefficients(self, params):
+    """
+    Returns the circuit parameters in the order of `PARAMETERS`, as expected by `dynamics`.
+
+    Parameters:
+                    params (dict): Dictionary of system parameters.
+
+    Returns:
+                    tuple: Circuit parameters.
+    """
+    return tuple(params[name] for name in self.PARAMETERS)
+
+  @staticmethod
+  @abc.abstractmethod
+  def dynamics(iL, vC, d, Pcpl, c):
+    """
+    Averaged dynamics of the converter.
+
+    Parameters:
+                    iL, vC (float or array): States.
+                    d, Pcpl (float or array): Duty cycle and power of the CPL.
+                    c (tuple): Circuit parameters (see `coefficients`).
+
+    Returns:
+                    tuple: Derivatives (iL', vC').
+    """
+
+  @staticmethod
+  @abc.abstractmethod
+  def jacobian(iL, vC, d, Pcpl, c):
+    """
+    Jacobian ∂f/∂x of the dynamics, with the arguments of `dynamics`.
+
+    Returns:
+                    tuple: Rows of the 2x2 matrix.
+    """
+
+  @staticmethod
+  @abc.abstractmethod
+  def input_jacobian(iL, vC, d, Pcpl, c):
+    """
+    Jacobian ∂f/∂u of the dynamics with respect to u = (d, Pcpl), with the arguments of
+    `dynamics`.
+
+    Returns:
+                    tuple: Rows of the 2x2 matrix.
+    """
+
+  def rhs(self, x, u, params):
+    """
+    Evaluates the dynamics on stacked states and inputs.
+
+    Parameters:
+                    x (array): States, shape (2,) or (2, N).
+                    u (array): Inputs (d, Pcpl), shape (2,) or (2, N).
+                    params (dict): Dictionary of system parameters.
+
+    Returns:
+                    array: Derivatives of the states, with the shape of x.
+    """
+    return stack(*self.dynamics(x[0], x[1], u[0], u[1], self.coefficients(params)))
+
+  def operating_values(self, params):
+    """
+    Returns the states and the inputs at the operating point.
+
+    Parameters:
+                    params (dict): Dictionary of system parameters, with the operating point.
+
+    Returns:
+                    tuple: iL, vC, d and Pcpl at the operating point.
+    """
+    op = params['op']
+    return op['iL'], op['vC'], op['d'], op['Pcpl']
+
+  def linearize(self, params):
+    """
+    Linearizes the dynamics at the operating point.
+
+    Parameters:
+                    params (dict): Dictionary of system parameters, with the operating point.
+
+    Returns:
+                    tuple: Matrices A (2x2) and B (2x2, inputs δd and δPcpl).
+    """
+    values = self.operating_values(params) + (self.coefficients(params),)
+    return stack(*self.jacobian(*values)), stack(*self.input_jacobian(*values))
+
+  @abc.abstractmethod
+  def create_params(self, *args, **kwargs):
+    """
+    Create a dictionary of parameters for the system model, with the operating point.
+    """
+
+  @abc.abstractmethod
+  def scenario_params(self, circuit_params, desired_values):
+    """
+    Create the parameters of a scenario of the JSON file.
+
+    Parameters:
+                    circuit_params (dict): 'circuit_params' of the scenario.
+                    desired_values (dict): 'desired_values' of the scenario, with the
+                                           'capacitor_voltage' and the 'pcpl_power'.
+
+    Returns:
+                    dict: Dictionary of system parameters (see `create_params`).
+    """
+
+
+class Buck(Converter):
+  """
+  Class to represent the buck converter with a CPL in parallel with a resistive load.
+  """
+
+  name = 'buck'
+  title = 'Buck'
+  PARAMETERS = ('Vin', 'rL', 'rC', 'L', 'C')
+
+  @staticmethod
+  def dynamics(iL, vC, d, Pcpl, c):
+    V_IN, RL, RC, L, C = c[0], c[1], c[2], c[3], c[4]
+    return ((V_IN / L) * d - (RL / L) * iL - vC / L,
+            iL / C - vC / (C * RC) - Pcpl / (C * vC))
+
+  @staticmethod
+  def jacobian(iL, vC, d, Pcpl, c):
+    RL, RC, L, C = c[1], c[2], c[3], c[4]
+    return ((-RL / L, -1. / L),
+            (1. / C, -1. / (C * RC) + Pcpl / (C * vC ** 2)))
+
+  @staticmethod
+  def input_jacobian(iL, vC, d, Pcpl, c):
+    V_IN, L, C = c[0], c[3], c[4]
+    return ((V_IN / L, 0.),
+            (0., -1. / (C * vC)))
+
+  def create_params(self, V_IN, RL, RC, L, C, PCPL_OP, VC_OP):
+    """
+    Create a dictionary of parameters for the system model.
+
+    Parameters:
+                    V_IN (float): Input voltage.
+                    RL (float): Resistance of the inductor.
+                    RC (float): Resistance of the load.
+                    L (float): Inductance.
+                    C (float): Capacitance.
+                    PCPL_OP (float): Operating power of the CPL.
+                    VC_OP (float): Operating voltage of the capacitor.
+
+    Returns:
+                    dict: Dictionary of system parameters.
+    """
+    IL_OP = (VC_OP / RC) + PCPL_OP / VC_OP
+    D_OP = (RL * IL_OP) / V_IN + VC_OP / V_IN
+
+    return {
+        "Vin": V_IN,
+        "rL": RL,
+        "rC": RC,
+        "L": L,
+        "C": C,
+        "op": {"Pcpl": PCPL_OP, "vC": VC_OP, "iL": IL_OP, "d": D_OP},
+    }
+
+  def scenario_params(self, circuit_params, desired_values):
+    return self.create_params(
+        V_IN=circuit_params['input_voltage'],
+        RC=circuit_params['constant_resistance_load'],
+        RL=circuit_params['inductor_winding_resistance'],
+        L=circuit_params['inductance'],
+        C=circuit_params['capacitance'],
+        PCPL_OP=desired_values['pcpl_power'],
+        VC_OP=desired_values['capacitor_voltage'])
+
+
+class Boost(Converter):
+  """
+  Class to represent the boost converter with a CPL in parallel with a resistive load.
+  """
+
+  name = 'boost'
+  title = 'Boost'
+  PARAMETERS = ('Vin', 'R', 'L', 'C')
+
+  @staticmethod
+  def dynamics(iL, vC, d, Pcpl, c):
+    V_IN, R, L, C = c[0], c[1], c[2], c[3]
+    return (-((1. - d) / L) * vC + V_IN / L,
+            ((1. - d) * iL) / C - vC / (R * C) - Pcpl / (C * vC))
+
+  @staticmethod
+  def jacobian(iL, vC, d, Pcpl, c):
+    R, L, C = c[1], c[2], c[3]
+    return ((0., -(1. - d) / L),
+            ((1. - d) / C, -1. / (R * C) + Pcpl / (C * vC ** 2)))
+
+  @staticmethod
+  def input_jacobian(iL, vC, d, Pcpl, c):
+    L, C = c[2], c[3]
+    return ((vC / L, 0.),
+            (-iL / C, -1. / (C * vC)))
+
+  def create_params(self, V_IN, R, L, C, PCPL_OP, VC_OP):
+    """
+    Create a dictionary of parameters for the system model.
+
+    Parameters:
+                    V_IN (float): Input voltage.
+                    R (float): Resistance of the load.
+                    L (float): Inductance.
+                    C (float): Capacitance.
+                    PCPL_OP (float): Operating power of the CPL.
+                    VC_OP (float): Operating voltage of the capacitor, above V_IN.
+
+    Returns:
+                    dict: Dictionary of system parameters.
+    """
+    IL_OP = (VC_OP ** 2 + R * PCPL_OP) / (R * V_IN)
+    D_OP = 1 - V_IN / VC_OP
+
+    return {
+        "Vin": V_IN,
+        "R": R,
+        "L": L,
+        "C": C,
+        "op": {"Pcpl": PCPL_OP, "vC": VC_OP, "iL": IL_OP, "d": D_OP},
+    }
+
+  def scenario_params(self, circuit_params, desired_values):
+    return self.create_params(
+        V_IN=circuit_params['input_voltage'],
+        R=circuit_params['constant_resistance_load'],
+        L=circuit_params['inductance'],
+        C=circuit_params['capacitance'],
+        PCPL_OP=desired_values['pcpl_power'],
+        VC_OP=desired_values['capacitor_voltage'])
+
+
+CONVERTERS = {converter.name: converter for converter in (Buck(), Boost())}
+
+
+def get_converter(name):
+  """
+  Returns a registered converter topology.
+
+  Parameters:
+                  name (str): Name of the topology (see `CONVERTERS`).
+
+  Returns:
+                  Converter: The topology.
+  """
+  try:
+    return CONVERTERS[name]
+  except KeyError:
+    raise ValueError(f'Unknown converter: {name} (available: {", ".join(CONVERTERS)})') \
+        from None
+
+
+class NonlinearConverter:
+  """
+  Class to create and manage the non-linear model of a converter topology.
+
+  Parameters:
+                  converter (Converter): Topology.
+                  name (str): Name of the system.
+  """
+
+  def __init__(self, converter, name):
+    self.converter = converter
+    self.name = name
+    self.inputs = ('D', 'P_CPL')
+    self.outputs = ('iL', 'vC')
+    self.states = ('iL', 'vC')
+    self.system = ct.NonlinearIOSystem(
+        self.update, self.output, name=self.name,
+        inputs=self.inputs, outputs=self.outputs, states=self.states
+    )
+
+  def update(self, t, x, u, params):
+    """
+    Update function of the state-space representation.
+
+    Parameters:
+                    t (float): Time.
+                    x (array): States, shape (2,) or (2, N).
+                    u (array): Inputs (D, P_CPL), shape (2,) or (2, N).
+                    params (dict): Dictionary of system parameters.
+
+    Returns:
+                    array: Derivatives of the states.
+    """
+    return self.converter.rhs(x, u, params)
+
+  def jacobian(self, t, x, u, params):
+    """
+    Jacobian ∂f/∂x of the update function.
+
+    Returns:
+                    array: 2x2 Jacobian matrix.
+    """
+    return stack(*self.converter.jacobian(
+        x[0], x[1], u[0], u[1], self.converter.coefficients(params)))
+
+  def output(self, t, x, u, params):
+    """
+    Output function of the state-space representation: the states.
+    """
+    return x[0:2]
+
+
+@functools.lru_cache(maxsize=None)
+def get_shifted_update(dynamics):
+  """
+  Builds the flat update function of the shifted model of a topology.
+
+  The function is built once per topology, so the closed-loop kernels compiled for it are
+  reused. When Numba is installed the dynamics are compiled, so the kernels can call them.
+
+  Parameters:
+                  dynamics (function): `Converter.dynamics` of the topology.
+
+  Returns:
+                  function: f(δiL, δvC, δd, δPcpl, c), with the coefficients c of
+                            `ShiftedNonlinearConverter.compile_update`.
+  """
+  if NUMBA_AVAILABLE:
+    from numba import njit
+    dynamics = njit(dynamics)
+
+  def shifted_update(δIL, δVC, δD, δP_CPL, c):
+    DIL, DVC = dynamics(c[0] + δIL, c[1] + δVC, c[2] + δD, c[3] + δP_CPL, c[6:])
+    return DIL - c[4], DVC - c[5]
+
+  return shifted_update
+
+
+class ShiftedNonlinearConverter:
+  """
+  Class to create and manage the non-linear model of a converter topology shifted to its
+  operating point.
+
+  The states and the inputs are deviations from the operating point, and the derivative at
+  the operating point is subtracted, so the origin is an equilibrium to machine precision.
+
+  Parameters:
+                  converter (Converter): Topology.
+                  name (str): Name of the system.
+  """
+
+  def __init__(self, converter, name):
+    self.converter = converter
+    self.name = name
+    self.inputs = ('δd', 'δPcpl')
+    self.outputs = ('δiL', 'δvC')
+    self.states = ('δiL', 'δvC')
+    self.system = ct.NonlinearIOSystem(
+        self.update, self.output, name=self.name,
+        inputs=self.inputs, outputs=self.outputs, states=self.states
+    )
+
+  def update(self, t, x, u, params):
+    """
+    Update function of the state-space representation.
+
+    Parameters:
+                    t (float): Time.
+                    x (array): State deviations, shape (2,) or (2, N).
+                    u (array): Input deviations (δd, δPcpl), shape (2,) or (2, N).
+                    params (dict): Dictionary of system parameters, with the operating point.
+
+    Returns:
+                    array: Derivatives of the state deviations.
+    """
+    IL, VC, D, P_CPL = self.converter.operating_values(params)
+    c = self.converter.coefficients(params)
+    DIL, DVC = self.converter.dynamics(IL + x[0], VC + x[1], D + u[0], P_CPL + u[1], c)
+    DIL_OP, DVC_OP = self.converter.dynamics(IL, VC, D, P_CPL, c)
+    return stack(DIL - DIL_OP, DVC - DVC_OP)
+
+  def jacobian(self, t, x, u, params):
+    """
+    Jacobian ∂f/∂x of the update function.
+
+    Returns:
+                    array: 2x2 Jacobian matrix.
+    """
+    IL, VC, D, P_CPL = self.converter.operating_values(params)
+    return stack(*self.converter.jacobian(IL + x[0], VC + x[1], D + u[0], P_CPL + u[1],
+                                          self.converter.coefficients(params)))
+
+  def compile_update(self, params):
+    """
+    Returns the update function in flat form and its coefficients.
+
+    Parameters:
+                    params (dict): Dictionary of system parameters, with the operating point.
+
+    Returns:
+                    tuple: Function of `get_shifted_update` and the vector of coefficients: the
+                           operating point (iL, vC, d, Pcpl), the derivative there and the
+                           circuit parameters.
+    """
+    values = self.converter.operating_values(params)
+    c = self.converter.coefficients(params)
+    return (get_shifted_update(self.converter.dynamics),
+            np.array(values + self.converter.dynamics(*values, c) + c, dtype=float))
+
+  def output(self, t, x, u, params):
+    """
+    Output function of the state-space representation: the states.
+    """
+    return x[0:2]
+
+
+class LinearizedConverter:
+  """
+  Class to create and manage the model of a converter topology linearized at its operating
+  point.
+
+  Parameters:
+                  converter (Converter): Topology.
+                  name (str): Name of the system.
+                  params (dict): Dictionary of system parameters, with the operating point.
+  """
+
+  def __init__(self, converter, name, params):
+    self.converter = converter
+    self.name = name
+    self.params = params
+    self.system = self.create_system()
+
+  def create_system(self):
+    """
+    Creates the linearized state-space model.
+
+    Returns:
+                    system: Linear system with inputs δd and δPcpl and outputs δiL and δvC.
+    """
+    A, B = self.converter.linearize(self.params)
+    system = ct.ss2io(ct.ss(A, B, np.eye(2), np.zeros((2, 2))), name=self.name, inputs=(
+        'δd', 'δPcpl'), outputs=('δiL', 'δvC'), states=('δiL', 'δvC'))
+    return system
+
+  @staticmethod
+  def flat_update(δIL, δVC, δD, δP_CPL, c):
+    """
+    Update function of the linearized model in flat form, operating on scalars.
+
+    Parameters:
+                    δIL, δVC (float): States.
+                    δD, δP_CPL (float): Inputs.
+                    c (array): Elements of A and B, row by row.
+
+    Returns:
+                    tuple: Derivatives (δiL', δvC').
+    """
+    return (c[0] * δIL + c[1] * δVC + c[4] * δD + c[5] * δP_CPL,
+            c[2] * δIL + c[3] * δVC + c[6] * δD + c[7] * δP_CPL)
+
+  def compile_update(self, params=None):
+    """
+    Returns the update function in flat form and its coefficients.
+
+    Parameters:
+                    params (dict): Unused, the parameters are in the matrices of the system.
+
+    Returns:
+                    tuple: Function `flat_update` and vector of coefficients.
+    """
+    c = np.concatenate((np.ravel(self.system.A), np.ravel(self.system.B))).astype(float)
+    return self.flat_update, c
+
+
+def model_names(converter):
+  """
+  Returns the names of the models of a topology.
+
+  Parameters:
+                  converter (str): Name of the topology.
+
+  Returns:
+                  tuple: Names of the non-linear, shifted non-linear and linearized models, such
+                         as 'buck_linearized'.
+  """
+  return tuple(f'{converter}_{kind}' for kind in MODEL_KINDS)
+
+
+def create_models(converter, params):
+  """
+  Create the models of a topology.
+
+  Parameters:
+                  converter (str): Name of the topology (see `CONVERTERS`).
+                  params (dict): Dictionary of system parameters, with the operating point.
+
+  Returns:
+                  dict: Non-linear, shifted non-linear and linearized models, by name (see
+                        `model_names`).
+  """
+  topology = get_converter(converter)
+  nonlinear, shifted_nonlinear, linearized = model_names(converter)
+  return {
+      nonlinear: NonlinearConverter(topology, nonlinear),
+      shifted_nonlinear: ShiftedNonlinearConverter(topology, shifted_nonlinear),
+      linearized: LinearizedConverter(topology, linearized, params),
+  }
@@ -0,0 +1,156 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from batch import batch_closed_loop_simulate
+from etm import DynamicETM
+from sweep import SweepExecutor
+
+DISTRIBUTIONS = ('uniform', 'normal', 'lhs')
+SUMMARY_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def sample_initial_factors(count, iL=(0.5, 1.5), vC=(0.5, 1.5), distribution='uniform',
+                           seed=None):
+  """
+  Draws initial conditions around the operating point, as factors of the operating point
+  like the `x0_factor` of the simulators.
+
+  Parameters:
+                  count (int): Number of initial conditions.
+                  iL (tuple): Range (low, high) of the factor of iL, or (mean, standard deviation)
+                              for the normal distribution.
+                  vC (tuple): Range of the factor of vC, as for iL.
+                  distribution (str): 'uniform', 'normal', or 'lhs' for a Latin hypercube over
+                                      the ranges, which covers them more evenly than independent
+                                      uniform draws.
+                  seed (int): Seed of the random generator.
+
+  Returns:
+                  array: Factors of shape (count, 2), columns iL and vC.
+  """
+  if distribution not in DISTRIBUTIONS:
+    raise ValueError(f'Unknown distribution: {distribution}')
+
+  rng = np.random.default_rng(seed)
+  first, second = np.array([iL, vC], dtype=float).T
+
+  if distribution == 'normal':
+    return rng.normal(first, second, size=(count, 2))
+  if distribution == 'lhs':
+    strata = np.column_stack([rng.permutation(count) for _ in range(2)])
+    return first + (strata + rng.random((count, 2))) / count * (second - first)
+  return rng.uniform(first, second, size=(count, 2))
+
+
+def ensemble_chunk(x0_factors, converter, etm, K, params, end_time,
+                   perturbation_signal_data=None, step=1e-5, stop=None, band=0.02):
+  """
+  Simulates a chunk of initial conditions as one batch.
+
+  Returns:
+                  list: Tuples (metrics, inter-event times, event times) for each initial condition.
+  """
+  x0_factors = np.asarray(x0_factors, dtype=float)
+  N = len(x0_factors)
+  dynamic = isinstance(etm, DynamicETM)
+
+  t, y, iet, et = batch_closed_loop_simulate(
+      converter, np.tile(np.ravel(K), (N, 1)), etm.Ψ, etm.Ξ, params, end_time,
+      perturbation_signal_data, x0_factors, step,
+      θ=etm.θ if dynamic else None, λ=etm.λ if dynamic else None, stop=stop)
+
+  lanes = metrics.closed_loop_metrics(t, y, iet, params['op']['vC'], band)
+  return [({name: values[lane] for name, values in lanes.items()}, iet[lane], et[lane])
+          for lane in range(N)]
+
+
+def ensemble_closed_loop_simulate(converter, etm, K, params, end_time, x0_factors,
+                                  perturbation_signal_data=None, step=1e-5, stop=None,
+                                  band=0.02, batch_size=256, workers=1):
+  """
+  Simulate the closed loop from many initial conditions.
+
+  The initial conditions are split into batches simulated in lockstep by
+  `batch.batch_closed_loop_simulate`, each lane with its own event bookkeeping, and the
+  batches are spread over a process pool. As in the batched simulation, the states are
+  advanced by a fixed-step RK4 integrator and the events are resolved to the step. Only the
+  metrics and the events of each lane are kept, so the memory depends on the batch size and
+  not on the size of the ensemble.
+
+  Parameters:
+                  converter: Instance of the converter system (shifted non-linear or linearized).
+                  etm: Instance of the event-triggered mechanism (ETM).
+                  K (array): State feedback gain.
+                  params (dict): Dictionary of system parameters.
+                  end_time (float): End time of simulation.
+                  x0_factors (array): Factors of the initial states, shape (N, 2) (see
+                                      `sample_initial_factors`).
+                  perturbation_signal_data (list): List of tuples representing perturbation signal data.
+                  step (float): Time step for simulation.
+                  stop (SteadyStateStop): Criterion to end each batch once all its lanes have settled.
+                  band (float): Relative half-width of the settling band.
+                  batch_size (int): Number of lanes simulated together.
+                  workers (int): Number of worker processes. If None, the number of CPUs is used.
+
+  Returns:
+                  tuple: A tuple containing:
+                                  - lanes (DataFrame): One row per initial condition, with its factors
+                                    (iL_factor, vC_factor), its number of transmissions and the metrics
+                                    of `metrics.closed_loop_metrics`.
+                                  - inter_event_times (array): Inter-event times of all lanes, pooled.
+  """
+  x0_factors = np.asarray(x0_factors, dtype=float).reshape(-1, 2)
+
+  results = SweepExecutor(workers, batch_size).map_chunks(
+      functools.partial(ensemble_chunk, converter=converter, etm=etm, K=K, params=params,
+                        end_time=end_time, perturbation_signal_data=perturbation_signal_data,
+                        step=step, stop=stop, band=band),
+      x0_factors)
+
+  lanes = pd.DataFrame(metrics.stack_metrics([row for row, _, _ in results]))
+  lanes.insert(0, 'iL_factor', x0_factors[:, 0])
+  lanes.insert(1, 'vC_factor', x0_factors[:, 1])
+  lanes.insert(2, 'transmissions', [len(et) for _, _, et in results])
+
+  inter_event_times = np.concatenate([iet[1:] for _, iet, _ in results]) \
+      if results else np.empty(0)
+
+  return lanes, inter_event_times
+
+
+def summarize_ensemble(lanes, inter_event_times, percentiles=SUMMARY_PERCENTILES):
+  """
+  Summarizes the distributions of an ensemble.
+
+  Parameters:
+                  lanes (DataFrame): Lanes of `ensemble_closed_loop_simulate`.
+                  inter_event_times (array): Pooled inter-event times.
+                  percentiles (tuple): Percentiles to calculate, between 0 and 100.
+
+  Returns:
+                  DataFrame: One row per quantity ('iet', the pooled inter-event times, and the
+                             per-lane 'iet_mean', 'settling_time' and 'transmissions'), with the
+                             count, mean, standard deviation, minimum, percentiles and maximum.
+  """
+  samples = {
+      'iet': np.asarray(inter_event_times, dtype=float),
+      'iet_mean': lanes['iet_mean'].to_numpy(dtype=float),
+      'settling_time': lanes['settling_time'].to_numpy(dtype=float),
+      'transmissions': lanes['transmissions'].to_numpy(dtype=float),
+  }
+
+  rows = []
+  for name, values in samples.items():
+    values = values[np.isfinite(values)]
+    row = {'quantity': name, 'count': len(values)}
+    if len(values):
+      row.update({'mean': values.mean(), 'std': values.std(), 'min': values.min()})
+      row.update({f'p{percentile:g}': value for percentile, value in
+                  zip(percentiles, np.percentile(values, percentiles))})
+      row['max'] = values.max()
+    rows += [row]
+
+  return pd.DataFrame(rows)
@@ -1,76 +1,683 @@
+import copy
+import functools
+import importlib.util
+
 import numpy as np
-import cvxpy as cp
 import control as ct
+from scipy.integrate import solve_ivp
+from scipy.linalg import expm
+from scipy.optimize import brentq
+
+import instrument
+from utils import generate_square_signal, make_square_signal
 
-from utils import generate_square_signal
+IMPLICIT_METHODS = ('Radau', 'BDF', 'LSODA')
 
+# Name of the default cvxpy solver (cvxpy.MOSEK). cvxpy and Numba are imported only when a
+# design problem is built or a kernel is compiled, so the processes that only simulate do not
+# load them.
+DEFAULT_SOLVER = 'MOSEK'
+NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
 
-def get_etm_parameters(Asys, Bsys, ρ=0.5):
-  A = cp.Parameter((2, 2), value=Asys)
-  BU = cp.Parameter((2, 1), value=Bsys)
-  I = cp.Parameter((2, 2), name='I', value=np.identity(2))
 
-  Ξ_TIL = cp.Variable((2, 2), name='Ξ_TIL', PSD=True)
-  Ψ_TIL = cp.Variable((2, 2), name='Ψ_TIL', PSD=True)
-  X = cp.Variable((2, 2), name='X', PSD=True)
-  K_TIL = cp.Variable((1, 2), name='K_TIL')
+class ETMDesign:
+  """
+  Class to represent the reusable LMI problem for the co-design of K, Ξ and Ψ.
+
+  The problem is compiled once with ρ, A and B as DPP-compliant parameters, so later solves
+  only update their values and reuse the canonicalization. Each solve is warm-started from
+  the previous X, Ξ̃, Ψ̃ and K̃. The problem is built by the first solve, so a design whose
+  results are all found in the cache never imports cvxpy.
 
-  obj = cp.Minimize(cp.trace(ρ * Ξ_TIL + (1 - ρ) * Ψ_TIL))
+  Parameters:
+                  Asys (array): State matrix of the linearized system.
+                  Bsys (array): Input matrix of the control input.
+                  solver (str): cvxpy solver name.
+                  solver_kwargs (dict): Additional settings passed to the solver.
+  """
 
-  M11 = A @ X + BU @ K_TIL + X @ A.T + K_TIL.T @ BU.T
-  M12 = BU @ K_TIL
-  M13 = X
+  def __init__(self, Asys, Bsys, solver=DEFAULT_SOLVER, solver_kwargs=None):
+    self.solver = solver
+    self.solver_kwargs = solver_kwargs or {}
+    self.status = None
+    self.solve_time = None
+    self.Asys = np.asarray(Asys)
+    self.Bsys = np.reshape(Bsys, (2, 1))
+    self.problem = None
 
-  M21 = K_TIL.T @ BU.T
-  M22 = -Ξ_TIL
-  M23 = np.zeros(shape=(2, 2))
+  def build(self):
+    """
+    Builds the parametrized problem.
+    """
+    import cvxpy as cp
 
-  M31 = X
-  M32 = np.zeros(shape=(2, 2))
-  M33 = -Ψ_TIL
+    self.A = cp.Parameter((2, 2), name='A', value=self.Asys)
+    self.BU = cp.Parameter((2, 1), name='BU', value=self.Bsys)
+    self.ρ = cp.Parameter(name='ρ', nonneg=True, value=0.5)
 
-  M = cp.bmat([[M11, M12, M13],
-               [M21, M22, M23],
-               [M31, M32, M33]])
+    self.Ξ_TIL = cp.Variable((2, 2), name='Ξ_TIL', PSD=True)
+    self.Ψ_TIL = cp.Variable((2, 2), name='Ψ_TIL', PSD=True)
+    self.X = cp.Variable((2, 2), name='X', PSD=True)
+    self.K_TIL = cp.Variable((1, 2), name='K_TIL')
 
-  constraints = [M << 0]
-  constraints += [1e-9 * np.eye(2) <= Ξ_TIL]
-  constraints += [Ξ_TIL <= 1e9 * np.eye(2)]
-  constraints += [1e-9 * np.eye(2) <= Ψ_TIL]
-  constraints += [Ψ_TIL <= 1e9 * np.eye(2)]
+    A, BU, ρ = self.A, self.BU, self.ρ
+    Ξ_TIL, Ψ_TIL, X, K_TIL = self.Ξ_TIL, self.Ψ_TIL, self.X, self.K_TIL
 
-  prob = cp.Problem(obj, constraints)
-  prob.solve(solver=cp.MOSEK, verbose=False)
+    obj = cp.Minimize(cp.trace(ρ * Ξ_TIL + (1 - ρ) * Ψ_TIL))
 
-  K = None
-  Ξ = None
-  Ψ = None
+    M11 = A @ X + BU @ K_TIL + X @ A.T + K_TIL.T @ BU.T
+    M12 = BU @ K_TIL
+    M13 = X
+
+    M21 = K_TIL.T @ BU.T
+    M22 = -Ξ_TIL
+    M23 = np.zeros(shape=(2, 2))
+
+    M31 = X
+    M32 = np.zeros(shape=(2, 2))
+    M33 = -Ψ_TIL
+
+    M = cp.bmat([[M11, M12, M13],
+                 [M21, M22, M23],
+                 [M31, M32, M33]])
+
+    constraints = [M << 0]
+    constraints += [1e-9 * np.eye(2) <= Ξ_TIL]
+    constraints += [Ξ_TIL <= 1e9 * np.eye(2)]
+    constraints += [1e-9 * np.eye(2) <= Ψ_TIL]
+    constraints += [Ψ_TIL <= 1e9 * np.eye(2)]
+
+    self.problem = cp.Problem(obj, constraints)
+
+  def solve(self, ρ=0.5, Asys=None, Bsys=None):
+    """
+    Solves the design problem for the given parameters.
 
-  if prob.status not in ["infeasible", "unbounded"]:
-    # print("Optimal value: %s\n" % prob.value)
-    # for variable in prob.variables():
-      # if len(variable.shape) == 2:
-      #   show_matrix(variable.name(), variable.value)
-      # else:
-      #   print(variable.name(), '=', variable.value, '\n')
+    Parameters:
+                    ρ (float): Weight between Ξ̃ and Ψ̃ in the objective.
+                    Asys (array): New state matrix. If None, the current value is kept.
+                    Bsys (array): New input matrix. If None, the current value is kept.
 
+    Returns:
+                    list: [K, Ξ, Ψ], or [None, None, None] if the problem is not feasible.
+    """
+    if Asys is not None:
+      self.Asys = np.asarray(Asys)
+    if Bsys is not None:
+      self.Bsys = np.reshape(Bsys, (2, 1))
+    if self.problem is None:
+      self.build()
+
+    self.ρ.value = ρ
+    self.A.value = self.Asys
+    self.BU.value = self.Bsys
+
+    with instrument.span('design'):
+      self.problem.solve(solver=self.solver, warm_start=True,
+                         verbose=False, **self.solver_kwargs)
+    self.status = self.problem.status
+    self.solve_time = self.problem.solver_stats.solve_time
+    instrument.observe('design_canonicalization', self.problem.compilation_time)
+    instrument.observe('design_solver', self.solve_time)
+
+    K = None
+    Ξ = None
+    Ψ = None
+
+    if self.problem.status not in ["infeasible", "unbounded"]:
       # Compute the inverse of X and use it to calculate Ξ and K
-    X_INV = np.linalg.inv(X.value)
-    Ξ = X_INV @ Ξ_TIL.value @ X_INV
+      X_INV = np.linalg.inv(self.X.value)
+      Ξ = X_INV @ self.Ξ_TIL.value @ X_INV
+      K = self.K_TIL.value @ X_INV
+      Ψ = np.linalg.inv(self.Ψ_TIL.value)
+    else:
+      instrument.log.warning(f'The design problem is not feasible for ρ = {ρ:g}')
+
+    return [K, Ξ, Ψ]
 
-    _K = K_TIL @ X_INV
-    K = _K.value
 
-    # utils.show_matrix('K', K)
+def get_etm_parameters(Asys, Bsys, ρ=0.5, design=None, cache=None):
+  """
+  Solves the LMI problem to obtain the ETM design parameters.
 
-    Ψ = np.linalg.inv(Ψ_TIL.value)
+  Parameters:
+                  Asys (array): State matrix of the linearized system.
+                  Bsys (array): Input matrix of the control input.
+                  ρ (float): Weight between Ξ̃ and Ψ̃ in the objective.
+                  design (ETMDesign): Compiled design problem to reuse. If None, a new one is built.
+                  cache (DesignCache): Persistent cache of design results. If None, the problem is always solved.
 
-    # utils.show_matrix('Ξ', Ξ)
-    # utils.show_matrix('Ψ', Ψ)
-  else:
-    print('The problem is not feasible')
+  Returns:
+                  list: [K, Ξ, Ψ], or [None, None, None] if the problem is not feasible.
+  """
+  if cache is not None:
+    solver = design.solver if design is not None else DEFAULT_SOLVER
+    solver_kwargs = design.solver_kwargs if design is not None else {}
+    key = cache.key(Asys, Bsys, ρ, solver, solver_kwargs)
+    entry = cache.get(key)
+    if entry is not None:
+      return [entry['K'], entry['Ξ'], entry['Ψ']]
+
+  if design is None:
+    design = ETMDesign(Asys, Bsys)
+  result = design.solve(ρ, Asys, Bsys)
+
+  if cache is not None:
+    cache.put(key, *result, design.status, design.solve_time)
+
+  return result
+
+
+RUN_CONTEXT = 'run_context'
+
+EVENT_DTYPE = np.dtype([('t', float), ('state', float, (2,)), ('error_norm', float),
+                        ('gama', float), ('eta', float)])
+
+
+class EventRecord:
+  """
+  Class to represent one event of an event trace.
+
+  Parameters:
+                  t (float): Event time.
+                  state (array): State sent at the event.
+                  error_norm (float): Norm of the transmission error at the event.
+                  gama (float): Value of Γ at the event.
+                  eta (float): Value of the dynamic variable η at the event.
+  """
+
+  __slots__ = ('t', 'state', 'error_norm', 'gama', 'eta')
+
+  def __init__(self, t, state, error_norm, gama, eta):
+    self.t = t
+    self.state = state
+    self.error_norm = error_norm
+    self.gama = gama
+    self.eta = eta
+
+
+class EventTrace:
+  """
+  Class to represent the events of a simulation in a preallocated, growable array.
+
+  Each record holds the event time, the state sent, the norm of the transmission error, Γ and
+  η at the event. The fields are exposed as array views for vectorized analysis.
+
+  Parameters:
+                  capacity (int): Initial number of records.
+  """
+
+  __slots__ = ('records', 'count')
+
+  def __init__(self, capacity=256):
+    self.records = np.zeros(capacity, dtype=EVENT_DTYPE)
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    record = self.records[:self.count][index]
+    return EventRecord(record['t'], record['state'].copy(), record['error_norm'],
+                       record['gama'], record['eta'])
+
+  def append(self, t, state, error_norm=0., gama=np.nan, eta=0.):
+    """
+    Appends an event, doubling the capacity when the trace is full.
+
+    Parameters:
+                    t (float): Event time.
+                    state (array): State sent at the event.
+                    error_norm (float): Norm of the transmission error at the event.
+                    gama (float): Value of Γ at the event.
+                    eta (float): Value of the dynamic variable η at the event.
+    """
+    if self.count == len(self.records):
+      self.records = np.resize(self.records, 2 * len(self.records))
+    self.records[self.count] = (t, state, error_norm, gama, eta)
+    instrument.count('events')
+    self.count += 1
+
+  @property
+  def times(self):
+    return self.records['t'][:self.count]
+
+  @property
+  def last_time(self):
+    return self.records['t'][self.count - 1] if self.count else -np.inf
+
+  @property
+  def states(self):
+    return self.records['state'][:self.count]
+
+  @property
+  def error_norms(self):
+    return self.records['error_norm'][:self.count]
+
+  @property
+  def gamas(self):
+    return self.records['gama'][:self.count]
 
-  return [K, Ξ, Ψ]
+  @property
+  def etas(self):
+    return self.records['eta'][:self.count]
+
+  def inter_event_times(self):
+    """
+    Calculates the inter-event times, with 0 for the first event.
+
+    Returns:
+                    array: Inter-event times.
+    """
+    return np.diff(self.times, prepend=self.times[:1])
+
+  def statistics(self, percentiles=(5, 50, 95)):
+    """
+    Calculates statistics of the inter-event times, excluding the first event.
+
+    Parameters:
+                    percentiles (tuple): Percentiles to calculate.
+
+    Returns:
+                    dict: Number of events, mean, minimum, maximum, standard deviation and percentiles.
+    """
+    iet = self.inter_event_times()[1:]
+    if len(iet) == 0:
+      iet = np.array([np.nan])
+    statistics = {'events': self.count, 'mean': np.mean(iet), 'min': np.min(iet),
+                  'max': np.max(iet), 'std': np.std(iet)}
+    for q, value in zip(percentiles, np.percentile(iet, percentiles)):
+      statistics[f'p{q}'] = value
+    return statistics
+
+
+def get_simulation_results(t, y, events, return_trace=False):
+  """
+  Packs the results of a closed-loop simulation.
+
+  Parameters:
+                  t (array): Time points of the simulation.
+                  y (array): System outputs of the simulation.
+                  events (EventTrace): Events of the simulation.
+                  return_trace (bool): Append the event trace to the results.
+
+  Returns:
+                  tuple: t, y, inter-event times, event times and, if requested, the event trace.
+  """
+  results = (t, y, events.inter_event_times(), events.times)
+  return results + (events,) if return_trace else results
+
+
+class OutputRecorder:
+  """
+  Class to represent how a closed-loop simulation stores its outputs.
+
+  By default every point of the output grid is kept. With a decimation factor only every
+  `decimation`-th grid point and the last one are kept, and with `events` the samples at the
+  event instants are merged in, so the outputs can be reduced to the events plus a coarse grid
+  without the dense array ever being allocated. A callback receives every block of dense grid
+  samples as it is produced, before decimation, to stream the outputs elsewhere.
+
+  Parameters:
+                  decimation (int): Keep one grid point out of `decimation`.
+                  events (bool): Merge the samples at the event instants into the outputs.
+                  callback (function): Called as callback(t, y) with each block of grid samples, where y
+                                       has shape (..., n_outputs, len(t)).
+                  grid (bool): Keep grid samples. With False only the event samples, if any, are kept.
+  """
+
+  def __init__(self, decimation=1, events=False, callback=None, grid=True):
+    if decimation < 1:
+      raise ValueError('The decimation factor must be a positive integer')
+    self.decimation = int(decimation)
+    self.events = events
+    self.callback = callback
+    self.grid = grid
+
+  def open(self, timepts, shape, tail=1):
+    """
+    Creates the output buffer of one simulation.
+
+    Parameters:
+                    timepts (array): Time points of the output grid.
+                    shape (tuple): Shape of one sample, (n_outputs,) or (N, n_outputs).
+                    tail (int): Number of most recent dense samples that must stay available.
+
+    Returns:
+                    OutputBuffer: Buffer of the simulation.
+    """
+    return OutputBuffer(self, timepts, shape, tail)
+
+
+class OutputBuffer:
+  """
+  Class to represent the outputs of one simulation, stored as set by an OutputRecorder.
+
+  Parameters:
+                  recorder (OutputRecorder): Storage settings.
+                  timepts (array): Time points of the output grid.
+                  shape (tuple): Shape of one sample, (n_outputs,) or (N, n_outputs).
+                  tail (int): Number of most recent dense samples that must stay available.
+  """
+
+  def __init__(self, recorder, timepts, shape, tail=1):
+    self.recorder = recorder
+    self.timepts = timepts
+    self.shape = tuple(shape)
+    self.dense = recorder.grid and recorder.decimation == 1
+
+    if self.dense:
+      self.y = np.zeros(self.shape + (len(timepts),))
+      self.kept = None
+    else:
+      kept = np.arange(0, len(timepts), recorder.decimation) if recorder.grid else \
+          np.empty(0, dtype=int)
+      self.kept = kept
+      self.y = np.zeros(self.shape + (len(kept),))
+      # Ring buffer of the most recent samples, stored twice so the window in chronological
+      # order, ring[..., start:start + size], is always a contiguous view
+      self.size = max(tail, 1)
+      self.ring = np.zeros(self.shape + (2 * self.size,))
+      self.start = 0
+      self.tail_end = -1
+
+  @property
+  def tail(self):
+    return self.ring[..., self.start:self.start + self.size]
+
+  def write(self, index, values):
+    """
+    Stores a block of consecutive grid samples.
+
+    Parameters:
+                    index (int): Grid index of the first sample.
+                    values (array): Samples, shape (..., n_outputs, n).
+    """
+    values = np.asarray(values, dtype=float)
+    end = index + values.shape[-1]
+
+    if self.recorder.callback is not None:
+      self.recorder.callback(self.timepts[index:end], values)
+
+    if self.dense:
+      self.y[..., index:end] = values
+      return
+
+    first, last = np.searchsorted(self.kept, (index, end))
+    self.y[..., first:last] = values[..., self.kept[first:last] - index]
+
+    size, count = self.size, values.shape[-1]
+    if count >= size:
+      self.ring[..., :size] = values[..., -size:]
+      self.ring[..., size:] = values[..., -size:]
+      self.start = 0
+    else:
+      # Write the block after the newest sample and copy it to the other half of the ring
+      start, stop = self.start, self.start + count
+      self.ring[..., start:stop] = values
+      split = min(stop, size) - start
+      self.ring[..., start + size:start + size + split] = values[..., :split]
+      self.ring[..., :count - split] = values[..., split:]
+      self.start = stop % size
+    self.tail_end = end - 1
+
+  def recent(self, index):
+    """
+    Returns the most recent dense samples up to a grid index.
+
+    Parameters:
+                    index (int): Grid index of the last sample written.
+
+    Returns:
+                    tuple: Time points and samples, shape (..., n_outputs, n).
+    """
+    if self.dense:
+      return self.timepts[:index + 1], self.y[..., :index + 1]
+
+    size = min(self.size, index + 1)
+    return self.timepts[index + 1 - size:index + 1], self.tail[..., -size:]
+
+  def result(self, end=None, events=None, K=None):
+    """
+    Returns the stored outputs up to a grid index.
+
+    Parameters:
+                    end (int): Grid index of the last sample of the simulation. If None, the last point
+                               of the grid.
+                    events (EventTrace): Events of the simulation, merged if the recorder keeps them.
+                    K (array): State feedback gain, used to calculate the control at the events.
+
+    Returns:
+                    tuple: Time points and outputs, shape (..., n_outputs, n).
+    """
+    if end is None:
+      end = len(self.timepts) - 1
+
+    if self.dense:
+      t, y = self.timepts[:end + 1], self.y[..., :end + 1]
+    else:
+      count = np.searchsorted(self.kept, end, side='right')
+      t, y = self.timepts[self.kept[:count]], self.y[..., :count]
+      if self.recorder.grid and self.kept[count - 1] != end:
+        t = np.append(t, self.timepts[end])
+        y = np.concatenate((y, self.tail[..., -1:]), axis=-1)
+
+    if self.recorder.events and events is not None:
+      inside = events.times <= self.timepts[end]
+      states = events.states[inside]
+      samples = np.zeros(self.shape + (len(states),))
+      samples[:2] = states.T
+      samples[2] = np.atleast_2d(K)[0] @ states.T
+      if self.shape[0] > 3:
+        samples[3] = events.etas[inside]
+
+      order = np.argsort(np.concatenate((t, events.times[inside])), kind='stable')
+      t = np.concatenate((t, events.times[inside]))[order]
+      y = np.concatenate((y, samples), axis=-1)[..., order]
+
+    return t, y
+
+
+class RunContext:
+  """
+  Class to represent the state of the ETM and ZOH blocks during one simulation.
+
+  The blocks keep no run state themselves: the simulation engine creates a context for each
+  run and passes it through the system parameters, so one designed ETM can drive several
+  simulations at the same time.
+  """
+
+  def __init__(self):
+    self.start_time = 0.
+    self.etm_previous_time = 0
+    self.first_simulation = True
+    self.events = EventTrace()
+    self.zoh_previous_time = 0
+    self.zoh_previous = []
+    self.last_states_sent = [0, 0]
+
+  def restart(self, t):
+    """
+    Prepares the context for an integration restarted at time t, such as the next chunk of a
+    simulation run until it settles. Events are recorded again until the outputs are replayed
+    from t.
+
+    Parameters:
+                    t (float): Start time of the integration.
+    """
+    self.start_time = t
+    self.etm_previous_time = t
+    self.first_simulation = True
+
+
+def get_run_context(params):
+  """
+  Returns the run context held by the system parameters.
+
+  Parameters:
+                  params (dict): System parameters.
+
+  Returns:
+                  RunContext: Context of the current run.
+  """
+  context = params.get(RUN_CONTEXT) if params else None
+  if context is None:
+    raise ValueError('The ETM and ZOH blocks require a RunContext in the parameters '
+                     f"under the '{RUN_CONTEXT}' key")
+  return context
+
+
+class SteadyStateStop:
+  """
+  Class to represent a criterion to stop a simulation once it has reached steady state.
+
+  A run is settled at time t when, over the window [t - window, t], every state stays within
+  ±tolerance·|x_op| of its value at t and no event occurs. The window must also start after
+  the last breakpoint of the CPL perturbation, so every load step is simulated.
+
+  Parameters:
+                  tolerance (float): Half-width of the band around the current state, relative to
+                                     the state at the operating point.
+                  window (float): Length of the window, in seconds.
+  """
+
+  def __init__(self, tolerance=5e-3, window=5e-3):
+    self.tolerance = tolerance
+    self.window = window
+
+  def check_interval(self, step):
+    """
+    Returns the number of grid steps between two checks of the criterion (half a window).
+
+    Parameters:
+                    step (float): Time step of the output grid.
+
+    Returns:
+                    int: Number of steps.
+    """
+    return max(1, int(round(self.window / (2 * step))))
+
+  def is_settled(self, timepts, states, index, X_OP, hold_until=0.):
+    """
+    Checks the criterion at a time point.
+
+    Parameters:
+                    timepts (array): Time points of the simulation.
+                    states (array): States of the simulation, shape (2, T) or (N, 2, T). Only the
+                                    columns up to `index` are read.
+                    index (int): Index of the current time point.
+                    X_OP (array): States at the operating point.
+                    hold_until (float): Earliest start of the window, such as the time of the last
+                                        event or of the last perturbation breakpoint. An array of
+                                        shape (N,) for stacked runs.
+
+    Returns:
+                    bool: Whether the run is settled, or an array of shape (N,) for stacked runs.
+    """
+    t = timepts[index]
+    start = np.searchsorted(timepts, t - self.window, side='left')
+    recent = states[..., start:index + 1]
+    limits = self.tolerance * np.abs(np.asarray(X_OP, dtype=float)[:2])
+
+    inside = np.all(np.abs(recent - recent[..., -1:]) <= limits[:, None], axis=(-2, -1))
+    return inside & (t - self.window >= np.maximum(hold_until, 0.))
+
+  def tail_length(self, step):
+    """
+    Returns the number of grid points covered by the window.
+
+    Parameters:
+                    step (float): Time step of the output grid.
+
+    Returns:
+                    int: Number of points.
+    """
+    return int(np.ceil(self.window / step)) + 1
+
+  def is_output_settled(self, output, index, X_OP, hold_until=0.):
+    """
+    Checks the criterion on the most recent samples of an output buffer, whose first two
+    outputs are the states.
+
+    Parameters:
+                    output (OutputBuffer): Outputs of the simulation.
+                    index (int): Grid index of the last sample written.
+                    X_OP (array): States at the operating point.
+                    hold_until (float): Earliest start of the window (see `is_settled`).
+
+    Returns:
+                    bool: Whether the run is settled, or an array of shape (N,) for stacked runs.
+    """
+    t, y = output.recent(index)
+    return self.is_settled(t, y[..., :2, :], len(t) - 1, X_OP, hold_until)
+
+
+def get_last_breakpoint(perturbation_signal_data, end_time):
+  """
+  Returns the time of the last breakpoint of the perturbation within the simulation.
+
+  Parameters:
+                  perturbation_signal_data (list): List of tuples representing perturbation signal data.
+                  end_time (float): End time of simulation.
+
+  Returns:
+                  float: Time of the last breakpoint, or 0.
+  """
+  return max([t for t, _ in perturbation_signal_data[1:] if t <= end_time], default=0.)
+
+
+def input_output_response_until_settled(system, timepts, U, X0, stop, X_OP,
+                                        hold_until=lambda: 0., on_restart=None, **kwargs):
+  """
+  Simulates an input/output system in chunks until it settles.
+
+  The grid is integrated in chunks of `stop.check_interval` steps, each one starting from the
+  final state of the previous one, and the criterion is checked on the first two outputs at
+  the end of each chunk.
+
+  Parameters:
+                  system (InputOutputSystem): System to simulate.
+                  timepts (array): Time points of the simulation.
+                  U (array): Inputs at the time points.
+                  X0 (array): Initial states.
+                  stop (SteadyStateStop): Stop criterion.
+                  X_OP (array): States at the operating point, which scale the tolerance.
+                  hold_until (function): Returns the earliest start of the settling window.
+                  on_restart (function): Called with the start time of each chunk but the first.
+                  **kwargs: Additional arguments of `ct.input_output_response`.
+
+  Returns:
+                  TimeResponseData: Response up to the time the system settled, or the whole grid.
+  """
+  U = np.asarray(U, dtype=float)
+  interval = stop.check_interval(timepts[1] - timepts[0])
+  x = np.asarray(X0, dtype=float)
+  y = states = None
+  start = 0
+
+  while start < len(timepts) - 1:
+    end = min(start + interval, len(timepts) - 1)
+    if start > 0 and on_restart is not None:
+      on_restart(timepts[start])
+    response = ct.input_output_response(
+        sys=system, T=timepts[start:end + 1], U=U[..., start:end + 1], X0=x,
+        return_x=True, squeeze=False, **kwargs)
+
+    if y is None:
+      y = np.empty((response.outputs.shape[0], len(timepts)))
+      states = np.empty((response.states.shape[0], len(timepts)))
+    y[:, start:end + 1] = response.outputs
+    states[:, start:end + 1] = response.states
+    x = response.states[:, -1]
+    start = end
+
+    if stop.is_settled(timepts, y[:2], end, X_OP, hold_until()):
+      break
+
+  return ct.TimeResponseData(
+      timepts[:start + 1], y[:, :start + 1], states[:, :start + 1], U[..., :start + 1],
+      issiso=False, output_labels=system.output_labels, state_labels=system.state_labels,
+      input_labels=system.input_labels)
 
 
 class StaticETM:
@@ -87,9 +694,6 @@ class StaticETM:
     self.Ψ = Ψ
     self.Ξ = Ξ
     self.name = name
-    self.previous_time = 0
-    self.first_simulation = True
-    self.event_times = [0.]
     self.system = ct.NonlinearIOSystem(
         None, self.etm_output,
         name=self.name,
@@ -108,9 +712,24 @@ class StaticETM:
     Returns:
                     float: Value of Γ.
     """
+    instrument.count('gama_evaluations')
     error = last_states_sent - current_states
     return np.dot(current_states.T, np.dot(self.Ψ, current_states)) - np.dot(error.T, np.dot(self.Ξ, error))
 
+  def get_trigger_value(self, current_states, last_states_sent, n=None):
+    """
+    Calculates the triggering condition. An event occurs when it becomes negative.
+
+    Parameters:
+                    current_states (array): Current states.
+                    last_states_sent (array): Last sent states.
+                    n (float): Dynamic variable (not used).
+
+    Returns:
+                    float: Value of Γ.
+    """
+    return self.get_gama(current_states, last_states_sent)
+
   def etm_output(self, t, x, u, params):
     """
     Output function of the ETM system.
@@ -119,15 +738,18 @@ class StaticETM:
                     t (float): Current time.
                     x (array): System states (not used).
                     u (array): System inputs.
-                    params (dict): System parameters (not used).
+                    params (dict): System parameters, holding the run context.
 
     Returns:
                     array: States to be sent.
     """
-    if t != self.previous_time:
-      self.previous_time = t
-      if self.first_simulation and t == 0.:
-        self.first_simulation = False
+    instrument.count('etm_output_calls')
+    context = get_run_context(params)
+
+    if t != context.etm_previous_time:
+      context.etm_previous_time = t
+      if context.first_simulation and t == context.start_time:
+        context.first_simulation = False
 
     last_states_sent = u[0:2]
     current_states = u[2:4]
@@ -135,8 +757,9 @@ class StaticETM:
     Γ = self.get_gama(current_states, last_states_sent)
     trigger = Γ < 0
 
-    if self.first_simulation and trigger:
-      self.event_times.append(t)
+    if context.first_simulation and trigger and t > context.events.last_time:
+      context.events.append(t, current_states,
+                            np.linalg.norm(last_states_sent - current_states), Γ)
 
     state_to_send = current_states if trigger or t == 0. else last_states_sent
     return [state_to_send[0], state_to_send[1]]
@@ -146,6 +769,9 @@ class DynamicETM:
   """
   Class to represent the model of a Dynamic Event-Triggered Mechanism (ETM) system.
 
+  The dynamic variable follows η' = -λη + Γ and an event occurs when η + θΓ < 0, as in the
+  notebooks. Every simulation engine uses this rule (see `get_trigger_value`).
+
   Parameters:
                   name (str): Name of the ETM.
                   Ψ (array): Ψ matrix for the calculation of Γ.
@@ -158,9 +784,6 @@ class DynamicETM:
     self.Ψ = Ψ
     self.Ξ = Ξ
     self.name = name
-    self.previous_time = 0
-    self.first_simulation = True
-    self.event_times = [0.]
     self.θ = θ
     self.λ = λ
     self.system = ct.NonlinearIOSystem(
@@ -181,9 +804,24 @@ class DynamicETM:
     Returns:
                     float: Value of Γ.
     """
+    instrument.count('gama_evaluations')
     error = last_states_sent - current_states
     return np.dot(current_states.T, np.dot(self.Ψ, current_states)) - np.dot(error.T, np.dot(self.Ξ, error))
 
+  def get_trigger_value(self, current_states, last_states_sent, n):
+    """
+    Calculates the triggering condition η + θΓ. An event occurs when it becomes negative.
+
+    Parameters:
+                    current_states (array): Current states.
+                    last_states_sent (array): Last sent states.
+                    n (float): Current value of the dynamic variable η.
+
+    Returns:
+                    float: Value of η + θΓ.
+    """
+    return n + self.θ * self.get_gama(current_states, last_states_sent)
+
   def etm_update(self, t, n, u, params):
     """
     Update function for the dynamic state 'n' of the ETM system.
@@ -211,24 +849,28 @@ class DynamicETM:
                     t (float): Current time.
                     n (array): Current value of the dynamic state 'n'.
                     u (array): System inputs.
-                    params (dict): System parameters (not used).
+                    params (dict): System parameters, holding the run context.
 
     Returns:
                     array: States to be sent.
     """
-    if t != self.previous_time:
-      self.previous_time = t
-      if self.first_simulation and t == 0.:
-        self.first_simulation = False
+    instrument.count('etm_output_calls')
+    context = get_run_context(params)
+
+    if t != context.etm_previous_time:
+      context.etm_previous_time = t
+      if context.first_simulation and t == context.start_time:
+        context.first_simulation = False
 
     last_states_sent = u[0:2]
     current_states = u[2:4]
 
     Γ = self.get_gama(current_states, last_states_sent)
-    trigger = Γ < 0
+    trigger = n[0] + self.θ * Γ < 0
 
-    if self.first_simulation and trigger:
-      self.event_times.append(t)
+    if context.first_simulation and trigger and t > context.events.last_time:
+      context.events.append(t, current_states,
+                            np.linalg.norm(last_states_sent - current_states), Γ, n[0])
 
     state_to_send = current_states if trigger or t == 0. else last_states_sent
     return [state_to_send[0], state_to_send[1], n[0]]
@@ -239,13 +881,11 @@ class ZeroOrderHold:
   Class representing a Zero-Order Hold (ZOH) system.
 
   This system maintains the last received input values and provides them as output for a given time step.
+  The values are kept in the run context passed through the system parameters.
 
   """
 
   def __init__(self):
-    self.previous_time = 0
-    self.previous = []
-    self.last_states_sent = [0, 0]
     self.system = ct.ss(
         None, self.zoh_output,
         name='zoh',
@@ -261,16 +901,18 @@ class ZeroOrderHold:
                     t (float): Current time.
                     x (array): System states (not used).
                     u (array): System inputs.
-                    params (dict): System parameters (not used).
+                    params (dict): System parameters, holding the run context.
 
     Returns:
                     array: Last received input values.
     """
-    if t != self.previous_time:
-      self.last_states_sent = self.previous
-      self.previous_time = t
-    self.previous = u
-    return self.last_states_sent
+    context = get_run_context(params)
+
+    if t != context.zoh_previous_time:
+      context.last_states_sent = context.zoh_previous
+      context.zoh_previous_time = t
+    context.zoh_previous = u
+    return context.last_states_sent
 
 
 class Controller:
@@ -309,7 +951,9 @@ class Controller:
 
 def closed_loop_simulate(converter, etm, K, params, end_time,
                          perturbation_signal_data=None,
-                         x0_factor=[1.5, 0.13], step=1e-5):
+                         x0_factor=[1.5, 0.13], step=1e-5,
+                         method='interconnect', solve_ivp_method='RK45',
+                         return_trace=False, stop=None, recorder=None, period=None):
   """
   Simulate the closed-loop system consisting of a converter and an event-triggered mechanism (ETM).
 
@@ -321,17 +965,63 @@ def closed_loop_simulate(converter, etm, K, params, end_time,
                   perturbation_signal_data (list): List of tuples representing perturbation signal data.
                   x0_factor (list): Factor to multiply the initial state values to obtain the initial conditions.
                   step (float): Time step for simulation.
+                  method (str): Simulation engine. 'interconnect' integrates the python-control
+                                interconnection with a step bounded by `step`; 'hybrid' uses
+                                `hybrid_closed_loop_simulate`; 'analytic' uses
+                                `analytic_closed_loop_simulate` (linearized converter only); 'fused'
+                                uses the hybrid engine with the kernel from `compile_closed_loop`;
+                                'periodic' checks the trigger every `period` seconds with
+                                `periodic_closed_loop_simulate`.
+                  solve_ivp_method (str): Integration method for the 'interconnect', 'hybrid' and 'fused'
+                                          engines. The hybrid engines supply the analytic Jacobian to
+                                          implicit methods ('Radau', 'BDF', 'LSODA').
+                  return_trace (bool): Append the EventTrace of the run to the results.
+                  stop (SteadyStateStop): Criterion to end the simulation once it has settled. If None,
+                                          the simulation runs until `end_time`.
+                  recorder (OutputRecorder): How the outputs are stored. If None, every point of the grid.
+                                             The 'interconnect' engine integrates on the dense grid
+                                             and reduces the outputs afterwards.
+                  period (float): Sampling period of the 'periodic' engine. If None, the step.
 
   Returns:
                   tuple: A tuple containing the following arrays:
-                                  - t (array): Array of time points for simulation.
+                                  - t (array): Array of time points for simulation, up to the stop time.
                                   - y (array): Array of system outputs for simulation.
                                   - inter_event_times (array): Array of inter-event times for the ETM.
                                   - event_times (array): Array of event times for the ETM.
+                                  - events (EventTrace): Events of the run, if `return_trace` is True.
   """
-  etm.previous_time = 0
-  etm.first_simulation = True
-  etm.event_times = [0.]
+  if method == 'hybrid':
+    with instrument.span('integration', engine=method):
+      return hybrid_closed_loop_simulate(
+          converter, etm, K, params, end_time,
+          perturbation_signal_data, x0_factor, step,
+          solve_ivp_method=solve_ivp_method, return_trace=return_trace, stop=stop,
+          recorder=recorder)
+  elif method == 'fused':
+    with instrument.span('integration', engine=method):
+      return hybrid_closed_loop_simulate(
+          converter, etm, K, params, end_time,
+          perturbation_signal_data, x0_factor, step,
+          solve_ivp_method=solve_ivp_method,
+          kernel=compile_closed_loop(converter, etm, K, params),
+          return_trace=return_trace, stop=stop, recorder=recorder)
+  elif method == 'analytic':
+    with instrument.span('integration', engine=method):
+      return analytic_closed_loop_simulate(
+          converter, etm, K, params, end_time,
+          perturbation_signal_data, x0_factor, step,
+          return_trace=return_trace, stop=stop, recorder=recorder)
+  elif method == 'periodic':
+    with instrument.span('integration', engine=method):
+      return periodic_closed_loop_simulate(
+          converter, etm, K, params, end_time,
+          perturbation_signal_data, x0_factor, step, period,
+          return_trace=return_trace, stop=stop, recorder=recorder)
+  elif method != 'interconnect':
+    raise ValueError(f'Unknown simulation method: {method}')
+
+  context = RunContext()
 
   X_OP = np.array([params['op']['iL'], params['op']['vC']])
   timepts = np.arange(0, end_time + step, step)
@@ -340,6 +1030,10 @@ def closed_loop_simulate(converter, etm, K, params, end_time,
   VC_INIT = x0_factor[1] * params['op']['vC']
   X0 = np.array([IL_INIT, VC_INIT])
 
+  # The ZOH holds the initial state until the first event, as in the other engines
+  context.last_states_sent = X0 - X_OP
+  context.events.append(0., X0 - X_OP, 0., etm.get_gama(X0 - X_OP, X0 - X_OP))
+
   if perturbation_signal_data == None:
     perturbation_signal_data = [(0., params['op']['Pcpl'])]
   P_CPL = generate_square_signal(
@@ -361,8 +1055,10 @@ def closed_loop_simulate(converter, etm, K, params, end_time,
   zoh = ZeroOrderHold()
   controller = Controller(K)
 
+  # python-control stores the current parameters on each subsystem, so every run works on
+  # its own shallow copies of the shared converter and ETM systems
   CLOSED_LOOP_BUCK_SYSTEM = ct.interconnect(
-      (converter.system, etm.system, zoh.system, controller.system),
+      (copy.copy(converter.system), copy.copy(etm.system), zoh.system, controller.system),
       connections=(
           # Connection between the controller output and the plant
           (converter.system.name + '.δd', 'control.u'),
@@ -386,20 +1082,1006 @@ def closed_loop_simulate(converter, etm, K, params, end_time,
       outlist=outlist,
       output=output
   )
+  if instrument.enabled():
+    CLOSED_LOOP_BUCK_SYSTEM._rhs = instrument.counted('rhs_evaluations',
+                                                      CLOSED_LOOP_BUCK_SYSTEM._rhs)
+
+  with instrument.span('integration', engine=method):
+    if stop is None:
+      t, y = ct.input_output_response(
+          sys=CLOSED_LOOP_BUCK_SYSTEM, T=timepts,
+          U=P_CPL,
+          X0=X0 - X_OP,
+          solve_ivp_method=solve_ivp_method,
+          solve_ivp_kwargs={'max_step': step},
+          params={**params, RUN_CONTEXT: context}
+      )
+    else:
+      last_breakpoint = get_last_breakpoint(perturbation_signal_data, end_time)
+      t, y = input_output_response_until_settled(
+          CLOSED_LOOP_BUCK_SYSTEM, timepts, P_CPL, X0 - X_OP, stop, X_OP,
+          lambda: max(context.events.times[-1], last_breakpoint), context.restart,
+          solve_ivp_method=solve_ivp_method,
+          solve_ivp_kwargs={'max_step': step},
+          params={**params, RUN_CONTEXT: context}
+      )
+
+  if recorder is not None:
+    buffer = recorder.open(t, y.shape[:1])
+    buffer.write(0, y)
+    t, y = buffer.result(events=context.events, K=K)
+
+  return get_simulation_results(t, y, context.events, return_trace)
+
+
+def get_plant_rhs(converter, params):
+  """
+  Returns the right-hand side of the shifted converter dynamics.
 
-  t, y = ct.input_output_response(
-      sys=CLOSED_LOOP_BUCK_SYSTEM, T=timepts,
-      U=P_CPL,
-      X0=X0 - X_OP,
-      solve_ivp_method='RK45',
-      solve_ivp_kwargs={'max_step': step},
-      params=params
-  )
+  Parameters:
+                  converter: Instance of the converter system (shifted non-linear or linearized).
+                  params (dict): Dictionary of system parameters.
+
+  Returns:
+                  function: f(t, x, u) returning the derivative of the state deviations,
+                            where u = (δd, δPcpl).
+  """
+  if hasattr(converter, 'update'):
+    return lambda t, x, u: converter.update(t, x, u, params)
 
-  inter_event_times = [0.]
+  A = np.asarray(converter.system.A)
+  B = np.asarray(converter.system.B)
+  return lambda t, x, u: A @ x + B @ u
 
-  for i in range(1, len(etm.event_times)):
-    inter_event_times.append(
-        etm.event_times[i] - etm.event_times[i-1])
 
-  return t, y, inter_event_times, etm.event_times
+@functools.lru_cache(maxsize=None)
+def get_closed_loop_kernel(plant, dynamic, jit):
+  """
+  Builds the flat closed-loop kernel functions for a plant update function.
+
+  The kernels take their constants as arrays, so they are built (and compiled, when Numba
+  is used) once per plant function and ETM type, and then reused for every design.
+
+  Parameters:
+                  plant (function): Flat update function f(x1, x2, d, p, c) of the converter.
+                  dynamic (bool): Whether the kernel includes the dynamic variable η.
+                  jit (bool): Compile the kernels with Numba.
+
+  Returns:
+                  tuple: Functions rhs(z, x_hat, δPcpl, c, plant_c) and trigger(z, x_hat, c).
+  """
+  if jit:
+    from numba import njit
+    plant = njit(plant)
+
+  def gama(x1, x2, x1_hat, x2_hat, c):
+    e1 = x1_hat - x1
+    e2 = x2_hat - x2
+    return (x1 * (c[2] * x1 + c[3] * x2) + x2 * (c[4] * x1 + c[5] * x2)
+            - e1 * (c[6] * e1 + c[7] * e2) - e2 * (c[8] * e1 + c[9] * e2))
+
+  if jit:
+    gama = njit(gama)
+
+  def rhs(z, x_hat, δP, c, plant_c):
+    dz = np.empty(3 if dynamic else 2)
+    δd = c[0] * x_hat[0] + c[1] * x_hat[1]
+    dz[0], dz[1] = plant(z[0], z[1], δd, δP, plant_c)
+    if dynamic:
+      dz[2] = -c[11] * z[2] + gama(z[0], z[1], x_hat[0], x_hat[1], c)
+    return dz
+
+  def trigger(z, x_hat, c):
+    Γ = gama(z[0], z[1], x_hat[0], x_hat[1], c)
+    if dynamic:
+      return z[2] + c[10] * Γ
+    return Γ
+
+  if jit:
+    rhs = njit(rhs)
+    trigger = njit(trigger)
+
+  return rhs, trigger
+
+
+def compile_closed_loop(converter, etm, K, params, jit=None):
+  """
+  Compiles the converter, ETM, ZOH and controller loop into flat kernel functions.
+
+  The converter parameters, the gain and the triggering matrices are packed into constant
+  arrays, so each evaluation is plain scalar arithmetic with no signal routing, dictionary
+  lookups or intermediate arrays. The kernels are compiled with Numba when it is installed.
+
+  Parameters:
+                  converter: Instance of the converter system providing `compile_update`.
+                  etm: Instance of the event-triggered mechanism (ETM).
+                  K (array): State feedback gain.
+                  params (dict): Dictionary of system parameters.
+                  jit (bool): Compile the kernels with Numba. If None, Numba is used when installed.
+
+  Returns:
+                  tuple: Functions rhs(z, x_hat, δPcpl), returning the derivative of the closed-loop
+                         state, and trigger(z, x_hat), returning the triggering condition.
+  """
+  if jit is None:
+    jit = NUMBA_AVAILABLE
+  elif jit and not NUMBA_AVAILABLE:
+    raise ImportError('Numba is required to compile the closed-loop kernel')
+
+  dynamic = isinstance(etm, DynamicETM)
+  plant, plant_c = converter.compile_update(params)
+  rhs, trigger = get_closed_loop_kernel(plant, dynamic, jit)
+
+  c = np.concatenate((np.ravel(K), np.ravel(etm.Ψ), np.ravel(etm.Ξ),
+                      [etm.θ if dynamic else 0., etm.λ if dynamic else 0.])).astype(float)
+
+  def closed_loop_rhs(z, x_hat, δP):
+    return rhs(z, x_hat, δP, c, plant_c)
+
+  def trigger_value(z, x_hat):
+    return trigger(z, x_hat, c)
+
+  # The compiled kernels cannot count their own calls, so Γ is counted around them: at each
+  # evaluation of the trigger and, with the dynamic ETM, of the right-hand side
+  if dynamic:
+    closed_loop_rhs = instrument.counted('gama_evaluations', closed_loop_rhs)
+  return closed_loop_rhs, instrument.counted('gama_evaluations', trigger_value)
+
+
+def get_plant_jacobian(converter, params):
+  """
+  Returns the Jacobian ∂f/∂x of the shifted converter dynamics.
+
+  Parameters:
+                  converter: Instance of the converter system (shifted non-linear or linearized).
+                  params (dict): Dictionary of system parameters.
+
+  Returns:
+                  function: J(t, x, u) returning the 2x2 Jacobian, where u = (δd, δPcpl).
+  """
+  if hasattr(converter, 'jacobian'):
+    return lambda t, x, u: converter.jacobian(t, x, u, params)
+
+  A = np.asarray(converter.system.A)
+  return lambda t, x, u: A
+
+
+def hybrid_closed_loop_simulate(converter, etm, K, params, end_time,
+                                perturbation_signal_data=None,
+                                x0_factor=[1.5, 0.13], step=1e-5,
+                                solve_ivp_method='RK45', rtol=1e-6, atol=1e-9,
+                                min_inter_event_time=1e-7, kernel=None, return_trace=False,
+                                stop=None, recorder=None):
+  """
+  Simulate the closed-loop system as a hybrid system with event localization.
+
+  Between transmissions the held state x̂ is constant, so the plant is integrated freely
+  with the control K x̂. Each transmission instant is located as a root of the triggering
+  condition (Γ for the static ETM, η + θΓ for the dynamic ETM), after which x̂ is reset to
+  the current state. The integration is also restarted at each breakpoint of the CPL
+  perturbation. The step only defines the output grid. With a stop criterion, the
+  integration is also restarted every half window to check it.
+
+  Parameters:
+                  converter: Instance of the converter system (shifted non-linear or linearized).
+                  etm: Instance of the event-triggered mechanism (ETM).
+                  K (array): State feedback gain.
+                  params (dict): Dictionary of system parameters.
+                  end_time (float): End time of simulation.
+                  perturbation_signal_data (list): List of tuples representing perturbation signal data.
+                  x0_factor (list): Factor to multiply the initial state values to obtain the initial conditions.
+                  step (float): Time step of the output grid.
+                  solve_ivp_method (str): Integration method used between events. Implicit methods
+                                          ('Radau', 'BDF', 'LSODA') use the analytic closed-loop Jacobian.
+                  rtol (float): Relative tolerance of the integrator.
+                  atol (float): Absolute tolerance of the integrator.
+                  min_inter_event_time (float): Minimum time between two events, used to exclude Zeno behavior.
+                                                The trigger is checked again at the end of the window.
+                  kernel (tuple): Closed-loop kernel (rhs, trigger) from `compile_closed_loop`. If None, the
+                                  converter and ETM objects are evaluated directly.
+                  return_trace (bool): Append the EventTrace of the run to the results.
+                  stop (SteadyStateStop): Criterion to end the simulation once it has settled.
+                  recorder (OutputRecorder): How the outputs are stored. If None, every point of the grid.
+
+  Returns:
+                  tuple: A tuple containing the following arrays:
+                                  - t (array): Array of time points for simulation, up to the stop time.
+                                  - y (array): Array of system outputs for simulation.
+                                  - inter_event_times (array): Array of inter-event times for the ETM.
+                                  - event_times (array): Array of event times for the ETM.
+  """
+  dynamic = isinstance(etm, DynamicETM)
+  K = np.atleast_2d(K)
+
+  if kernel is None:
+    plant_rhs = get_plant_rhs(converter, params)
+
+    def closed_loop_rhs(z, x_hat, δP):
+      dx = plant_rhs(0., z[:2], np.array([(K @ x_hat)[0], δP]))
+      if dynamic:
+        dn = -etm.λ * z[2] + etm.get_gama(z[:2], x_hat)
+        return np.append(dx, dn)
+      return dx
+
+    def trigger_value(z, x_hat):
+      return etm.get_trigger_value(z[:2], x_hat, z[2] if dynamic else None)
+  else:
+    closed_loop_rhs, trigger_value = kernel
+
+  implicit = solve_ivp_method in IMPLICIT_METHODS
+  if implicit:
+    plant_jacobian = get_plant_jacobian(converter, params)
+    Ψ_SYM = etm.Ψ + np.transpose(etm.Ψ)
+    Ξ_SYM = etm.Ξ + np.transpose(etm.Ξ)
+
+  X_OP = np.array([params['op']['iL'], params['op']['vC']])
+  timepts = np.arange(0, end_time + step, step)
+  final_time = timepts[-1]
+
+  X0 = np.array([x0_factor[0] * params['op']['iL'],
+                 x0_factor[1] * params['op']['vC']])
+  z = X0 - X_OP
+  if dynamic:
+    z = np.append(z, 0.)
+
+  if perturbation_signal_data == None:
+    perturbation_signal_data = [(0., params['op']['Pcpl'])]
+  breakpoints = [t for t, _ in perturbation_signal_data[1:] if 0. < t < final_time]
+  breakpoints.append(final_time)
+  perturbation = make_square_signal(perturbation_signal_data)
+
+  if stop is not None:
+    last_breakpoint = get_last_breakpoint(perturbation_signal_data, final_time)
+    check_interval = stop.check_interval(step)
+    max_segment = check_interval * step
+    next_check = check_interval
+
+  output = (recorder or OutputRecorder()).open(
+      timepts, (4 if dynamic else 3,), 1 if stop is None else stop.tail_length(step))
+  x_hat = z[:2].copy()
+  last_event = 0.
+  t_current = 0.
+  first_step = None
+  index = 0
+
+  events = EventTrace()
+  events.append(0., x_hat, 0., etm.get_gama(x_hat, x_hat))
+
+  def record_event(t, z, x_hat):
+    events.append(t, z[:2], np.linalg.norm(x_hat - z[:2]), etm.get_gama(z[:2], x_hat),
+                  z[2] if dynamic else 0.)
+
+  def trigger(t, z):
+    return trigger_value(z, x_hat)
+
+  trigger.terminal = True
+  trigger.direction = -1
+
+  for boundary in breakpoints:
+    δP = perturbation(t_current) - params['op']['Pcpl']
+
+    while t_current < boundary:
+      guard_end = last_event + min_inter_event_time
+      if t_current >= guard_end and trigger(t_current, z) < 0:
+        record_event(t_current, z, x_hat)
+        x_hat = z[:2].copy()
+        last_event = t_current
+        guard_end = last_event + min_inter_event_time
+
+      δd = (K @ x_hat)[0]
+
+      def rhs(t, z):
+        return closed_loop_rhs(z, x_hat, δP)
+
+      # Only the implicit methods take the Jacobian; the explicit ones warn about it
+      solve_ivp_kwargs = {}
+      if implicit:
+        def jac(t, z):
+          J = np.zeros((len(z), len(z)))
+          J[:2, :2] = plant_jacobian(t, z[:2], (δd, δP))
+          if dynamic:
+            J[2, :2] = Ψ_SYM @ z[:2] + Ξ_SYM @ (x_hat - z[:2])
+            J[2, 2] = -etm.λ
+          return J
+        solve_ivp_kwargs['jac'] = jac
+
+      # Within the minimum inter-event time the trigger is not checked: the segment ends with
+      # the window and the next one checks the trigger at its start, as the analytic engine
+      # does. Each segment starts with the last step size of the previous one, which skips the
+      # initial step selection of solve_ivp at every event
+      segment_end = boundary if stop is None else min(boundary, t_current + max_segment)
+      guarded = t_current < guard_end
+      if guarded:
+        segment_end = min(segment_end, guard_end)
+      solution = solve_ivp(
+          rhs, (t_current, segment_end), z, method=solve_ivp_method,
+          events=None if guarded else trigger, dense_output=True, rtol=rtol, atol=atol,
+          first_step=None if first_step is None else min(first_step, segment_end - t_current),
+          **solve_ivp_kwargs)
+
+      if solution.status == -1:
+        raise RuntimeError(solution.message)
+      instrument.count('rhs_evaluations', solution.nfev)
+      instrument.count('jacobian_evaluations', solution.njev)
+
+      t_current = solution.t[-1]
+      z = solution.y[:, -1]
+      # The guard segments are too short to set the step size of the next one
+      if not guarded and solution.status == 0:
+        first_step = solution.t[-1] - solution.t[-2]
+      elif not guarded and len(solution.t) > 2:
+        first_step = solution.t[-2] - solution.t[-3]
+
+      last_index = np.searchsorted(timepts, t_current, side='right')
+      if last_index > index:
+        states = solution.sol(timepts[index:last_index])
+        output.write(index, np.vstack((states[:2], np.full(last_index - index, δd), states[2:])))
+        index = last_index
+
+      if solution.status == 1:
+        record_event(t_current, z, x_hat)
+        x_hat = z[:2].copy()
+        last_event = t_current
+
+      if stop is not None and index >= next_check:
+        next_check = index + check_interval
+        if stop.is_output_settled(output, index - 1, X_OP, max(last_event, last_breakpoint)):
+          return get_simulation_results(*output.result(index - 1, events, K), events, return_trace)
+
+  return get_simulation_results(*output.result(events=events, K=K), events, return_trace)
+
+
+def get_lifted_system(converter, etm, K):
+  """
+  Builds the closed loop of the linearized converter in the augmented state ξ = (x, x̂, δPcpl).
+
+  Between events the loop is LTI, ξ' = Fξ, and the triggering function is the quadratic form
+  Γ = ξᵀQξ. The transition matrix e^{Fτ} and the weighted integral
+  ∫ e^{-λ(τ-s)} e^{Fᵀs} Q e^{Fs} ds, which propagates the dynamic variable η exactly, are
+  obtained from a single Van Loan block exponential.
+
+  Parameters:
+                  converter: Instance of the linearized converter system.
+                  etm: Instance of the event-triggered mechanism (ETM).
+                  K (array): State feedback gain.
+
+  Returns:
+                  tuple: Matrix Q and a function transition(τ) returning e^{Fτ}, the matrix M of the
+                         increment ξᵀMξ of η over τ, and the decay e^{-λτ} of η (λ = 0 for the
+                         static ETM).
+  """
+  λ = etm.λ if isinstance(etm, DynamicETM) else 0.
+
+  A = np.asarray(converter.system.A)
+  B = np.asarray(converter.system.B)
+  K = np.atleast_2d(K)
+  Ψ = np.asarray(etm.Ψ)
+  Ξ = np.asarray(etm.Ξ)
+
+  F = np.zeros((5, 5))
+  F[:2, :2] = A
+  F[:2, 2:4] = B[:, :1] @ K
+  F[:2, 4] = B[:, 1]
+
+  Q = np.zeros((5, 5))
+  Q[:2, :2] = Ψ - Ξ
+  Q[:2, 2:4] = Ξ
+  Q[2:4, :2] = Ξ
+  Q[2:4, 2:4] = -Ξ
+  Q = (Q + Q.T) / 2
+
+  C = np.zeros((10, 10))
+  C[:5, :5] = -(F + λ / 2 * np.identity(5)).T
+  C[:5, 5:] = Q
+  C[5:, 5:] = F + λ / 2 * np.identity(5)
+
+  def transition(τ):
+    E = expm(C * τ)
+    Φ = np.exp(-λ * τ / 2) * E[5:, 5:]
+    M = np.exp(-λ * τ) * E[5:, 5:].T @ E[:5, 5:]
+    return Φ, (M + M.T) / 2, np.exp(-λ * τ)
+
+  return Q, transition
+
+
+def analytic_closed_loop_simulate(converter, etm, K, params, end_time,
+                                  perturbation_signal_data=None,
+                                  x0_factor=[1.5, 0.13], step=1e-5,
+                                  min_inter_event_time=1e-7, return_trace=False, stop=None,
+                                  recorder=None):
+  """
+  Simulate the closed loop of the linearized converter by exact propagation.
+
+  Between events the loop is LTI in the augmented state ξ = (x, x̂, δPcpl), ξ' = Fξ, and the
+  triggering function is the quadratic form Γ = ξᵀQξ. The transition matrix e^{Fh} and the
+  weighted integral ∫ e^{-λ(h-s)} e^{Fᵀs} Q e^{Fs} ds, which propagates η exactly, are
+  obtained from a single Van Loan block exponential precomputed for the grid step. A sign
+  change of the triggering condition between grid points is refined by bracketing, as are
+  the breakpoints of the CPL perturbation.
+
+  Parameters:
+                  converter: Instance of the linearized converter system.
+                  etm: Instance of the event-triggered mechanism (ETM).
+                  K (array): State feedback gain.
+                  params (dict): Dictionary of system parameters.
+                  end_time (float): End time of simulation.
+                  perturbation_signal_data (list): List of tuples representing perturbation signal data.
+                  x0_factor (list): Factor to multiply the initial state values to obtain the initial conditions.
+                  step (float): Time step of the output grid.
+                  min_inter_event_time (float): Minimum time between two events, used to exclude Zeno behavior.
+                  return_trace (bool): Append the EventTrace of the run to the results.
+                  stop (SteadyStateStop): Criterion to end the simulation once it has settled.
+                  recorder (OutputRecorder): How the outputs are stored. If None, every point of the grid.
+
+  Returns:
+                  tuple: A tuple containing the following arrays:
+                                  - t (array): Array of time points for simulation, up to the stop time.
+                                  - y (array): Array of system outputs for simulation.
+                                  - inter_event_times (array): Array of inter-event times for the ETM.
+                                  - event_times (array): Array of event times for the ETM.
+  """
+  if hasattr(converter, 'update'):
+    raise ValueError('The analytic method requires a linearized converter')
+
+  dynamic = isinstance(etm, DynamicETM)
+  θ = etm.θ if dynamic else 0.
+
+  K = np.atleast_2d(K)
+  Q, transition = get_lifted_system(converter, etm, K)
+
+  Φ_STEP, M_STEP, DECAY_STEP = transition(step)
+
+  def advance(ξ, η, τ):
+    Φ, M, decay = (Φ_STEP, M_STEP, DECAY_STEP) if τ == step else transition(τ)
+    return Φ @ ξ, decay * η + ξ @ M @ ξ
+
+  def trigger(ξ, η):
+    Γ = ξ @ Q @ ξ
+    return η + θ * Γ if dynamic else Γ
+
+  trigger = instrument.counted('gama_evaluations', trigger)
+
+  X_OP = np.array([params['op']['iL'], params['op']['vC']])
+  timepts = np.arange(0, end_time + step, step)
+
+  if perturbation_signal_data == None:
+    perturbation_signal_data = [(0., params['op']['Pcpl'])]
+  breakpoints = [(t, P - params['op']['Pcpl'])
+                 for t, P in perturbation_signal_data[1:] if 0. < t <= timepts[-1]]
+  breakpoints.append((np.inf, 0.))
+
+  x0 = np.array([x0_factor[0] * params['op']['iL'],
+                 x0_factor[1] * params['op']['vC']]) - X_OP
+  δP0 = make_square_signal(perturbation_signal_data)(0.) - params['op']['Pcpl']
+  ξ = np.concatenate((x0, x0, [δP0]))
+  η = 0.
+
+  rows = 4 if dynamic else 3
+  output = (recorder or OutputRecorder()).open(
+      timepts, (rows,), 1 if stop is None else stop.tail_length(step))
+  sample = np.zeros((rows, 1))
+
+  def write(i):
+    sample[:2, 0] = ξ[:2]
+    sample[2, 0] = K[0] @ ξ[2:4]
+    if dynamic:
+      sample[3, 0] = η
+    output.write(i, sample)
+
+  write(0)
+
+  events = EventTrace()
+  events.append(0., ξ[:2], 0., ξ @ Q @ ξ)
+  last_event = 0.
+  next_breakpoint = 0
+
+  if stop is not None:
+    last_breakpoint = get_last_breakpoint(perturbation_signal_data, timepts[-1])
+    check_interval = stop.check_interval(step)
+
+  for i in range(1, len(timepts)):
+    t = timepts[i - 1]
+    τ_left = step
+
+    while τ_left > 1e-12 * step:
+      τ = τ_left
+      t_breakpoint = breakpoints[next_breakpoint][0]
+      at_breakpoint = t_breakpoint <= t + τ_left
+      if at_breakpoint:
+        τ = max(t_breakpoint - t, 0.)
+
+      ξ_next, η_next = advance(ξ, η, τ)
+
+      if t + τ - last_event >= min_inter_event_time and trigger(ξ_next, η_next) < 0:
+        τ_low = max(last_event + min_inter_event_time - t, 0.)
+        if trigger(*advance(ξ, η, τ_low)) < 0:
+          τ_event = τ_low
+        else:
+          τ_event = brentq(lambda τ: trigger(*advance(ξ, η, τ)), τ_low, τ,
+                           xtol=1e-12 * step)
+        ξ, η = advance(ξ, η, τ_event)
+        t += τ_event
+        events.append(t, ξ[:2], np.linalg.norm(ξ[2:4] - ξ[:2]), ξ @ Q @ ξ,
+                      η if dynamic else 0.)
+        ξ[2:4] = ξ[:2]
+        τ_left -= τ_event
+        last_event = t
+        continue
+
+      ξ, η = ξ_next, η_next
+      t += τ
+      τ_left -= τ
+
+      if at_breakpoint:
+        ξ[4] = breakpoints[next_breakpoint][1]
+        next_breakpoint += 1
+
+    write(i)
+
+    if stop is not None and i % check_interval == 0 and \
+            stop.is_output_settled(output, i, X_OP, max(last_event, last_breakpoint)):
+      return get_simulation_results(*output.result(i, events, K), events, return_trace)
+
+  return get_simulation_results(*output.result(events=events, K=K), events, return_trace)
+
+
+def periodic_closed_loop_simulate(converter, etm, K, params, end_time,
+                                  perturbation_signal_data=None,
+                                  x0_factor=[1.5, 0.13], step=1e-5, period=None,
+                                  return_trace=False, stop=None, recorder=None):
+  """
+  Simulate the closed loop under periodic event-triggered control.
+
+  The triggering condition is only checked at the sampling instants, every `period` seconds,
+  as in a digital implementation, so the events fall on the sampling grid and x̂ is held
+  between them. With the dynamic ETM, η still follows η' = -λη + Γ between the samples. The
+  CPL perturbation is sampled on the output grid.
+
+  For the linearized converter the loop is a discrete-time recurrence on the augmented state
+  ξ = (x, x̂, δPcpl): the powers Φʲ of Φ = e^{F·step} and the matrices Mʲ of the increments of
+  η over j steps (see `get_lifted_system`) are precomputed for the steps of one period, so a
+  whole period is advanced by one stacked product. For the shifted non-linear converter the
+  loop is integrated between samples by a fixed-step RK4 integrator on the output grid, with
+  the kernel from `compile_closed_loop`.
+
+  Parameters:
+                  converter: Instance of the converter system (shifted non-linear or linearized).
+                  etm: Instance of the event-triggered mechanism (ETM).
+                  K (array): State feedback gain.
+                  params (dict): Dictionary of system parameters.
+                  end_time (float): End time of simulation.
+                  perturbation_signal_data (list): List of tuples representing perturbation signal data.
+                  x0_factor (list): Factor to multiply the initial state values to obtain the initial conditions.
+                  step (float): Time step of the output grid and of the integrator.
+                  period (float): Sampling period of the triggering condition, a multiple of the
+                                  step. If None, the step.
+                  return_trace (bool): Append the EventTrace of the run to the results.
+                  stop (SteadyStateStop): Criterion to end the simulation once it has settled.
+                  recorder (OutputRecorder): How the outputs are stored. If None, every point of the grid.
+
+  Returns:
+                  tuple: A tuple containing the following arrays:
+                                  - t (array): Array of time points for simulation, up to the stop time.
+                                  - y (array): Array of system outputs for simulation.
+                                  - inter_event_times (array): Array of inter-event times for the ETM.
+                                  - event_times (array): Array of event times for the ETM.
+  """
+  period = step if period is None else period
+  ratio = int(round(period / step))
+  if ratio < 1 or not np.isclose(ratio * step, period, rtol=1e-9, atol=0.):
+    raise ValueError('The sampling period must be a multiple of the step')
+
+  dynamic = isinstance(etm, DynamicETM)
+  K = np.atleast_2d(K)
+
+  X_OP = np.array([params['op']['iL'], params['op']['vC']])
+  timepts = np.arange(0, end_time + step, step)
+
+  x0 = np.array([x0_factor[0] * params['op']['iL'],
+                 x0_factor[1] * params['op']['vC']]) - X_OP
+
+  if perturbation_signal_data == None:
+    perturbation_signal_data = [(0., params['op']['Pcpl'])]
+  δP = generate_square_signal(timepts, perturbation_signal_data) - params['op']['Pcpl']
+
+  if hasattr(converter, 'update'):
+    rhs, _ = compile_closed_loop(converter, etm, K, params)
+
+    def advance(z, x_hat, start, count):
+      states = np.empty((count, len(z)))
+      for j in range(count):
+        P = δP[start + j]
+        k1 = rhs(z, x_hat, P)
+        k2 = rhs(z + step / 2 * k1, x_hat, P)
+        k3 = rhs(z + step / 2 * k2, x_hat, P)
+        k4 = rhs(z + step * k3, x_hat, P)
+        z = z + step / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        states[j] = z
+      instrument.count('rhs_evaluations', 4 * count)
+      return states
+  else:
+    Q, transition = get_lifted_system(converter, etm, K)
+    Φ, M, decay = transition(step)
+
+    Φ_POWERS = np.empty((ratio, 5, 5))
+    M_SUMS = np.empty((ratio, 5, 5))
+    DECAYS = decay ** np.arange(1, ratio + 1)
+    power, total = np.identity(5), np.zeros((5, 5))
+    for j in range(ratio):
+      total = decay * total + power.T @ M @ power
+      power = Φ @ power
+      Φ_POWERS[j], M_SUMS[j] = power, total
+
+    def advance(z, x_hat, start, count):
+      states = np.empty((count, len(z)))
+      done = 0
+      while done < count:
+        k = start + done
+        run = count - done
+        changes = np.flatnonzero(δP[k + 1:k + run] != δP[k])
+        if len(changes):
+          run = changes[0] + 1
+
+        ξ = np.concatenate((z[:2], x_hat, [δP[k]]))
+        states[done:done + run, :2] = (Φ_POWERS[:run] @ ξ)[:, :2]
+        if dynamic:
+          states[done:done + run, 2] = DECAYS[:run] * z[2] + \
+              np.einsum('i,jik,k->j', ξ, M_SUMS[:run], ξ)
+        z = states[done + run - 1]
+        done += run
+      return states
+
+  rows = 4 if dynamic else 3
+  output = (recorder or OutputRecorder()).open(
+      timepts, (rows,), 1 if stop is None else stop.tail_length(step))
+
+  z = np.append(x0, 0.) if dynamic else x0.copy()
+  x_hat = x0.copy()
+  output.write(0, np.concatenate((x0, K @ x_hat, z[2:]))[:, None])
+
+  events = EventTrace()
+  events.append(0., x_hat, 0., etm.get_gama(x_hat, x_hat))
+  last_event = 0.
+  index = 0
+
+  if stop is not None:
+    last_breakpoint = get_last_breakpoint(perturbation_signal_data, timepts[-1])
+    check_interval = stop.check_interval(step)
+    next_check = check_interval
+
+  while index < len(timepts) - 1:
+    count = min(ratio, len(timepts) - 1 - index)
+    states = advance(z, x_hat, index, count)
+    z = states[-1].copy()
+
+    block = np.empty((rows, count))
+    block[:2] = states[:, :2].T
+    block[2] = (K @ x_hat)[0]
+    if dynamic:
+      block[3] = states[:, 2]
+    index += count
+
+    if count == ratio and etm.get_trigger_value(z[:2], x_hat, z[2] if dynamic else None) < 0:
+      events.append(timepts[index], z[:2], np.linalg.norm(x_hat - z[:2]),
+                    etm.get_gama(z[:2], x_hat), z[2] if dynamic else 0.)
+      x_hat = z[:2].copy()
+      last_event = timepts[index]
+      block[2, -1] = (K @ x_hat)[0]
+
+    output.write(index - count + 1, block)
+
+    if stop is not None and index >= next_check:
+      next_check = index + check_interval
+      if stop.is_output_settled(output, index, X_OP, max(last_event, last_breakpoint)):
+        return get_simulation_results(*output.result(index, events, K), events, return_trace)
+
+  return get_simulation_results(*output.result(events=events, K=K), events, return_trace)
+
+
+class FuzzyModel:
+  """
+  Class to represent a Takagi–Sugeno (T–S) fuzzy model ẋ = Σᵢ wᵢ(x) (Aᵢ x + Bᵢ u).
+
+  The memberships are quadratic in the states, wᵢ(x) = cᵢ + xᵀ Qᵢ x, as in the sector
+  non-linearity models of polynomial plants. The premise matrices Qᵢ are flattened into one
+  (n², r) matrix and the rule matrices [Aᵢ Bᵢ] into one (r·n, n + m) matrix, so the memberships
+  and the dynamics of every rule and every lane are one matrix product each.
+
+  Parameters:
+                  A (array): State matrices of the rules, shape (r, n, n).
+                  B (array): Input matrices of the rules, shape (r, n, m).
+                  offsets (array): Constant terms cᵢ of the memberships, shape (r,).
+                  premises (array): Premise matrices Qᵢ of the memberships, shape (r, n, n).
+  """
+
+  def __init__(self, A, B, offsets, premises):
+    self.A = np.asarray(A, dtype=float)
+    self.B = np.asarray(B, dtype=float)
+    self.rules, self.n_states, self.n_inputs = self.B.shape
+    self.offsets = np.asarray(offsets, dtype=float).reshape(self.rules)
+    premises = np.asarray(premises, dtype=float).reshape(self.rules, self.n_states, self.n_states)
+    self.premises = (premises + premises.transpose(0, 2, 1)) / 2
+    self.premise_matrix = self.premises.reshape(self.rules, -1).T
+    self.rule_matrix = np.concatenate((self.A, self.B), axis=2).reshape(self.rules * self.n_states, -1)
+
+  @classmethod
+  def van_der_pol(cls, r0=5.):
+    """
+    Two-rule model of the Van der Pol oscillator ẍ₁ - (1 - x₁²) ẋ₁ + x₁ = u on |x₁| ≤ r0.
+
+    Parameters:
+                    r0 (float): Bound on x₁ of the sector.
+
+    Returns:
+                    FuzzyModel: Model with w₀ = (r0² - x₁²) / r0² and w₁ = 1 - w₀.
+    """
+    A = [[[0., 1.], [-1., 1.]], [[0., 1.], [-1., 1. - r0 ** 2]]]
+    B = [[[0.], [1.]], [[0.], [1.]]]
+    Q = np.zeros((2, 2, 2))
+    Q[0, 0, 0], Q[1, 0, 0] = -1. / r0 ** 2, 1. / r0 ** 2
+    return cls(A, B, [1., 0.], Q)
+
+  def memberships(self, X):
+    """
+    Calculates the memberships of the rules.
+
+    Parameters:
+                    X (array): States, shape (n,) or (N, n).
+
+    Returns:
+                    array: Memberships, shape (r,) or (N, r).
+    """
+    X = np.asarray(X, dtype=float)
+    outer = (X[..., :, None] * X[..., None, :]).reshape(X.shape[:-1] + (-1,))
+    return self.offsets + outer @ self.premise_matrix
+
+  def blend(self, W, matrices):
+    """
+    Calculates the weighted sum Σᵢ wᵢ Mᵢ of stacked rule matrices.
+
+    Parameters:
+                    W (array): Memberships, shape (r,) or (N, r).
+                    matrices (array): Rule matrices, shape (r, p, q).
+
+    Returns:
+                    array: Blended matrices, shape (p, q) or (N, p, q).
+    """
+    return np.tensordot(W, matrices, axes=1)
+
+  def update(self, X, U, W=None):
+    """
+    Calculates the state derivative Σᵢ wᵢ(x) (Aᵢ x + Bᵢ u).
+
+    Parameters:
+                    X (array): States, shape (n,) or (N, n).
+                    U (array): Inputs, shape (m,) or (N, m).
+                    W (array): Memberships at X, if already known.
+
+    Returns:
+                    array: State derivatives, shape (n,) or (N, n).
+    """
+    W = self.memberships(X) if W is None else W
+    Z = np.concatenate((X, U), axis=-1)
+    rules = (Z @ self.rule_matrix.T).reshape(Z.shape[:-1] + (self.rules, self.n_states))
+    return (W[..., None, :] @ rules)[..., 0, :]
+
+
+class FuzzyETM:
+  """
+  Class to represent an Event-Triggered Mechanism (ETM) of a T–S fuzzy model under the
+  parallel distributed compensation u = Σⱼ wⱼ(x̂) Kⱼ x̂.
+
+  Γ = xᵀΨx - eᵀΞe - ζ, with e = x̂ - x and the cross-term ζ = 2 xᵀ P B(x) (K(x̂) - K(x)) x̂
+  from the mismatch between the memberships at the sent and at the current states. The
+  static ETM triggers when Γ < 0. With θ and λ, the dynamic ETM follows η' = -λη + Γ and
+  triggers when η + θΓ < 0. The gains Kᵢ and the products P Bᵢ of all rules are stacked once
+  into (n, r·m) matrices, so Kᵢ x̂ and xᵀ P Bᵢ are one matrix product for every rule, and every
+  method works on one state or on a batch of lanes stacked along the first axis.
+
+  Parameters:
+                  name (str): Name of the ETM.
+                  model (FuzzyModel): T–S fuzzy model of the plant.
+                  K (array): State feedback gains of the rules, shape (r, m, n) or (r, n).
+                  Ψ (array): Ψ matrix for the calculation of Γ.
+                  Ξ (array): Ξ matrix for the calculation of Γ.
+                  P (array): Lyapunov matrix of the design, for the calculation of ζ.
+                  θ (float): Threshold parameter of the dynamic ETM. None for the static ETM.
+                  λ (float): Decay rate of the dynamic ETM. None for the static ETM.
+  """
+
+  def __init__(self, name, model, K, Ψ, Ξ, P, θ=None, λ=None):
+    if (θ is None) != (λ is None):
+      raise ValueError('θ and λ must both be given for the dynamic ETM, or both be None for '
+                       'the static ETM')
+    self.name = name
+    self.model = model
+    self.K = np.asarray(K, dtype=float).reshape(model.rules, model.n_inputs, model.n_states)
+    self.Ψ = np.asarray(Ψ, dtype=float)
+    self.Ξ = np.asarray(Ξ, dtype=float)
+    self.P = np.asarray(P, dtype=float)
+    self.PB = self.P @ model.B
+    self.gain_matrix = self.K.reshape(-1, model.n_states).T
+    self.coupling_matrix = self.PB.transpose(1, 0, 2).reshape(model.n_states, -1)
+    self.θ = θ
+    self.λ = λ
+
+  @property
+  def dynamic(self):
+    return self.λ is not None
+
+  def gains(self, W):
+    """
+    Calculates the blended gain K(w) = Σⱼ wⱼ Kⱼ.
+
+    Parameters:
+                    W (array): Memberships, shape (r,) or (N, r).
+
+    Returns:
+                    array: Gains, shape (m, n) or (N, m, n).
+    """
+    return self.model.blend(W, self.K)
+
+  def control(self, X_hat, W_hat=None):
+    """
+    Calculates the control signal u = K(x̂) x̂.
+
+    Parameters:
+                    X_hat (array): Last sent states, shape (n,) or (N, n).
+                    W_hat (array): Memberships at X_hat, if already known.
+
+    Returns:
+                    array: Control signals, shape (m,) or (N, m).
+    """
+    W_hat = self.model.memberships(X_hat) if W_hat is None else W_hat
+    return (W_hat[..., None, :] @ self.per_rule(X_hat, self.gain_matrix))[..., 0, :]
+
+  def per_rule(self, X, matrix):
+    """
+    Calculates the products of the states with a stacked (n, r·m) matrix, rule by rule.
+
+    Parameters:
+                    X (array): States, shape (n,) or (N, n).
+                    matrix (array): Stacked matrix, `gain_matrix` (Kᵢ x) or `coupling_matrix` (xᵀ P Bᵢ).
+
+    Returns:
+                    array: Products, shape (r, m) or (N, r, m).
+    """
+    return (X @ matrix).reshape(np.shape(X)[:-1] + (self.model.rules, self.model.n_inputs))
+
+  def get_gama(self, current_states, last_states_sent, W=None, W_hat=None):
+    """
+    Calculates the value of Γ based on the current states and the last sent states.
+
+    Parameters:
+                    current_states (array): Current states, shape (n,) or (N, n).
+                    last_states_sent (array): Last sent states, shape (n,) or (N, n).
+                    W (array): Memberships at the current states, if already known.
+                    W_hat (array): Memberships at the last sent states, if already known.
+
+    Returns:
+                    float or array: Value of Γ, shape () or (N,).
+    """
+    instrument.count('gama_evaluations')
+    X, X_hat = current_states, last_states_sent
+    W = self.model.memberships(X) if W is None else W
+    W_hat = self.model.memberships(X_hat) if W_hat is None else W_hat
+    error = X_hat - X
+
+    mismatch = (W_hat - W)[..., None, :] @ self.per_rule(X_hat, self.gain_matrix)
+    xPB = W[..., None, :] @ self.per_rule(X, self.coupling_matrix)
+    ζ = 2 * np.einsum('...m,...m->...', xPB[..., 0, :], mismatch[..., 0, :])
+
+    return np.einsum('...i,ij,...j->...', X, self.Ψ, X) - \
+        np.einsum('...i,ij,...j->...', error, self.Ξ, error) - ζ
+
+  def get_trigger_value(self, current_states, last_states_sent, n=None, W=None, W_hat=None):
+    """
+    Calculates the triggering condition, Γ for the static ETM and η + θΓ for the dynamic ETM.
+    An event occurs when it becomes negative.
+
+    Parameters:
+                    current_states (array): Current states, shape (n,) or (N, n).
+                    last_states_sent (array): Last sent states, shape (n,) or (N, n).
+                    n (float or array): Current value of the dynamic variable η (dynamic ETM only).
+                    W (array): Memberships at the current states, if already known.
+                    W_hat (array): Memberships at the last sent states, if already known.
+
+    Returns:
+                    float or array: Value of the triggering condition.
+    """
+    Γ = self.get_gama(current_states, last_states_sent, W, W_hat)
+    return n + self.θ * Γ if self.dynamic else Γ
+
+
+def fuzzy_closed_loop_simulate(etm, end_time, x0, step=1e-4, recorder=None):
+  """
+  Simulate N closed loops of a T–S fuzzy model under a fuzzy ETM in lockstep.
+
+  The states of all lanes are advanced together by a fixed-step RK4 integrator with the sent
+  states held over the step, and the triggering condition is checked for every lane at each
+  grid point, as in `batch.batch_closed_loop_simulate`. The memberships at the sent states and
+  the control signals only change at the events, so they are updated for the lanes that fired;
+  the memberships at the current states are evaluated once per stage and shared by the plant
+  and Γ.
+
+  Parameters:
+                  etm (FuzzyETM): Fuzzy ETM, holding the T–S model of the plant.
+                  end_time (float): End time of simulation.
+                  x0 (array): Initial states, shape (n,) or (N, n).
+                  step (float): Time step for simulation.
+                  recorder (OutputRecorder): How the outputs are stored. If None, every point of the grid.
+                                             Event samples are not supported, as the lanes have
+                                             different event instants.
+
+  Returns:
+                  tuple: A tuple containing the following arrays:
+                                  - t (array): Array of time points for simulation.
+                                  - y (array): States, control signals and η (dynamic ETM only) of
+                                               every lane, shape (N, n + m (+ 1), T).
+                                  - inter_event_times (list): Inter-event times for each lane.
+                                  - event_times (list): Event times for each lane.
+  """
+  if recorder is not None and recorder.events:
+    raise ValueError('The batched simulation does not support event samples in the outputs')
+
+  model = etm.model
+  n, m = model.n_states, model.n_inputs
+  dynamic = etm.dynamic
+
+  X = np.atleast_2d(np.asarray(x0, dtype=float)).reshape(-1, n)
+  N = len(X)
+  timepts = np.arange(0, end_time + step, step)
+
+  def rhs(Z, X_hat, W_hat, U):
+    W = model.memberships(Z[:, :n])
+    dX = model.update(Z[:, :n], U, W)
+    if dynamic:
+      dn = -etm.λ * Z[:, n] + etm.get_gama(Z[:, :n], X_hat, W, W_hat)
+      return np.column_stack((dX, dn))
+    return dX
+
+  Z = np.column_stack((X, np.zeros(N))) if dynamic else X.copy()
+  X_hat = X.copy()
+  W_hat = model.memberships(X_hat)
+  U = etm.control(X_hat, W_hat)
+
+  rows = n + m + (1 if dynamic else 0)
+  output = (recorder or OutputRecorder()).open(
+      timepts, (N, rows))
+  sample = np.empty((N, rows, 1))
+  event_lanes, event_steps = [np.arange(N)], [np.zeros(N, dtype=int)]
+
+  for k in range(len(timepts)):
+    sample[:, :n, 0] = Z[:, :n]
+    sample[:, n:n + m, 0] = U
+    if dynamic:
+      sample[:, -1, 0] = Z[:, n]
+    output.write(k, sample)
+
+    if k == len(timepts) - 1:
+      break
+
+    k1 = rhs(Z, X_hat, W_hat, U)
+    k2 = rhs(Z + step / 2 * k1, X_hat, W_hat, U)
+    k3 = rhs(Z + step / 2 * k2, X_hat, W_hat, U)
+    k4 = rhs(Z + step * k3, X_hat, W_hat, U)
+    Z = Z + step / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+    trigger = etm.get_trigger_value(Z[:, :n], X_hat, Z[:, n] if dynamic else None, W_hat=W_hat)
+
+    fired = trigger < 0
+    if fired.any():
+      X_hat[fired] = Z[fired, :n]
+      W_hat[fired] = model.memberships(X_hat[fired])
+      U[fired] = etm.control(X_hat[fired], W_hat[fired])
+      event_lanes.append(np.flatnonzero(fired))
+      event_steps.append(np.full(len(event_lanes[-1]), k + 1))
+
+  lanes = np.concatenate(event_lanes)
+  steps = np.concatenate(event_steps)[np.argsort(lanes, kind='stable')]
+  event_times = np.split(timepts[steps], np.cumsum(np.bincount(lanes, minlength=N))[:-1])
+  inter_event_times = [np.concatenate(([0.], np.diff(et))) for et in event_times]
+
+  t, y = output.result(k)
+
+  return t, y, inter_event_times, event_times
@@ -0,0 +1,355 @@
+import json
+import time
+import logging
+import contextlib
+
+PREFIX = 'etc'
+
+COUNTERS = {
+    'rhs_evaluations': 'Evaluations of the right-hand side of the integrated systems',
+    'jacobian_evaluations': 'Evaluations of the Jacobian by the implicit integrators',
+    'etm_output_calls': 'Calls of the output functions of the ETM blocks',
+    'gama_evaluations': 'Evaluations of the triggering function Γ',
+    'events': 'Records appended to the event traces',
+    'figures': 'Figures rendered',
+}
+
+SPANS = {
+    'stage': 'Wall time of the pipeline stages',
+    'design': 'Wall time of the solves of the design problem',
+    'design_canonicalization': 'Time cvxpy spent compiling the design problem for the solver',
+    'design_solver': 'Time the solver reported for the design problem',
+    'integration': 'Wall time of the simulations',
+    'plotting': 'Wall time of the figures, from the data to the saved files',
+    'figure_save': 'Time spent drawing and writing the figure files',
+}
+
+# Progress messages of the pipeline and the drivers. They are shown once `configure_logging` is
+# called, as the drivers do, and follow the level of the standard logging configuration.
+log = logging.getLogger(PREFIX)
+
+enabled_flag = False
+counters = {}
+spans = {}
+current_labels = {}
+current_key = ()
+
+
+def configure_logging(level=logging.INFO):
+  """
+  Writes the progress messages to the standard error, one line per message.
+
+  Parameters:
+                  level (int or str): Lowest level of the messages shown.
+  """
+  logging.basicConfig(format='%(message)s', level=level)
+
+
+def enabled():
+  """
+  Returns whether the instrumentation is enabled in the current process.
+  """
+  return enabled_flag
+
+
+def enable(flag=True):
+  """
+  Enables or disables the instrumentation in the current process.
+
+  Worker processes started by `sweep.SweepExecutor` and `pipeline.Pipeline` follow the main
+  process and send their metrics back with their results.
+
+  Parameters:
+                  flag (bool): Whether the counters and spans are recorded.
+  """
+  global enabled_flag
+  enabled_flag = flag
+
+
+def reset():
+  """
+  Discards the metrics recorded in the current process.
+  """
+  counters.clear()
+  spans.clear()
+
+
+def labels_key(values):
+  return tuple(sorted((name, str(value)) for name, value in values.items()))
+
+
+@contextlib.contextmanager
+def labels(**values):
+  """
+  Context in which the recorded metrics carry the given labels, such as the scenario and the
+  stage, in addition to the labels of the enclosing contexts.
+
+  Parameters:
+                  **values: Label values, by name.
+  """
+  global current_labels, current_key
+  previous = current_labels, current_key
+  current_labels = {**current_labels, **values}
+  current_key = labels_key(current_labels)
+  try:
+    yield
+  finally:
+    current_labels, current_key = previous
+
+
+def count(name, n=1):
+  """
+  Increments a counter. Does nothing when the instrumentation is disabled, so it can be called
+  from the hot paths.
+
+  Parameters:
+                  name (str): Name of the counter (see `COUNTERS`).
+                  n (int): Increment.
+  """
+  if enabled_flag:
+    key = (name, current_key)
+    counters[key] = counters.get(key, 0) + n
+
+
+def counted(name, function):
+  """
+  Wraps a function so each call increments a counter.
+
+  Parameters:
+                  name (str): Name of the counter.
+                  function (callable): Function to wrap.
+
+  Returns:
+                  callable: The wrapper, or the function itself when the instrumentation is
+                            disabled, so uninstrumented runs pay nothing.
+  """
+  if not enabled_flag:
+    return function
+
+  def wrapper(*args, **kwargs):
+    key = (name, current_key)
+    counters[key] = counters.get(key, 0) + 1
+    return function(*args, **kwargs)
+
+  return wrapper
+
+
+def observe(name, seconds, **values):
+  """
+  Adds a duration to a span.
+
+  Parameters:
+                  name (str): Name of the span (see `SPANS`).
+                  seconds (float): Duration.
+                  **values: Labels of this observation, in addition to the current ones.
+  """
+  if not enabled_flag or seconds is None:
+    return
+  key = (name, labels_key({**current_labels, **values}) if values else current_key)
+  entry = spans.get(key)
+  if entry is None:
+    spans[key] = [1, seconds, seconds, seconds]
+  else:
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] = min(entry[2], seconds)
+    entry[3] = max(entry[3], seconds)
+
+
+@contextlib.contextmanager
+def span(name, **values):
+  """
+  Context whose wall time is added to a span.
+
+  Parameters:
+                  name (str): Name of the span (see `SPANS`).
+                  **values: Labels of this observation, in addition to the current ones.
+  """
+  if not enabled_flag:
+    yield
+    return
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe(name, time.perf_counter() - start, **values)
+
+
+def snapshot():
+  """
+  Returns the metrics recorded in the current process.
+
+  Returns:
+                  tuple: Counters and spans, as picklable dictionaries.
+  """
+  return dict(counters), {key: list(entry) for key, entry in spans.items()}
+
+
+def drain():
+  """
+  Returns the metrics recorded in the current process and discards them.
+
+  Returns:
+                  tuple: Counters and spans (see `snapshot`), or None if the instrumentation is
+                         disabled.
+  """
+  if not enabled_flag:
+    return None
+  metrics = snapshot()
+  reset()
+  return metrics
+
+
+def merge(metrics):
+  """
+  Adds the metrics recorded in another process to the ones of the current process.
+
+  Parameters:
+                  metrics (tuple): Counters and spans (see `drain`), or None.
+  """
+  if metrics is None:
+    return
+  other_counters, other_spans = metrics
+  for key, value in other_counters.items():
+    counters[key] = counters.get(key, 0) + value
+  for key, (n, total, low, high) in other_spans.items():
+    entry = spans.get(key)
+    if entry is None:
+      spans[key] = [n, total, low, high]
+    else:
+      entry[0] += n
+      entry[1] += total
+      entry[2] = min(entry[2], low)
+      entry[3] = max(entry[3], high)
+
+
+def context():
+  """
+  Returns what a worker process needs to record metrics like the current process.
+
+  Returns:
+                  dict: Current labels, or None if the instrumentation is disabled.
+  """
+  return dict(current_labels) if enabled_flag else None
+
+
+def collect(function, worker_labels, *args):
+  """
+  Calls a function in a worker process and returns its result with the metrics it recorded.
+
+  Workers are reused and may be forked with the metrics of their parent, so the metrics are
+  discarded before the call.
+
+  Parameters:
+                  function (callable): Function to call.
+                  worker_labels (dict): Labels from `context` in the main process, or None if
+                                        the instrumentation is disabled.
+                  *args: Arguments of the function.
+
+  Returns:
+                  tuple: Result of the function and metrics for `merge`.
+  """
+  enable(worker_labels is not None)
+  if worker_labels is None:
+    return function(*args), None
+  reset()
+  with labels(**worker_labels):
+    result = function(*args)
+  return result, drain()
+
+
+def report():
+  """
+  Builds the report of the metrics recorded in the current process.
+
+  Besides every series, the report has the totals of each metric and the totals of each
+  metric by scenario, for the series labelled with one.
+
+  Returns:
+                  dict: JSON-serializable report.
+  """
+  counter_rows = [{'name': name, 'labels': dict(key), 'value': value}
+                  for (name, key), value in sorted(counters.items())]
+  span_rows = [{'name': name, 'labels': dict(key), 'count': n, 'total': total,
+                'mean': total / n, 'min': low, 'max': high}
+               for (name, key), (n, total, low, high) in sorted(spans.items())]
+
+  totals = {'counters': {}, 'spans': {}}
+  scenarios = {}
+  for row in counter_rows:
+    totals['counters'][row['name']] = totals['counters'].get(row['name'], 0) + row['value']
+    if 'scenario' in row['labels']:
+      scenario = scenarios.setdefault(row['labels']['scenario'], {'counters': {}, 'spans': {}})
+      scenario['counters'][row['name']] = scenario['counters'].get(row['name'], 0) + row['value']
+  for row in span_rows:
+    totals['spans'][row['name']] = totals['spans'].get(row['name'], 0.) + row['total']
+    if 'scenario' in row['labels']:
+      scenario = scenarios.setdefault(row['labels']['scenario'], {'counters': {}, 'spans': {}})
+      scenario['spans'][row['name']] = scenario['spans'].get(row['name'], 0.) + row['total']
+
+  return {'created': time.time(), 'counters': counter_rows, 'spans': span_rows,
+          'totals': totals, 'scenarios': scenarios}
+
+
+def write_json(file_name):
+  """
+  Writes the report of the metrics to a JSON file.
+
+  Parameters:
+                  file_name (str): Path of the file.
+  """
+  with open(file_name, 'w') as file:
+    json.dump(report(), file, indent=2, ensure_ascii=False)
+
+
+def prometheus_labels(key):
+  if not key:
+    return ''
+  return '{' + ','.join(
+      f'{name}="{escape_label(value)}"' for name, value in key) + '}'
+
+
+def escape_label(value):
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text():
+  """
+  Formats the metrics in the Prometheus text exposition format.
+
+  Counters are exported as `etc_<name>_total` and spans as summaries `etc_<name>_seconds`,
+  with their sum and count, plus a gauge `etc_<name>_seconds_max`.
+
+  Returns:
+                  str: Metrics, one series per line.
+  """
+  lines = []
+  for name in sorted({name for name, _ in counters}):
+    metric = f'{PREFIX}_{name}_total'
+    lines += [f'# HELP {metric} {COUNTERS.get(name, name)}', f'# TYPE {metric} counter']
+    lines += [f'{metric}{prometheus_labels(key)} {value}'
+              for (other, key), value in sorted(counters.items()) if other == name]
+
+  for name in sorted({name for name, _ in spans}):
+    metric = f'{PREFIX}_{name}_seconds'
+    lines += [f'# HELP {metric} {SPANS.get(name, name)}', f'# TYPE {metric} summary']
+    series = [(key, entry) for (other, key), entry in sorted(spans.items()) if other == name]
+    for key, (n, total, _, _) in series:
+      lines += [f'{metric}_sum{prometheus_labels(key)} {total!r}',
+                f'{metric}_count{prometheus_labels(key)} {n}']
+    lines += [f'# HELP {metric}_max Longest observation of {name}', f'# TYPE {metric}_max gauge']
+    lines += [f'{metric}_max{prometheus_labels(key)} {high!r}' for key, (*_, high) in series]
+
+  return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(file_name):
+  """
+  Writes the metrics to a file in the Prometheus text exposition format, for example for the
+  textfile collector of the node exporter.
+
+  Parameters:
+                  file_name (str): Path of the file.
+  """
+  with open(file_name, 'w') as file:
+    file.write(prometheus_text())
@@ -0,0 +1,228 @@
+import numpy as np
+
+IET_PERCENTILES = (5, 50, 95)
+
+
+def as_lanes(signals):
+  """
+  Converts a trajectory or a stack of trajectories to a 2-D array of lanes.
+
+  Parameters:
+                  signals (array): Trajectory of shape (T,) or stacked trajectories of shape (N, T).
+
+  Returns:
+                  array: Trajectories of shape (N, T).
+  """
+  signals = np.asarray(signals, dtype=float)
+  return signals.reshape(1, -1) if signals.ndim == 1 else signals
+
+
+def settling_time(signals, timepts, band=0.02, final_values=None):
+  """
+  Calculates the settling time of every lane.
+
+  The settling time is the last time at which the signal is outside a band of ±band·|final
+  value| around the final value. Lanes that never leave the band settle at timepts[0].
+
+  Parameters:
+                  signals (array): Trajectories of shape (T,) or (N, T).
+                  timepts (array): Time points of the trajectories.
+                  band (float): Relative half-width of the settling band.
+                  final_values (array): Final value of each lane. If None, the last sample is used.
+
+  Returns:
+                  array: Settling times, shape (N,).
+  """
+  signals = as_lanes(signals)
+  timepts = np.asarray(timepts, dtype=float)
+
+  if final_values is None:
+    final_values = signals[:, -1]
+  final_values = np.broadcast_to(np.asarray(final_values, dtype=float), (len(signals),))
+
+  outside = np.abs(signals - final_values[:, None]) >= band * np.abs(final_values)[:, None]
+  last_outside = signals.shape[1] - 1 - np.argmax(outside[:, ::-1], axis=1)
+
+  return np.where(outside.any(axis=1), timepts[last_outside], timepts[0])
+
+
+def overshoot(signals, final_values=None):
+  """
+  Calculates the percent overshoot of every lane.
+
+  The overshoot is the largest excursion beyond the final value, in the direction of the
+  transient, relative to the distance between the initial and the final values.
+
+  Parameters:
+                  signals (array): Trajectories of shape (T,) or (N, T).
+                  final_values (array): Final value of each lane. If None, the last sample is used.
+
+  Returns:
+                  array: Overshoot in percent, shape (N,). NaN for lanes without a transient.
+  """
+  signals = as_lanes(signals)
+
+  if final_values is None:
+    final_values = signals[:, -1]
+  final_values = np.broadcast_to(np.asarray(final_values, dtype=float), (len(signals),))
+
+  transient = final_values - signals[:, 0]
+  direction = np.sign(transient)
+  peak = np.max(direction[:, None] * (signals - final_values[:, None]), axis=1)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.where(transient != 0, 100 * np.maximum(peak, 0) / np.abs(transient), np.nan)
+
+
+def integral_squared_error(errors, timepts):
+  """
+  Calculates the integral of the squared error (ISE) of every lane.
+
+  Parameters:
+                  errors (array): Errors of shape (T,) or (N, T).
+                  timepts (array): Time points of the errors.
+
+  Returns:
+                  array: ISE, shape (N,).
+  """
+  return np.trapz(as_lanes(errors) ** 2, timepts, axis=1)
+
+
+def integral_absolute_error(errors, timepts):
+  """
+  Calculates the integral of the absolute error (IAE) of every lane.
+
+  Parameters:
+                  errors (array): Errors of shape (T,) or (N, T).
+                  timepts (array): Time points of the errors.
+
+  Returns:
+                  array: IAE, shape (N,).
+  """
+  return np.trapz(np.abs(as_lanes(errors)), timepts, axis=1)
+
+
+def control_effort(inputs, timepts):
+  """
+  Calculates the control effort ∫u² dt of every lane.
+
+  Parameters:
+                  inputs (array): Control inputs of shape (T,) or (N, T).
+                  timepts (array): Time points of the inputs.
+
+  Returns:
+                  array: Control effort, shape (N,).
+  """
+  return integral_squared_error(inputs, timepts)
+
+
+def iet_statistics(inter_event_times, percentiles=IET_PERCENTILES):
+  """
+  Calculates statistics of the inter-event times of every lane.
+
+  The lanes may hold different numbers of events. The leading zero returned by the simulators
+  for the initial transmission is excluded. All lanes are reduced together: the values are
+  concatenated, sorted by lane and value, and the percentiles are interpolated linearly
+  between the order statistics of each lane.
+
+  Parameters:
+                  inter_event_times (list): Inter-event times of each lane, or a single array.
+                  percentiles (tuple): Percentiles to calculate, between 0 and 100.
+
+  Returns:
+                  dict: Arrays of shape (N,) with keys 'iet_count', 'iet_mean', 'iet_min',
+                        'iet_max' and 'iet_p<percentile>'. NaN for lanes without events.
+  """
+  if len(inter_event_times) and np.ndim(inter_event_times[0]) == 0:
+    inter_event_times = [inter_event_times]
+
+  lanes = [np.asarray(iet, dtype=float)[1:] for iet in inter_event_times]
+  counts = np.array([len(iet) for iet in lanes], dtype=int)
+  values = np.concatenate(lanes) if lanes else np.empty(0)
+  lane_ids = np.repeat(np.arange(len(lanes)), counts)
+
+  values = values[np.lexsort((values, lane_ids))]
+  starts = np.cumsum(counts) - counts
+  last = np.maximum(counts - 1, 0)
+  padded = np.append(values, np.nan)
+
+  def take(index):
+    return np.where(counts > 0, padded[np.where(counts > 0, index, len(values))], np.nan)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    statistics = {
+        'iet_count': counts,
+        'iet_mean': np.bincount(lane_ids, values, minlength=len(lanes)) / counts,
+        'iet_min': take(starts),
+        'iet_max': take(starts + last),
+    }
+
+  for percentile in percentiles:
+    position = percentile / 100 * last
+    low = np.floor(position).astype(int)
+    fraction = position - low
+    high = np.minimum(low + 1, last)
+    statistics[f'iet_p{percentile:g}'] = \
+        (1 - fraction) * take(starts + low) + fraction * take(starts + high)
+
+  return statistics
+
+
+def closed_loop_metrics(timepts, y, inter_event_times, vC_op, band=0.02,
+                        percentiles=IET_PERCENTILES):
+  """
+  Calculates the performance metrics of closed-loop simulations.
+
+  The rows of y follow the outputs of the closed-loop simulators: the deviations δiL and
+  δvC, the control input δd and, for the dynamic ETM, η. The settling time and the overshoot
+  are calculated on the output voltage vC = vC_op + δvC, and ISE and IAE on δvC.
+
+  Parameters:
+                  timepts (array): Time points of the simulations.
+                  y (array): Outputs of one simulation, shape (n_outputs, T), or of a batch,
+                             shape (N, n_outputs, T).
+                  inter_event_times (list): Inter-event times of the simulation, or of each lane.
+                  vC_op (float): Output voltage at the operating point.
+                  band (float): Relative half-width of the settling band.
+                  percentiles (tuple): Percentiles of the inter-event times.
+
+  Returns:
+                  dict: Arrays of shape (N,) with keys 'horizon' (last simulated time), 'settling_time',
+                        'overshoot', 'ise', 'iae', 'control_effort' and the keys of `iet_statistics`.
+  """
+  y = np.asarray(y, dtype=float)
+  if y.ndim == 2:
+    y = y[None]
+    inter_event_times = [inter_event_times]
+
+  vC = y[:, 1] + vC_op
+
+  return {
+      'horizon': np.full(len(y), timepts[-1], dtype=float),
+      'settling_time': settling_time(vC, timepts, band),
+      'overshoot': overshoot(vC),
+      'ise': integral_squared_error(y[:, 1], timepts),
+      'iae': integral_absolute_error(y[:, 1], timepts),
+      'control_effort': control_effort(y[:, 2], timepts),
+      **iet_statistics(inter_event_times, percentiles),
+  }
+
+
+def stack_metrics(rows, columns=None):
+  """
+  Stacks per-simulation metrics into a table of columns.
+
+  Parameters:
+                  rows (list): Dictionaries of metrics, with scalars or arrays of shape (1,).
+                               None marks a missing simulation, filled with NaN.
+                  columns (list): Names of the columns. If None, the keys of the first row.
+
+  Returns:
+                  dict: Arrays of shape (len(rows),), one per column.
+  """
+  if columns is None:
+    columns = next((list(row) for row in rows if row is not None), [])
+
+  return {column: np.array([np.nan if row is None else np.ravel(row[column])[0]
+                            for row in rows], dtype=float)
+          for column in columns}
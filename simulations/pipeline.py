@@ -0,0 +1,259 @@
+import os
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import instrument
+from sweep import limit_threads
+
+
+class Stage:
+  """
+  Class to represent a stage of a pipeline.
+
+  The stage calls function(*inputs, **kwargs), where inputs are the results of the required
+  stages, in order. Local stages run in the main process, for work that must not be spread over
+  processes, such as writes to the result store; the others run in the worker processes, so
+  their function, arguments and results must be picklable.
+
+  Parameters:
+                  name (str): Unique name of the stage.
+                  function (callable): Function of the stage.
+                  requires (tuple): Names of the stages whose results are the inputs.
+                  local (bool): Run the stage in the main process.
+                  cached (bool): Keep the result in the stage cache of the pipeline, if any. Stages
+                                 with side effects that must be checked on every run, such as
+                                 rendering files, should not be cached.
+                  labels (dict): Instrumentation labels of the metrics recorded by the stage, such
+                                 as its scenario. The name of the stage is always added.
+                  **kwargs: Keyword arguments of the function.
+  """
+
+  def __init__(self, name, function, requires=(), local=False, cached=True, labels=None,
+               **kwargs):
+    self.name = name
+    self.function = function
+    self.requires = tuple(requires)
+    self.local = local
+    self.cached = cached
+    self.labels = labels or {}
+    self.kwargs = kwargs
+
+  def run(self, inputs):
+    with instrument.labels(**self.labels, stage=self.name), instrument.span('stage'):
+      return self.function(*inputs, **self.kwargs)
+
+
+def run_stage(stage, inputs, worker_labels=None):
+  """
+  Runs a stage in a worker process.
+
+  Returns:
+                  tuple: Result of the stage and the metrics it recorded (see `instrument.collect`).
+  """
+  return instrument.collect(stage.run, worker_labels, inputs)
+
+
+class PipelineError(RuntimeError):
+  """
+  Error raised at the end of a pipeline run when stages failed.
+
+  Parameters:
+                  failed (dict): Tracebacks of the failed stages, and reasons of the skipped ones, by name.
+                  results (dict): Results of the final stages that finished, by name.
+  """
+
+  def __init__(self, failed, results):
+    super().__init__(f'Failed stages: {", ".join(failed)}')
+    self.failed = failed
+    self.results = results
+
+
+class Pipeline:
+  """
+  Class to represent a pipeline of stages forming a directed acyclic graph.
+
+  Every stage starts as soon as all the stages it requires have finished, so independent
+  stages, such as the simulations of different scenarios or the chunks of a sweep, run
+  concurrently over a process pool. When a stage fails, the stages depending on it are skipped,
+  the others still run, and a `PipelineError` listing the failed stages, with the results of
+  the final stages that finished, is raised at the end.
+
+  With a stage cache, the key of each stage hashes its function, its arguments and the keys of
+  the stages it requires, so it changes whenever anything upstream changes. Stages whose key is
+  cached are not run again, and their results are only loaded when a stage that must run
+  requires them, so a rerun only recomputes the stale part of the graph.
+
+  With the instrumentation enabled (see `instrument`), the metrics of each stage are labelled
+  with its name and labels, its wall time is recorded in the 'stage' span, and the metrics
+  recorded in the workers are merged into the main process.
+
+  Parameters:
+                  workers (int): Number of worker processes. If None, the number of CPUs is used;
+                                 with 1 worker the stages run one after another in the
+                                 current process.
+                  threads_per_worker (int): Maximum number of BLAS/OpenMP threads in each worker.
+                  start_method (str): Multiprocessing start method. If None, the platform default.
+                  verbose (bool): Log a line when each stage finishes (see `instrument.log`).
+                  cache (StageCache): Cache of stage results. If None, every stage runs.
+  """
+
+  def __init__(self, workers=None, threads_per_worker=1, start_method=None, verbose=True,
+               cache=None):
+    self.workers = workers or os.cpu_count() or 1
+    self.threads_per_worker = threads_per_worker
+    self.start_method = start_method
+    self.verbose = verbose
+    self.cache = cache
+    self.stages = {}
+
+  def add(self, name, function, requires=(), local=False, cached=True, labels=None, **kwargs):
+    """
+    Adds a stage to the pipeline.
+
+    Parameters:
+                    name (str): Unique name of the stage.
+                    function (callable): Function of the stage.
+                    requires (tuple): Names of the stages whose results are the inputs. They must
+                                      have been added before.
+                    local (bool): Run the stage in the main process.
+                    cached (bool): Keep the result in the stage cache.
+                    labels (dict): Instrumentation labels of the stage.
+                    **kwargs: Keyword arguments of the function.
+
+    Returns:
+                    str: Name of the stage.
+    """
+    if name in self.stages:
+      raise ValueError(f'Duplicate stage: {name}')
+    missing = [required for required in requires if required not in self.stages]
+    if missing:
+      raise ValueError(f'Stage {name} requires unknown stages: {", ".join(missing)}')
+
+    self.stages[name] = Stage(name, function, requires, local, cached, labels, **kwargs)
+    return name
+
+  def __contains__(self, name):
+    return name in self.stages
+
+  def keys(self):
+    """
+    Calculates the cache key of every stage.
+
+    Returns:
+                    dict: Keys, by stage name.
+    """
+    keys = {}
+    for name, stage in self.stages.items():
+      keys[name] = self.cache.key(stage.function, stage.kwargs,
+                                  [keys[required] for required in stage.requires])
+    return keys
+
+  def run(self):
+    """
+    Runs every stage of the pipeline that is not up to date.
+
+    The result of a stage is released as soon as all the stages requiring it have finished, so
+    only the results of the final stages, the ones no other stage requires, are kept.
+
+    Returns:
+                    dict: Results of the final stages, by name.
+    """
+    dependents = {name: [] for name in self.stages}
+    for stage in self.stages.values():
+      for required in dict.fromkeys(stage.requires):
+        dependents[required] += [stage.name]
+
+    keys = self.keys() if self.cache is not None else {}
+    fresh = {name for name, stage in self.stages.items()
+             if stage.cached and name in keys and keys[name] in self.cache}
+
+    results, failed = {}, {}
+    waiting = {name: len(set(stage.requires)) for name, stage in self.stages.items()}
+    ready = [name for name, count in waiting.items() if count == 0]
+    remaining = {name: len(names) for name, names in dependents.items()}
+
+    def finish(name, result=None, error=None):
+      if name in fresh:
+        if self.verbose:
+          instrument.log.info(f'[{name}]\tStage up to date')
+      elif error is None:
+        results[name] = result
+        if self.cache is not None and self.stages[name].cached:
+          self.cache.put(keys[name], result)
+        if self.verbose:
+          instrument.log.info(f'[{name}]\tStage finalized')
+      else:
+        failed[name] = error
+        instrument.log.error(f'[{name}]\tStage failed:\n{error}')
+
+      for required in set(self.stages[name].requires):
+        remaining[required] -= 1
+        if remaining[required] == 0 and dependents[required]:
+          results.pop(required, None)
+
+      for dependent in dependents[name]:
+        waiting[dependent] -= 1
+        if waiting[dependent] == 0:
+          ready.append(dependent)
+
+    def result(name):
+      if name not in results:
+        results[name] = self.cache.get(keys[name])
+        if results[name] is self.cache.MISSING:
+          raise RuntimeError(f'The cached result of stage {name} cannot be read')
+      return results[name]
+
+    def inputs(name):
+      return [result(required) for required in self.stages[name].requires]
+
+    def skip(name):
+      return any(required in failed for required in self.stages[name].requires)
+
+    def run_here(name):
+      if name in fresh:
+        finish(name)
+        return
+      if skip(name):
+        finish(name, error='Skipped: a required stage failed')
+        return
+      try:
+        finish(name, self.stages[name].run(inputs(name)))
+      except Exception:
+        finish(name, error=traceback.format_exc())
+
+    if self.workers == 1:
+      while ready:
+        run_here(ready.pop(0))
+    else:
+      context = multiprocessing.get_context(self.start_method)
+      with ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                               initializer=limit_threads,
+                               initargs=(self.threads_per_worker,)) as executor:
+        running = {}
+        while ready or running:
+          while ready:
+            name = ready.pop(0)
+            if self.stages[name].local or name in fresh or skip(name):
+              run_here(name)
+            else:
+              running[executor.submit(run_stage, self.stages[name], inputs(name),
+                                      instrument.context())] = name
+
+          if running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+              name = running.pop(future)
+              try:
+                value, metrics = future.result()
+                instrument.merge(metrics)
+                finish(name, value)
+              except Exception:
+                finish(name, error=traceback.format_exc())
+
+    final = {name: result(name) for name in self.stages
+             if not dependents[name] and name not in failed}
+    if failed:
+      raise PipelineError(failed, final)
+
+    return final
@@ -0,0 +1,164 @@
+import os
+import json
+import hashlib
+import functools
+
+import utils
+import instrument
+from cache import update_digest
+from sweep import SweepExecutor
+
+VECTOR_FORMATS = ('eps', 'pdf', 'svg')
+RASTER_FORMATS = ('png',)
+MANIFEST = '.figures.json'
+
+
+class FigureJob:
+  """
+  Class to represent a figure to render: a figure function of `utils` and its arguments.
+
+  Parameters:
+                  function (str): Name of the figure function in `utils`, such as
+                                  'create_figure_two_by_one'.
+                  name (str): Name of the figure, unique in its directory.
+                  path (str): Directory of the figure.
+                  **kwargs: Arguments of the figure function, except path, fmt, dpi and max_points.
+  """
+
+  def __init__(self, function, name, path, **kwargs):
+    self.function = function
+    self.name = name
+    self.path = path
+    self.kwargs = kwargs
+
+  def key(self, fmt, dpi, max_points):
+    """
+    Calculates a hash of the inputs of the figure.
+
+    Parameters:
+                    fmt (str): File format.
+                    dpi (float): Resolution of raster formats.
+                    max_points (int): Maximum number of points of each line.
+
+    Returns:
+                    str: Hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([self.function, fmt, dpi, max_points]).encode())
+    update_digest(digest, self.kwargs)
+    return digest.hexdigest()
+
+  def render(self, fmt='eps', dpi=None, max_points=None):
+    """
+    Renders the figure.
+
+    matplotlib is imported here, on the first figure, and not when the module is loaded, so
+    the processes that only simulate do not pay for it.
+
+    Returns:
+                    list: Paths of the saved files.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+    function = getattr(utils, self.function)
+    with instrument.span('plotting', figure=self.function):
+      files = function(path=self.path, fmt=fmt, dpi=dpi, max_points=max_points, **self.kwargs)
+    instrument.count('figures')
+    return files
+
+
+def render_chunk(jobs, fmt='eps', dpi=None, max_points=None):
+  """
+  Renders a chunk of figures in the current process.
+
+  Parameters:
+                  jobs (list): Figures to render.
+
+  Returns:
+                  list: Paths of the saved files of each figure.
+  """
+  return [job.render(fmt, dpi, max_points) for job in jobs]
+
+
+class FigureRenderer:
+  """
+  Class to represent a renderer of figures over a process pool.
+
+  Each directory holds a manifest with the hash of the inputs of every figure rendered there,
+  in every format, and a figure is only rendered again when the hash changed or one of its
+  files is missing. The lines are downsampled with LTTB to `max_points` points, about two points per pixel
+  column of the axes, so the files stay small whatever the length of the simulations.
+
+  Parameters:
+                  workers (int): Number of worker processes. If None, the number of CPUs is used.
+                  fmt (str): File format: 'eps', 'pdf' or 'svg' (vector) or 'png' (raster).
+                  dpi (float): Resolution of raster formats. If None, the matplotlib default.
+                  max_points (int): Maximum number of points of each line. If None, the lines
+                                    are drawn with every sample.
+                  force (bool): Render every figure, even if its inputs did not change.
+  """
+
+  def __init__(self, workers=None, fmt='eps', dpi=None, max_points=2000, force=False):
+    if fmt not in VECTOR_FORMATS + RASTER_FORMATS:
+      raise ValueError(f'Unsupported figure format: {fmt}')
+    self.workers = workers
+    self.fmt = fmt
+    self.dpi = dpi
+    self.max_points = max_points
+    self.force = force
+
+  def render(self, jobs):
+    """
+    Renders the figures whose inputs changed.
+
+    Parameters:
+                    jobs (list): Figures to render.
+
+    Returns:
+                    tuple: Numbers of rendered and skipped figures.
+    """
+    manifests, pending = {}, []
+    for job in jobs:
+      manifest = manifests.setdefault(job.path, load_manifest(job.path))
+      key = job.key(self.fmt, self.dpi, self.max_points)
+      entry = manifest.get(f'{job.name}.{self.fmt}')
+      if not self.force and entry is not None and entry['key'] == key and \
+              all(os.path.exists(file_name) for file_name in entry['files']):
+        continue
+      pending += [(job, key)]
+
+    results = SweepExecutor(self.workers, chunksize=1).map_chunks(
+        functools.partial(render_chunk, fmt=self.fmt, dpi=self.dpi, max_points=self.max_points),
+        [job for job, _ in pending])
+
+    for (job, key), files in zip(pending, results):
+      manifests[job.path][f'{job.name}.{self.fmt}'] = {'key': key, 'files': files}
+    for path in {job.path for job, _ in pending}:
+      save_manifest(path, manifests[path])
+
+    return len(pending), len(jobs) - len(pending)
+
+
+def load_manifest(path):
+  """
+  Reads the manifest of the figures of a directory.
+
+  Returns:
+                  dict: Hash and files of each figure, by name and format.
+  """
+  try:
+    with open(os.path.join(path, MANIFEST), 'r') as file:
+      return json.load(file)
+  except (OSError, ValueError):
+    return {}
+
+
+def save_manifest(path, manifest):
+  """
+  Writes the manifest of the figures of a directory.
+  """
+  file_name = os.path.join(path, MANIFEST)
+  with open(file_name + '.tmp', 'w') as file:
+    json.dump(manifest, file, indent=2, sort_keys=True)
+  os.replace(file_name + '.tmp', file_name)
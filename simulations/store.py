@@ -0,0 +1,407 @@
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+import pandas as pd
+import tables
+
+import cache
+from metrics import IET_PERCENTILES
+
+METRIC_COLUMNS = ('horizon', 'settling_time', 'overshoot', 'ise', 'iae', 'control_effort',
+                  'iet_count', 'iet_mean', 'iet_min', 'iet_max') + \
+    tuple(f'iet_p{percentile:g}' for percentile in IET_PERCENTILES)
+
+INDEX_COLUMNS = ('scenario', 'model', 'etm', 'rho')
+
+MAX_OUTPUTS = 4
+
+FILTERS = tables.Filters(complevel=5, complib='blosc', shuffle=True)
+
+# Version of the layout of the store, written to the runs table. Version 2 added the 'stage'
+# column and version 3 the 'key' column.
+SCHEMA_VERSION = 3
+
+
+def run_description():
+  """
+  Returns the description of the table of runs.
+
+  Returns:
+                  dict: PyTables column descriptions, by name.
+  """
+  description = {
+      'run_id': tables.Int64Col(pos=0),
+      'scenario': tables.StringCol(64, pos=1),
+      'model': tables.StringCol(32, pos=2),
+      'etm': tables.StringCol(16, pos=3),
+      'rho': tables.Float64Col(pos=4, dflt=np.nan),
+      'theta': tables.Float64Col(pos=5, dflt=np.nan),
+      'lam': tables.Float64Col(pos=6, dflt=np.nan),
+      'method': tables.StringCol(16, pos=7),
+      'stage': tables.StringCol(16, pos=8),
+      'created': tables.Float64Col(pos=9),
+      'K': tables.Float64Col(shape=(2,), pos=10, dflt=np.nan),
+      'Xi': tables.Float64Col(shape=(2, 2), pos=11, dflt=np.nan),
+      'Psi': tables.Float64Col(shape=(2, 2), pos=12, dflt=np.nan),
+      'sample_start': tables.Int64Col(pos=13),
+      'sample_count': tables.Int64Col(pos=14),
+      'output_count': tables.Int8Col(pos=15),
+      'event_start': tables.Int64Col(pos=16),
+      'event_count': tables.Int64Col(pos=17),
+      'key': tables.StringCol(64, pos=18),
+  }
+  for position, column in enumerate(METRIC_COLUMNS, start=len(description)):
+    description[column] = tables.Float64Col(pos=position, dflt=np.nan)
+  return description
+
+
+class StoreSchemaError(RuntimeError):
+  """
+  Error raised when an existing result store was written with another layout of the tables.
+
+  Parameters:
+                  path (str): Path of the HDF5 file.
+                  missing (list): Columns of the current layout absent from the file.
+                  version (int): Layout version of the file, if recorded.
+  """
+
+  def __init__(self, path, missing, version=None):
+    found = 'an unversioned layout' if version is None else f'layout version {version}'
+    super().__init__(
+        f'The result store {path} has {found}, but version {SCHEMA_VERSION} is required'
+        + (f' (missing columns: {", ".join(missing)})' if missing else '')
+        + '. Move or delete the file to start a new store; the runs of the old one are not '
+        'migrated.')
+    self.path = path
+    self.missing = missing
+    self.version = version
+
+
+class EventRow(tables.IsDescription):
+  run_id = tables.Int64Col(pos=0)
+  t = tables.Float64Col(pos=1)
+  state = tables.Float64Col(shape=(2,), pos=2, dflt=np.nan)
+  error_norm = tables.Float64Col(pos=3, dflt=np.nan)
+  gama = tables.Float64Col(pos=4, dflt=np.nan)
+  eta = tables.Float64Col(pos=5, dflt=np.nan)
+
+
+class ResultStore:
+  """
+  Class to represent a columnar store of simulation results in an HDF5 file.
+
+  Every run appends one row to the `runs` table, with the scenario tag, the model, the ETM
+  type, ρ, θ, λ, the engine, the stage that produced it, the design (K, Ξ, Ψ) and the
+  metrics, and its samples and events to shared, chunked and compressed arrays, located by
+  offsets in the row. The index columns (scenario,
+  model, ETM type and ρ) are indexed, so queries read only the matching rows, and trajectories
+  are read as slices of the sample arrays. Runs are only appended: a query returns by default
+  the latest run of each configuration, and writing a run identical to the latest one of its
+  configuration, as a rerun of the pipeline does, keeps the stored one. Opening a file written with another layout of the
+  tables raises a StoreSchemaError instead of failing on the first append.
+
+  Parameters:
+                  path (str): Path of the HDF5 file.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+
+    with tables.open_file(self.path, 'a') as h5:
+      if '/runs' not in h5:
+        runs = h5.create_table('/', 'runs', run_description(), 'Simulation runs',
+                               filters=FILTERS)
+        for column in INDEX_COLUMNS + ('run_id',):
+          runs.cols._f_col(column).create_index()
+        h5.create_earray('/', 't', tables.Float64Atom(), (0,), 'Sample times',
+                         filters=FILTERS, chunkshape=(16384,))
+        h5.create_earray('/', 'y', tables.Float64Atom(dflt=np.nan), (0, MAX_OUTPUTS),
+                         'Sample outputs', filters=FILTERS, chunkshape=(4096, MAX_OUTPUTS))
+        h5.create_table('/', 'events', EventRow, 'Events of the runs', filters=FILTERS)
+        runs.attrs['schema_version'] = SCHEMA_VERSION
+      else:
+        self.check_schema(h5)
+
+  def check_schema(self, h5):
+    """
+    Checks that the tables of an existing file have the current layout.
+
+    Parameters:
+                    h5 (File): Open PyTables file.
+    """
+    runs = h5.root.runs
+    version = int(runs.attrs['schema_version']) if 'schema_version' in runs.attrs else None
+    missing = [column for column in run_description() if column not in runs.colnames]
+    if missing or version not in (None, SCHEMA_VERSION):
+      raise StoreSchemaError(self.path, missing, version)
+    if version is None:
+      runs.attrs['schema_version'] = SCHEMA_VERSION
+
+  def open(self, mode='r'):
+    """
+    Opens the HDF5 file.
+
+    Parameters:
+                    mode (str): File mode.
+
+    Returns:
+                    File: PyTables file, to be closed by the caller.
+    """
+    return tables.open_file(self.path, mode)
+
+  def write_scenario(self, scenario, **info):
+    """
+    Stores information about a scenario, such as its operating point, replacing the values
+    of the same names and keeping the others.
+
+    Parameters:
+                    scenario (str): Scenario tag.
+                    **info: JSON-serializable values.
+    """
+    with self.open('a') as h5:
+      scenarios = json.loads(h5.root.runs.attrs['scenarios']) \
+          if 'scenarios' in h5.root.runs.attrs else {}
+      scenarios.setdefault(scenario, {}).update(info)
+      h5.root.runs.attrs['scenarios'] = json.dumps(scenarios, default=float)
+
+  def load_scenario(self, scenario):
+    """
+    Reads the information stored about a scenario.
+
+    Parameters:
+                    scenario (str): Scenario tag.
+
+    Returns:
+                    dict: Information about the scenario, empty if none was stored.
+    """
+    with self.open() as h5:
+      if 'scenarios' not in h5.root.runs.attrs:
+        return {}
+      return json.loads(h5.root.runs.attrs['scenarios']).get(scenario, {})
+
+  def write_run(self, scenario, model, t, y, etm='none', events=None, design=None,
+                ρ=np.nan, θ=np.nan, λ=np.nan, method='', metrics=None, stage=''):
+    """
+    Appends a run to the store, unless the latest run of the same configuration has the same
+    design, samples, events and metrics.
+
+    Parameters:
+                    scenario (str): Scenario tag.
+                    model (str): Name of the converter model.
+                    t (array): Time points of the run.
+                    y (array): Outputs of the run, shape (n_outputs, T), with n_outputs up to 4.
+                    etm (str): ETM type ('static', 'dynamic' or 'none').
+                    events (EventTrace): Events of the run, or an array of event times.
+                    design (tuple): ETM design (K, Ξ, Ψ).
+                    ρ (float): Weight of the design objective.
+                    θ (float): Threshold parameter of the dynamic ETM.
+                    λ (float): Decay rate of the dynamic ETM.
+                    method (str): Simulation engine.
+                    metrics (dict): Metrics of the run (see `metrics.closed_loop_metrics`).
+                    stage (str): Stage that produced the run, such as 'open_loop' or 'rho_sweep'.
+
+    Returns:
+                    int: Identifier of the run, the stored one if it was kept.
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    if y.shape[0] > MAX_OUTPUTS:
+      raise ValueError(f'At most {MAX_OUTPUTS} outputs can be stored, got {y.shape[0]}')
+
+    samples = np.full((len(t), MAX_OUTPUTS), np.nan)
+    samples[:, :y.shape[0]] = y.T
+    records = self.event_records(-1, events)
+    stored_metrics = {column: float(np.ravel(metrics[column])[0]) for column in METRIC_COLUMNS
+                      if metrics is not None and column in metrics}
+    digest = hashlib.sha256()
+    cache.update_digest(digest, (
+        None if design is None else [np.asarray(matrix, dtype=float) for matrix in design],
+        t, samples, records, stored_metrics))
+    key = digest.hexdigest()
+
+    with self.open('a') as h5:
+      runs = h5.root.runs
+      latest = self.latest_run(runs, scenario, model, etm, ρ, θ, λ, method, stage)
+      if latest is not None and latest['key'].decode() == key:
+        return int(latest['run_id'])
+
+      run_id = int(runs.nrows)
+      records['run_id'] = run_id
+      row = runs.row
+      row['run_id'] = run_id
+      row['scenario'] = scenario
+      row['model'] = model
+      row['etm'] = etm
+      row['rho'] = ρ
+      row['theta'] = θ
+      row['lam'] = λ
+      row['method'] = method
+      row['stage'] = stage
+      row['created'] = time.time()
+      if design is not None:
+        K, Ξ, Ψ = design
+        row['K'] = np.ravel(K)
+        row['Xi'] = Ξ
+        row['Psi'] = Ψ
+      row['sample_start'] = h5.root.t.nrows
+      row['sample_count'] = len(t)
+      row['output_count'] = y.shape[0]
+      row['event_start'] = h5.root.events.nrows
+      row['event_count'] = len(records)
+      row['key'] = key
+      for column, value in stored_metrics.items():
+        row[column] = value
+      row.append()
+
+      h5.root.t.append(t)
+      h5.root.y.append(samples)
+      h5.root.events.append(records)
+      runs.flush()
+
+    return run_id
+
+  @staticmethod
+  def latest_run(runs, scenario, model, etm, ρ, θ, λ, method, stage):
+    """
+    Reads the latest run of a configuration.
+
+    Parameters:
+                    runs (Table): Table of runs.
+                    scenario, model, etm, ρ, θ, λ, method, stage: Configuration of the run.
+
+    Returns:
+                    array: Row of the run, or None if the configuration has no run.
+    """
+    rows = runs.read_where(
+        '(scenario == scenario_value) & (model == model_value) & (etm == etm_value) & '
+        '(method == method_value) & (stage == stage_value)',
+        {'scenario_value': scenario.encode(), 'model_value': model.encode(),
+         'etm_value': etm.encode(), 'method_value': method.encode(),
+         'stage_value': stage.encode()})
+    for column, value in (('rho', ρ), ('theta', θ), ('lam', λ)):
+      rows = rows[np.isclose(rows[column], value, rtol=0., atol=0., equal_nan=True)]
+    return rows[np.argmax(rows['run_id'])] if len(rows) else None
+
+  @staticmethod
+  def event_records(run_id, events):
+    """
+    Converts the events of a run to rows of the events table.
+
+    Parameters:
+                    run_id (int): Identifier of the run.
+                    events (EventTrace): Events of the run, an array of event times, or None.
+
+    Returns:
+                    array: Structured array of event rows.
+    """
+    dtype = tables.description.dtype_from_descr(EventRow)
+    if events is None:
+      return np.zeros(0, dtype=dtype)
+
+    if hasattr(events, 'records'):
+      trace = events.records[:len(events)]
+      records = np.zeros(len(trace), dtype=dtype)
+      for field in ('t', 'state', 'error_norm', 'gama', 'eta'):
+        records[field] = trace[field]
+    else:
+      times = np.asarray(events, dtype=float)
+      records = np.zeros(len(times), dtype=dtype)
+      records['t'] = times
+      for field in ('state', 'error_norm', 'gama', 'eta'):
+        records[field] = np.nan
+
+    records['run_id'] = run_id
+    return records
+
+  def query(self, scenario=None, model=None, etm=None, ρ=None, stage=None, latest=True):
+    """
+    Reads the runs matching the index columns.
+
+    Parameters:
+                    scenario (str): Scenario tag.
+                    model (str): Name of the converter model.
+                    etm (str): ETM type.
+                    ρ (float or tuple): Value of ρ, or range (low, high) of values.
+                    stage (str): Stage that produced the runs.
+                    latest (bool): Keep only the latest run of each configuration.
+
+    Returns:
+                    DataFrame: Matching runs, one row per run.
+    """
+    conditions, variables = [], {}
+    for column, value in (('scenario', scenario), ('model', model), ('etm', etm),
+                          ('stage', stage)):
+      if value is not None:
+        conditions.append(f'({column} == {column}_value)')
+        variables[f'{column}_value'] = value.encode()
+    if ρ is not None:
+      if np.ndim(ρ) == 0:
+        conditions.append('(rho == rho_value)')
+        variables['rho_value'] = float(ρ)
+      else:
+        conditions.append('(rho >= rho_low) & (rho <= rho_high)')
+        variables['rho_low'], variables['rho_high'] = map(float, ρ)
+
+    with self.open() as h5:
+      runs = h5.root.runs
+      rows = runs.read_where(' & '.join(conditions), variables) if conditions else runs.read()
+
+    frame = pd.DataFrame({
+        name: list(rows[name]) if rows[name].ndim > 1 else rows[name]
+        for name in rows.dtype.names})
+    for column in ('scenario', 'model', 'etm', 'method', 'stage'):
+      frame[column] = frame[column].str.decode('utf-8')
+
+    if latest and len(frame):
+      keys = ['scenario', 'model', 'etm', 'method', 'stage', 'rho', 'theta', 'lam']
+      frame = frame.sort_values('run_id').groupby(
+          keys, dropna=False, sort=False).tail(1).sort_values('run_id')
+
+    return frame.reset_index(drop=True)
+
+  def load_trajectory(self, run):
+    """
+    Reads the samples of a run.
+
+    Parameters:
+                    run: Identifier of the run, or its row from `query`.
+
+    Returns:
+                    tuple: Time points and outputs, shape (n_outputs, T).
+    """
+    with self.open() as h5:
+      row = self.run_row(h5, run)
+      start, stop = row['sample_start'], row['sample_start'] + row['sample_count']
+      t = h5.root.t.read(start, stop)
+      y = h5.root.y.read(start, stop)[:, :row['output_count']].T
+    return t, y
+
+  def load_events(self, run):
+    """
+    Reads the events of a run.
+
+    Parameters:
+                    run: Identifier of the run, or its row from `query`.
+
+    Returns:
+                    array: Structured array with the fields t, state, error_norm, gama and eta.
+    """
+    with self.open() as h5:
+      row = self.run_row(h5, run)
+      return h5.root.events.read(row['event_start'], row['event_start'] + row['event_count'])
+
+  @staticmethod
+  def run_row(h5, run):
+    """
+    Returns the row of a run from its identifier or a row from `query`.
+    """
+    if isinstance(run, (int, np.integer)):
+      return h5.root.runs[int(run)]
+    return run
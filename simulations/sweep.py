@@ -0,0 +1,102 @@
+import os
+import math
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+
+try:
+  from threadpoolctl import threadpool_limits
+except ImportError:
+  threadpool_limits = None
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def limit_threads(threads=1):
+  """
+  Limits the number of threads used by BLAS and OpenMP in the current process.
+
+  The environment variables cover the libraries loaded after the call (all of them when the
+  workers are spawned), and threadpoolctl, when installed, also limits the ones already loaded.
+
+  Parameters:
+                  threads (int): Maximum number of threads.
+  """
+  for variable in THREAD_VARIABLES:
+    os.environ[variable] = str(threads)
+
+  if threadpool_limits is not None:
+    threadpool_limits(limits=threads)
+
+
+def split_chunks(points, chunksize):
+  """
+  Splits a list of points into consecutive chunks.
+
+  Parameters:
+                  points (list): Points to split.
+                  chunksize (int): Number of points in each chunk.
+
+  Returns:
+                  list: List of chunks, in the order of the points.
+  """
+  return [points[i:i + chunksize] for i in range(0, len(points), chunksize)]
+
+
+class SweepExecutor:
+  """
+  Class to represent an executor that distributes the points of a sweep over a process pool.
+
+  The points are split into consecutive chunks, and each task evaluates a whole chunk so it
+  can reuse per-chunk resources such as a compiled design problem. Results are returned in
+  the order of the points, whatever the number of workers.
+
+  Parameters:
+                  workers (int): Number of worker processes. If None, the number of CPUs is used;
+                                 with 1 worker the chunks are evaluated in the current process.
+                  chunksize (int): Number of points in each task. If None, about four tasks per worker.
+                  threads_per_worker (int): Maximum number of BLAS/OpenMP threads in each worker.
+                  start_method (str): Multiprocessing start method. If None, the platform default.
+  """
+
+  def __init__(self, workers=None, chunksize=None, threads_per_worker=1, start_method=None):
+    self.workers = workers or os.cpu_count() or 1
+    self.chunksize = chunksize
+    self.threads_per_worker = threads_per_worker
+    self.start_method = start_method
+
+  def map_chunks(self, function, points):
+    """
+    Evaluates a function over the chunks of a list of points.
+
+    Parameters:
+                    function (callable): Picklable function taking a list of points and returning
+                                         a list with one result per point.
+                    points (list): Points of the sweep.
+
+    Returns:
+                    list: Results, in the order of the points.
+    """
+    points = list(points)
+    if not points:
+      return []
+
+    chunksize = self.chunksize or max(1, math.ceil(len(points) / (4 * self.workers)))
+    chunks = split_chunks(points, chunksize)
+
+    if self.workers == 1 or len(chunks) == 1:
+      return [result for chunk in chunks for result in function(chunk)]
+
+    context = multiprocessing.get_context(self.start_method)
+    with ProcessPoolExecutor(max_workers=min(self.workers, len(chunks)), mp_context=context,
+                             initializer=limit_threads,
+                             initargs=(self.threads_per_worker,)) as executor:
+      results = []
+      for chunk_results, metrics in executor.map(
+              functools.partial(instrument.collect, function, instrument.context()), chunks):
+        instrument.merge(metrics)
+        results += chunk_results
+      return results
@@ -0,0 +1,82 @@
+import numpy as np
+
+from cache import DesignCache, StageCache
+from pipeline import Pipeline
+
+calls = []
+
+
+def square(value, offset=0):
+  calls.append(value)
+  return value ** 2 + offset
+
+
+def total(*values):
+  calls.append('total')
+  return sum(values)
+
+
+def create_pipeline(cache, offset=0, cached=True):
+  pipeline = Pipeline(1, verbose=False, cache=cache)
+  pipeline.add('a', square, value=2, offset=offset)
+  pipeline.add('b', square, value=3)
+  pipeline.add('total', total, ['a', 'b'], cached=cached)
+  return pipeline
+
+
+def test_stage_cache_round_trip(tmp_path):
+  cache = StageCache(str(tmp_path), 'v1')
+  key = cache.key(square, {'value': np.arange(3)})
+  assert key not in cache
+  assert cache.get(key) is StageCache.MISSING
+
+  cache.put(key, {'y': np.arange(3)})
+  assert key in cache
+  assert np.array_equal(cache.get(key)['y'], np.arange(3))
+  assert cache.key(square, {'value': np.arange(3)}) == key
+  assert StageCache(str(tmp_path), 'v2').key(square, {'value': np.arange(3)}) != key
+
+
+def test_pipeline_reuses_and_invalidates_cached_stages(tmp_path):
+  cache = StageCache(str(tmp_path), 'v1')
+  calls.clear()
+  assert create_pipeline(cache).run() == {'total': 13}
+  assert calls == [2, 3, 'total']
+
+  calls.clear()
+  assert create_pipeline(cache).run() == {'total': 13}
+  assert calls == []
+
+  # A changed argument invalidates the stage and every stage depending on it
+  calls.clear()
+  assert create_pipeline(cache, offset=1).run() == {'total': 14}
+  assert calls == [2, 'total']
+
+  # A new version of the code invalidates every stage
+  calls.clear()
+  create_pipeline(StageCache(str(tmp_path), 'v2')).run()
+  assert calls == [2, 3, 'total']
+
+
+def test_uncached_stages_always_run(tmp_path):
+  cache = StageCache(str(tmp_path), 'v1')
+  create_pipeline(cache, cached=False).run()
+
+  calls.clear()
+  assert create_pipeline(cache, cached=False).run() == {'total': 13}
+  assert calls == ['total']
+
+
+def test_design_key_ignores_execution_only_solver_options(tmp_path):
+  cache = DesignCache(str(tmp_path / 'designs.sqlite'))
+  A, B = np.array([[-100., -1000.], [454.5, 122.2]]), np.array([48000., 0.])
+  serial = cache.key(A, B, 0.5, 'MOSEK')
+  parallel = cache.key(A, B, 0.5, 'MOSEK', {'mosek_params': {'MSK_IPAR_NUM_THREADS': 1}})
+  assert parallel == serial
+
+  tolerance = {'mosek_params': {'MSK_IPAR_NUM_THREADS': 1, 'MSK_DPAR_INTPNT_CO_TOL_REL_GAP': 1e-9}}
+  assert cache.key(A, B, 0.5, 'MOSEK', tolerance) != serial
+  assert cache.key(A, B, 0.6, 'MOSEK') != serial
+
+  cache.put(serial, np.ones((1, 2)), np.eye(2), np.eye(2), 'optimal', 0.1)
+  assert np.array_equal(cache.get(parallel)['K'], np.ones((1, 2)))
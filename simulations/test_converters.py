@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import converters
+
+BUCK_CIRCUIT = {'input_voltage': 48, 'inductor_winding_resistance': 0.1, 'inductance': 1e-3,
+                'capacitance': 2.2e-3}
+BOOST_CIRCUIT = {'input_voltage': 48, 'constant_resistance_load': 20, 'inductance': 1e-3,
+                 'capacitance': 2.2e-3}
+
+# Matrices of the linearized models of buck/simu.py and of the boost notebook before the
+# converters were generalized
+BASELINES = [
+    ('buck', {**BUCK_CIRCUIT, 'constant_resistance_load': 10},
+     {'capacitor_voltage': 28, 'pcpl_power': 50},
+     [[-100., -1000.], [454.5454545454545, -16.465677179962896]],
+     [[48000., 0.], [0., -16.233766233766232]]),
+    ('buck', {**BUCK_CIRCUIT, 'constant_resistance_load': 20},
+     {'capacitor_voltage': 28, 'pcpl_power': 250},
+     [[-100., -1000.], [454.5454545454545, 122.21706864564007]],
+     [[48000., 0.], [0., -16.233766233766232]]),
+    ('boost', BOOST_CIRCUIT, {'capacitor_voltage': 72, 'pcpl_power': 125},
+     [[0., -666.6666666666666], [303.030303030303, -11.766975308641976]],
+     [[72000., 0.], [-3638.2575757575755, -6.3131313131313123]]),
+    ('boost', BOOST_CIRCUIT, {'capacitor_voltage': 72, 'pcpl_power': 600},
+     [[0., -666.6666666666666], [303.030303030303, 29.88215488215488]],
+     [[72000., 0.], [-8136.363636363635, -6.313131313131312]]),
+]
+
+
+@pytest.mark.parametrize('name, circuit, desired, A, B', BASELINES)
+def test_linearized_matrices_match_the_baseline(name, circuit, desired, A, B):
+  converter = converters.get_converter(name)
+  params = converter.scenario_params(circuit, desired)
+
+  A_converter, B_converter = converter.linearize(params)
+  assert np.allclose(A_converter, A, rtol=1e-12, atol=0.)
+  assert np.allclose(B_converter, B, rtol=1e-12, atol=0.)
+
+  system = converters.LinearizedConverter(converter, f'{name}_linearized', params).system
+  assert np.allclose(system.A, A, rtol=1e-12, atol=0.)
+  assert np.allclose(system.B, B, rtol=1e-12, atol=0.)
+
+
+def test_incomplete_converter_fails_at_instantiation():
+  class Incomplete(converters.Converter):
+    name = 'incomplete'
+
+    @staticmethod
+    def dynamics(iL, vC, d, Pcpl, c):
+      return vC, iL
+
+  with pytest.raises(TypeError, match='jacobian'):
+    Incomplete()
+
+
+def test_unknown_converter_is_rejected():
+  with pytest.raises(ValueError, match='buck'):
+    converters.get_converter('cuk')
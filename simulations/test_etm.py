@@ -0,0 +1,181 @@
+import warnings
+
+import numpy as np
+import pytest
+
+import batch
+import etm
+
+END_TIME = 5e-4
+STEP = 1e-5
+X0_FACTOR = [0.9, 0.9]
+
+
+def create_etm(etm_type, design, θ=1, λ=100):
+  K, Ξ, Ψ = design
+  return etm.StaticETM('etm', Ψ, Ξ) if etm_type == 'static' else \
+      etm.DynamicETM('etm', Ψ, Ξ, θ=θ, λ=λ)
+
+
+def run(converter, params, design, etm_type, method, solve_ivp_method='RK45'):
+  return etm.closed_loop_simulate(
+      converter, create_etm(etm_type, design), design[0], params, END_TIME,
+      x0_factor=X0_FACTOR, step=STEP, method=method, solve_ivp_method=solve_ivp_method)
+
+
+def test_dynamic_etm_output_triggers_on_eta_plus_theta_gama():
+  mechanism = etm.DynamicETM('etm', np.eye(2), np.eye(2), θ=1, λ=0.1)
+  x, x_hat = np.array([1., 0.]), np.array([2.5, 0.])
+  assert mechanism.get_gama(x, x_hat) == pytest.approx(-1.25)
+
+  params = {etm.RUN_CONTEXT: etm.RunContext()}
+  held = mechanism.etm_output(1., np.array([2.]), np.concatenate((x_hat, x)), params)
+  assert np.allclose(held[:2], x_hat)
+  assert len(params[etm.RUN_CONTEXT].events) == 0
+
+  sent = mechanism.etm_output(1., np.array([1.]), np.concatenate((x_hat, x)), params)
+  assert np.allclose(sent[:2], x)
+  assert len(params[etm.RUN_CONTEXT].events) == 1
+
+
+@pytest.mark.parametrize('etm_type', ['static', 'dynamic'])
+def test_event_driven_engines_agree(buck_linearized, buck_params, buck_design, etm_type):
+  t, y, _, reference = run(buck_linearized, buck_params, buck_design, etm_type, 'hybrid')
+  assert len(reference) > 10
+
+  for method in ('fused', 'analytic'):
+    t_method, y_method, _, event_times = run(buck_linearized, buck_params, buck_design,
+                                             etm_type, method)
+    assert len(event_times) == len(reference), method
+    assert np.allclose(event_times, reference, rtol=0., atol=1e-9), method
+    assert np.allclose(y_method[:2, -1], y[:2, -1], rtol=1e-4, atol=1e-6), method
+
+
+@pytest.mark.parametrize('etm_type', ['static', 'dynamic'])
+def test_sampled_engines_agree(buck_linearized, buck_params, buck_design, etm_type):
+  _, y, _, event_times = run(buck_linearized, buck_params, buck_design, etm_type, 'periodic')
+
+  K, Ξ, Ψ = buck_design
+  θ, λ = (None, None) if etm_type == 'static' else (1, 100)
+  _, y_batch, _, batch_event_times = batch.batch_closed_loop_simulate(
+      buck_linearized, K, Ψ, Ξ, buck_params, END_TIME, x0_factor=X0_FACTOR, step=STEP, θ=θ, λ=λ)
+
+  assert np.array_equal(batch_event_times[0], event_times)
+  assert np.allclose(y_batch[0, :2], y[:2], rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize('etm_type', ['static', 'dynamic'])
+def test_interconnect_follows_the_event_driven_engines(buck_linearized, buck_params, buck_design,
+                                                       etm_type):
+  # The interconnection checks the trigger at the evaluations of the integrator, with a step
+  # bounded by the grid, so its events are close to, but not on, the exact crossings
+  _, y, _, reference = run(buck_linearized, buck_params, buck_design, etm_type, 'hybrid')
+  _, y_interconnect, _, event_times = run(buck_linearized, buck_params, buck_design, etm_type,
+                                          'interconnect')
+
+  assert np.all(np.diff(event_times) > 0)
+  assert abs(len(event_times) - len(reference)) <= 0.15 * len(reference)
+  assert np.allclose(y_interconnect[:2, -1], y[:2, -1], rtol=1e-2, atol=1e-2)
+
+
+def test_hybrid_engine_passes_the_jacobian_to_implicit_methods_only(buck_linearized, buck_params,
+                                                                    buck_design):
+  with warnings.catch_warnings():
+    warnings.simplefilter('error', UserWarning)
+    _, y, _, event_times = run(buck_linearized, buck_params, buck_design, 'dynamic', 'hybrid')
+  _, y_radau, _, radau_event_times = run(buck_linearized, buck_params, buck_design, 'dynamic',
+                                         'hybrid', 'Radau')
+
+  assert abs(len(radau_event_times) - len(event_times)) <= 1
+  assert np.allclose(y_radau[:2, -1], y[:2, -1], rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.parametrize('tail', [1, 4, 7])
+def test_output_buffer_keeps_the_most_recent_samples(tail):
+  timepts = np.arange(60.)
+  samples = np.stack((timepts, -timepts, 2 * timepts))
+  output = etm.OutputRecorder(decimation=5).open(timepts, (3,), tail)
+
+  index = 0
+  for count in [1, 3, 9, 2, 5, 1, 1, 6, 4, 8, 3, 7, 10]:
+    output.write(index, samples[:, index:index + count])
+    index += count
+    t, y = output.recent(index - 1)
+    assert np.array_equal(t, timepts[max(index - tail, 0):index])
+    assert np.array_equal(y, samples[:, max(index - tail, 0):index])
+
+  t, y = output.result(index - 1)
+  assert np.array_equal(t, np.append(timepts[:index:5], timepts[index - 1]))
+  assert np.array_equal(y[:, -1], samples[:, index - 1])
+
+
+@pytest.mark.parametrize('window', [3e-5, 1e-4])
+def test_event_driven_engines_keep_the_minimum_inter_event_time(buck_linearized, buck_params,
+                                                                buck_design, window):
+  K, Ξ, Ψ = buck_design
+  runs = [simulate(buck_linearized, create_etm('dynamic', buck_design), K, buck_params, 2e-3,
+                   x0_factor=X0_FACTOR, step=STEP, min_inter_event_time=window)
+          for simulate in (etm.hybrid_closed_loop_simulate, etm.analytic_closed_loop_simulate)]
+  (_, _, _, event_times), (_, _, _, analytic_event_times) = runs
+
+  assert len(event_times) > 5
+  # The inter-event times are differences of event times, exact up to rounding
+  assert np.diff(event_times).min() >= window * (1 - 1e-9)
+  assert np.allclose(event_times, analytic_event_times, rtol=0., atol=1e-9)
+
+
+# Formulas of notebooks/dynamic-etm-van-der-pol-oscillator.ipynb, rule by rule
+R0 = 5
+VDP_A = [np.array([[0, 1], [-1, 1]]), np.array([[0, 1], [-1, 1 - R0 ** 2]])]
+VDP_B = [np.array([[0], [1]]), np.array([[0], [1]])]
+VDP_K = [np.array([[-0.559, -3.5]]), np.array([[-6.05, -3.01]])]
+VDP_Ξ = np.array([[1.36, 1.34], [1.34, 6.39]])
+VDP_Ψ = np.array([[0.951, 0.333], [0.333, 1.81]])
+VDP_P = np.array([[2.08e+00, 4.10e-01], [4.10e-01, 1.83e+00]])
+
+
+def notebook_w(x):
+  w0 = (R0 ** 2 - x[0] ** 2) / (R0 ** 2)
+  return [w0, 1. - w0]
+
+
+def notebook_gama(current_states, last_states_sent):
+  w_x = notebook_w(current_states)
+  w_ex = notebook_w(last_states_sent)
+  error = last_states_sent - current_states
+
+  K_x, K_ex, B_x = 0, 0, 0
+  for i in range(len(w_x)):
+    K_x += w_x[i] * VDP_K[i]
+    K_ex += w_ex[i] * VDP_K[i]
+    B_x += w_x[i] * VDP_B[i]
+
+  ζ = 2 * current_states.T @ VDP_P @ B_x @ (K_ex - K_x) @ last_states_sent
+  return current_states.T @ VDP_Ψ @ current_states - error.T @ VDP_Ξ @ error - ζ
+
+
+def test_fuzzy_etm_matches_the_notebook_formulas():
+  mechanism = etm.FuzzyETM('etm', etm.FuzzyModel.van_der_pol(R0), VDP_K, VDP_Ψ, VDP_Ξ, VDP_P,
+                           θ=1, λ=0.1)
+  rng = np.random.default_rng(0)
+  X, X_hat = rng.uniform(-R0, R0, (2, 50, 2))
+
+  expected_gama = [notebook_gama(x, x_hat) for x, x_hat in zip(X, X_hat)]
+  expected_control = [sum(w * K @ x_hat for w, K in zip(notebook_w(x_hat), VDP_K))
+                      for x_hat in X_hat]
+  expected_update = [sum(w * (A @ x + B @ u) for w, A, B in zip(notebook_w(x), VDP_A, VDP_B))
+                     for x, u in zip(X, expected_control)]
+
+  assert np.allclose(mechanism.get_gama(X, X_hat), expected_gama, rtol=1e-12, atol=1e-12)
+  assert mechanism.get_gama(X[0], X_hat[0]) == pytest.approx(expected_gama[0], rel=1e-12)
+  assert np.allclose(mechanism.control(X_hat), expected_control, rtol=1e-12, atol=1e-12)
+  assert np.allclose(mechanism.model.update(X, mechanism.control(X_hat)), expected_update,
+                     rtol=1e-12, atol=1e-12)
+  assert np.allclose(mechanism.get_trigger_value(X, X_hat, np.full(50, 0.5)),
+                     0.5 + np.array(expected_gama), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('θ, λ', [(1., None), (None, 0.1)])
+def test_fuzzy_etm_requires_both_dynamic_parameters(θ, λ):
+  with pytest.raises(ValueError, match='θ and λ'):
+    etm.FuzzyETM('etm', etm.FuzzyModel.van_der_pol(R0), VDP_K, VDP_Ψ, VDP_Ξ, VDP_P, θ=θ, λ=λ)
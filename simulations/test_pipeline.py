@@ -0,0 +1,53 @@
+import pytest
+
+from pipeline import Pipeline, PipelineError
+
+
+def constant(value):
+  return value
+
+
+def fail():
+  raise ValueError('solver failed')
+
+
+def total(*values):
+  return sum(values)
+
+
+def create_pipeline(workers):
+  pipeline = Pipeline(workers, verbose=False)
+  pipeline.add('a', constant, value=1)
+  pipeline.add('b', fail)
+  pipeline.add('c', constant, value=2)
+  pipeline.add('ab', total, ['a', 'b'])
+  pipeline.add('ac', total, ['a', 'c'])
+  return pipeline
+
+
+def test_run_returns_the_final_results():
+  pipeline = Pipeline(1, verbose=False)
+  pipeline.add('a', constant, value=1)
+  pipeline.add('b', constant, value=2)
+  pipeline.add('ab', total, ['a', 'b'])
+  assert pipeline.run() == {'ab': 3}
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_failures_propagate_to_dependents_only(workers):
+  with pytest.raises(PipelineError) as error:
+    create_pipeline(workers).run()
+
+  assert set(error.value.failed) == {'b', 'ab'}
+  assert 'solver failed' in error.value.failed['b']
+  assert error.value.failed['ab'].startswith('Skipped')
+  assert error.value.results == {'ac': 3}
+
+
+def test_duplicate_and_unknown_stages_are_rejected():
+  pipeline = Pipeline(1, verbose=False)
+  pipeline.add('a', constant, value=1)
+  with pytest.raises(ValueError):
+    pipeline.add('a', constant, value=1)
+  with pytest.raises(ValueError):
+    pipeline.add('b', total, ['missing'])
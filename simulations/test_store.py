@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+import tables
+
+import etm
+import store
+from store import ResultStore, StoreSchemaError
+
+
+def create_events():
+  events = etm.EventTrace()
+  events.append(0., np.array([1., 2.]), 0., 5.)
+  events.append(1e-3, np.array([0.5, 1.5]), 0.25, -0.1, 0.3)
+  return events
+
+
+def test_result_store_round_trip(tmp_path):
+  results = ResultStore(str(tmp_path / 'results.h5'))
+  results.write_scenario('scenario-2', op={'iL': 23.9, 'vC': 28.})
+
+  t = np.linspace(0., 1e-2, 11)
+  y = np.vstack((np.sin(t), np.cos(t), t, -t))
+  design = (np.array([[-1., -2.]]), np.eye(2), 2 * np.eye(2))
+  first = results.write_run('scenario-2', 'buck_linearized', t, y, 'dynamic', create_events(),
+                            design, ρ=0.5, θ=1., λ=100., method='hybrid',
+                            metrics={'iet_mean': np.array([1e-3]), 'settling_time': 0.01},
+                            stage='closed_loop')
+  second = results.write_run('scenario-2', 'buck_linearized', t, 2 * y[:3], 'dynamic',
+                             [0., 2e-3], design, ρ=0.5, θ=1., λ=100., method='hybrid',
+                             stage='closed_loop')
+  results.write_run('scenario-2', 'buck_nonlinear', t, y[:2], stage='open_loop')
+
+  assert results.load_scenario('scenario-2') == {'op': {'iL': 23.9, 'vC': 28.}}
+  assert results.load_scenario('missing') == {}
+
+  runs = results.query('scenario-2', 'buck_linearized', 'dynamic', ρ=0.5, stage='closed_loop')
+  assert list(runs['run_id']) == [second]
+  assert len(results.query(stage='closed_loop', latest=False)) == 2
+  assert len(results.query(ρ=(0.4, 0.6), latest=False)) == 2
+
+  row = results.query(stage='closed_loop', latest=False).iloc[0]
+  assert row['run_id'] == first and row['method'] == 'hybrid' and row['etm'] == 'dynamic'
+  assert row['iet_mean'] == 1e-3 and row['settling_time'] == 0.01 and np.isnan(row['ise'])
+  assert np.array_equal(row['K'], [-1., -2.]) and np.array_equal(row['Psi'], 2 * np.eye(2))
+
+  t_first, y_first = results.load_trajectory(first)
+  assert np.array_equal(t_first, t) and np.array_equal(y_first, y)
+  t_second, y_second = results.load_trajectory(runs.iloc[0])
+  assert np.array_equal(t_second, t) and np.array_equal(y_second, 2 * y[:3])
+
+  events = results.load_events(first)
+  assert np.array_equal(events['t'], [0., 1e-3])
+  assert np.array_equal(events['state'][1], [0.5, 1.5])
+  assert events['eta'][1] == 0.3
+  assert np.array_equal(results.load_events(second)['t'], [0., 2e-3])
+
+  # Reopening the file keeps the runs
+  assert len(ResultStore(str(tmp_path / 'results.h5')).query(latest=False)) == 3
+
+
+def test_store_of_an_older_layout_is_rejected(tmp_path):
+  path = str(tmp_path / 'results.h5')
+  description = store.run_description()
+  del description['stage']
+  with tables.open_file(path, 'w') as h5:
+    h5.create_table('/', 'runs', description)
+
+  with pytest.raises(StoreSchemaError, match='missing columns: stage') as error:
+    ResultStore(path)
+  assert error.value.missing == ['stage']
+  assert error.value.version is None
+
+
+def test_store_of_another_version_is_rejected(tmp_path):
+  path = str(tmp_path / 'results.h5')
+  ResultStore(path)
+  with tables.open_file(path, 'a') as h5:
+    h5.root.runs.attrs['schema_version'] = store.SCHEMA_VERSION + 1
+
+  with pytest.raises(StoreSchemaError, match=f'layout version {store.SCHEMA_VERSION + 1}'):
+    ResultStore(path)
+
+
+def test_rewriting_the_latest_run_keeps_the_stored_one(tmp_path):
+  results = ResultStore(str(tmp_path / 'results.h5'))
+  t = np.linspace(0., 1e-2, 11)
+  design = (np.array([[-1., -2.]]), np.eye(2), 2 * np.eye(2))
+
+  def write(y, ρ=0.5):
+    return results.write_run('scenario-2', 'buck_linearized', t, y, 'dynamic', create_events(),
+                             design, ρ=ρ, θ=1., λ=100., method='hybrid',
+                             metrics={'iet_mean': 1e-3}, stage='rho_sweep')
+
+  first = write([np.sin(t)])
+  assert write([np.sin(t)]) == first
+  assert len(results.query(latest=False)) == 1
+
+  # Changed results, and other configurations, are appended
+  second = write([np.cos(t)])
+  assert write([np.sin(t)], ρ=0.6) not in (first, second)
+  assert len(results.query(latest=False)) == 3
+
+  # A run identical to an older one is appended again, so it is the latest
+  third = write([np.sin(t)])
+  assert third not in (first, second)
+  assert list(results.query(ρ=0.5)['run_id']) == [third]
+  assert np.array_equal(results.load_events(third)['t'], [0., 1e-3])
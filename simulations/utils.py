@@ -1,12 +1,7 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import control as ct
-import control.optimal as opt
-from control.matlab import *
-import cvxpy as cp
-import math
-import pandas as pd
-ct.use_fbs_defaults()
+
+import metrics
+import instrument
 
 
 def show_matrix(name, matrix, decimal_places=2):
@@ -49,19 +44,99 @@ def set_axs(axs, x, y, label, x_label, y_label, title):
                   colors='black', top=True, right=True)
 
 
-def generate_square_signal(timepts, signal_data):
-  signal = np.zeros(len(timepts))
-  for i, t in enumerate(timepts):
-    for j in range(len(signal_data) - 1):
-      if signal_data[j][0] <= t < signal_data[j + 1][0]:
-        signal[i] = signal_data[j][1]
-        break
-    else:
-      signal[i] = signal_data[-1][1]
+def make_square_signal(signal_data):
+  """
+  Creates a piecewise-constant signal that can be evaluated at arbitrary times.
+
+  The value at t is the one of the last breakpoint at or before t, found by binary search
+  over the breakpoints. Times before the first breakpoint take the last value.
+
+  Parameters:
+                  signal_data (list): List of tuples (t, value) sorted by time.
+
+  Returns:
+                  function: u(t) accepting a scalar or an array of times.
+  """
+  breakpoints = np.array([t for t, _ in signal_data], dtype=float)
+  values = np.array([value for _, value in signal_data], dtype=float)
+
+  def signal(t):
+    return values[np.searchsorted(breakpoints, t, side='right') - 1]
+
   return signal
 
 
-def set_subplot(ax, x_data, y_data, xlabel, ylabel, title, line_color='#120a8f', linewidth=1.5):
+def generate_square_signal(timepts, signal_data):
+  return make_square_signal(signal_data)(np.asarray(timepts, dtype=float))
+
+
+def lttb(x, y, threshold):
+  """
+  Downsamples a line with the Largest-Triangle-Three-Buckets algorithm.
+
+  The first and last points are kept, and the others are split into threshold - 2 buckets of
+  consecutive points. From each bucket the point forming the largest triangle with the point
+  kept from the previous bucket and the mean of the next bucket is kept, which preserves the
+  peaks and the shape of the line far better than taking every n-th point.
+
+  Parameters:
+                  x (array): x values, sorted.
+                  y (array): y values.
+                  threshold (int): Number of points to keep, at least 3.
+
+  Returns:
+                  tuple: Downsampled x and y values.
+  """
+  x = np.asarray(x, dtype=float)
+  y = np.asarray(y, dtype=float)
+  if threshold is None or len(x) <= threshold or threshold < 3:
+    return x, y
+
+  edges = np.linspace(1, len(x) - 1, threshold - 1).astype(int)
+  x_mean = np.add.reduceat(x[1:-1], edges[:-1] - 1) / np.diff(edges)
+  y_mean = np.add.reduceat(y[1:-1], edges[:-1] - 1) / np.diff(edges)
+  x_mean = np.append(x_mean, x[-1])
+  y_mean = np.append(y_mean, y[-1])
+
+  kept = np.empty(threshold, dtype=int)
+  kept[0], kept[-1] = 0, len(x) - 1
+  for bucket in range(threshold - 2):
+    start, end = edges[bucket], edges[bucket + 1]
+    a = kept[bucket]
+    areas = np.abs((x[a] - x_mean[bucket + 1]) * (y[start:end] - y[a]) -
+                   (x[a] - x[start:end]) * (y_mean[bucket + 1] - y[a]))
+    kept[bucket + 1] = start + np.argmax(areas)
+
+  return x[kept], y[kept]
+
+
+def save_figure(path, fig_name, fmt='eps', dpi=None):
+  """
+  Saves the current figure and closes it.
+
+  Parameters:
+                  path (str): Directory of the figure.
+                  fig_name (str): File name, without extension.
+                  fmt (str): File format: 'eps', 'pdf' or 'svg' (vector) or 'png' (raster).
+                  dpi (float): Resolution of raster formats. If None, the matplotlib default.
+
+  Returns:
+                  list: Path of the saved file.
+  """
+  import matplotlib.pyplot as plt
+
+  file_name = path + '/' + fig_name + '.' + fmt
+  with instrument.span('figure_save', format=fmt):
+    plt.tight_layout()
+    plt.savefig(file_name, format=fmt, dpi=dpi, bbox_inches='tight')
+  plt.close()
+  return [file_name]
+
+
+def set_subplot(ax, x_data, y_data, xlabel, ylabel, title, line_color='#120a8f', linewidth=1.5,
+                max_points=None):
+  if max_points is not None:
+    x_data, y_data = lttb(x_data, y_data, max_points)
   line, = ax.plot(x_data, y_data, linestyle='-',
                   color=line_color, linewidth=linewidth)
   ax.set_xlabel(xlabel, fontsize=18)
@@ -101,69 +176,71 @@ def set_axe_stem(ax, x, y, xlabel, ylabel, linefmt='-', markerfmt=None, basefmt=
     ax.grid(linestyle='--')
 
 
-def create_figure_two_by_one(title_figure, data_1, data_2, fig_name, path='./'):
+def create_figure_two_by_one(title_figure, data_1, data_2, fig_name, path='./', fmt='eps', dpi=None,
+                             max_points=None):
+  import matplotlib.pyplot as plt
+
   fig, axs = plt.subplots(1, 2, figsize=(12, 3))
   fig.suptitle(title_figure, fontsize=22)
 
   set_subplot(
       axs[0], data_1['x'], data_1['y'],
-      data_1['x_label'], data_1['y_label'], data_1['title'],
+      data_1['x_label'], data_1['y_label'], data_1['title'], max_points=max_points
   )
 
   set_subplot(
       axs[1], data_2['x'], data_2['y'],
-      data_2['x_label'], data_2['y_label'], data_2['title'],
+      data_2['x_label'], data_2['y_label'], data_2['title'], max_points=max_points
   )
 
-  plt.tight_layout()
-  plt.savefig(
-      path + '/' + fig_name + '.eps',
-      format='eps', bbox_inches='tight')
-  plt.close()
+  return save_figure(path, fig_name, fmt, dpi)
+
 
+def create_figure_two_by_two(title_figure, data_1, data_2, legends, fig_name, path='./', fmt='eps',
+                             dpi=None, max_points=None):
+  import matplotlib.pyplot as plt
 
-def create_figure_two_by_two(title_figure, data_1, data_2, legends, fig_name, path='./'):
   fig, axs = plt.subplots(1, 2, figsize=(12, 3))
   fig.suptitle(title_figure, fontsize=22)
 
   line1 = set_subplot(
       axs[0], data_1['x1'], data_1['y1'],
-      data_1['x_label'], data_1['y_label'], data_1['title'],
+      data_1['x_label'], data_1['y_label'], data_1['title'], max_points=max_points
   )
 
   line2 = set_subplot(
       axs[0], data_1['x2'], data_1['y2'],
       data_1['x_label'], data_1['y_label'], data_1['title'],
-      line_color='#8b0000'
+      line_color='#8b0000', max_points=max_points
   )
 
   set_subplot(
       axs[1], data_2['x1'], data_2['y1'],
-      data_2['x_label'], data_2['y_label'], data_2['title'],
+      data_2['x_label'], data_2['y_label'], data_2['title'], max_points=max_points
   )
 
   set_subplot(
       axs[1], data_2['x2'], data_2['y2'],
-      data_2['x_label'], data_2['y_label'], data_2['title'], line_color='#8b0000'
+      data_2['x_label'], data_2['y_label'], data_2['title'], line_color='#8b0000',
+      max_points=max_points
   )
 
   fig.legend([line1, line2], legends,
              fontsize=18, loc='upper center', bbox_to_anchor=(.5, 0.0), fancybox=False, shadow=False, ncol=2)
 
-  plt.tight_layout()
-  plt.savefig(
-      path + '/' + fig_name + '.eps',
-      format='eps', bbox_inches='tight')
-  plt.close()
+  return save_figure(path, fig_name, fmt, dpi)
 
 
 def create_etm_results_figures(
     title, fig_prefix, path, op,
     t_etm_nl, y_etm_nl, iet_etm_nl, et_etm_nl,
-    t_etm_l, y_etm_l, iet_etm_l, et_etm_l
+    t_etm_l, y_etm_l, iet_etm_l, et_etm_l, fmt='eps', dpi=None, max_points=None
 ):
+  import matplotlib.pyplot as plt
+
+  options = {'path': path, 'fmt': fmt, 'dpi': dpi, 'max_points': max_points}
 
-  create_figure_two_by_two(
+  files = create_figure_two_by_two(
       title_figure=title + ': States $i_L$ and $v_C$',
       data_1={
           'x1': t_etm_nl, 'x2': t_etm_l,
@@ -179,10 +256,10 @@ def create_etm_results_figures(
       },
       legends=['Non-linear', 'Linearized'],
       fig_name=fig_prefix + '_states',
-      path=path
+      **options
   )
 
-  create_figure_two_by_one(
+  files += create_figure_two_by_one(
       title_figure=title + ': States $i_L$ and $v_C$',
       data_1={
           'x': t_etm_nl[1:], 'y': y_etm_nl[2][1:] + op['d'],
@@ -195,7 +272,7 @@ def create_etm_results_figures(
           'title': 'Duty Cycle (Linearized)'
       },
       fig_name=fig_prefix + '_duty_cycle',
-      path=path
+      **options
   )
 
   fig, axs = plt.subplots(1, 2, figsize=(12, 3))
@@ -211,37 +288,25 @@ def create_etm_results_figures(
   fig.legend(['Não Linear', 'Linearizado'],
              fontsize=14, loc='upper center', bbox_to_anchor=(.5, 0.), fancybox=False, shadow=False, ncol=2)
 
-  plt.tight_layout()
-  plt.savefig(
-      path + '/' + fig_prefix + '_inter_event_times.eps',
-      format='eps', bbox_inches='tight')
-  plt.close()
+  files += save_figure(path, fig_prefix + '_inter_event_times', fmt, dpi)
 
   if len(y_etm_nl) == 4 and len(y_etm_l) == 4:
     fig, axs = plt.subplots(1, 2, figsize=(12, 3))
     fig.suptitle(title + ": Dynamic Variable", fontsize=20)
     line1 = set_subplot(
         axs[0], t_etm_nl, y_etm_nl[3] + op['d'],
-        'Time (s)', '$\eta$', '')
+        'Time (s)', '$\eta$', '', max_points=max_points)
     line2 = set_subplot(
         axs[1], t_etm_l, y_etm_l[3] + op['d'],
         'Time (s)', '$\eta$', '',
-        line_color='#8b0000')
+        line_color='#8b0000', max_points=max_points)
 
     fig.legend([line1, line2], ['Non-linear', 'Linearized'],
                fontsize=18, loc='upper center', bbox_to_anchor=(.5, 0.0), fancybox=False, shadow=False, ncol=2)
-    plt.tight_layout()
-    plt.savefig(
-        path + '/' + fig_prefix + '_eta.eps',
-        format='eps', bbox_inches='tight')
-    plt.close()
+    files += save_figure(path, fig_prefix + '_eta', fmt, dpi)
 
+  return files
 
-def get_settling_time(signal, timepts):
-  final_value = signal[-1]
-  limit = 0.02 * final_value
 
-  for i in range(len(signal) - 1, -1, -1):
-    if abs(signal[i] - final_value) >= limit:
-      return timepts[i]
-  return timepts[0]
+def get_settling_time(signal, timepts):
+  return metrics.settling_time(signal, timepts)[0]
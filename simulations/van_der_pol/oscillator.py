@@ -0,0 +1,135 @@
+import os
+import time
+import argparse
+import itertools
+
+import numpy as np
+
+import etm
+import instrument
+import metrics
+import ensemble
+
+# Design of the notebooks of the Van der Pol oscillator, for the sector |x₁| ≤ 5
+R0 = 5.
+GAINS = [[[-0.559, -3.5]], [[-6.05, -3.01]]]
+Ξ = np.array([[1.36, 1.34], [1.34, 6.39]])
+Ψ = np.array([[0.951, 0.333], [0.333, 1.81]])
+P = np.array([[2.08, 0.41], [0.41, 1.83]])
+X0 = np.array([4.2467, 1.1155])
+
+
+def parse_values(text):
+  """
+  Parses a comma-separated list of values.
+  """
+  return [float(value) for value in text.split(',')]
+
+
+def create_etm(etm_type, θ=1., λ=0.1, r0=R0):
+  """
+  Create the fuzzy ETM of the oscillator with the design of the notebooks.
+
+  Parameters:
+                  etm_type (str): ETM type ('static' or 'dynamic').
+                  θ (float): Threshold parameter of the dynamic ETM.
+                  λ (float): Decay rate of the dynamic ETM.
+                  r0 (float): Bound on x₁ of the fuzzy model.
+
+  Returns:
+                  FuzzyETM: Fuzzy ETM holding the T–S model of the oscillator.
+  """
+  model = etm.FuzzyModel.van_der_pol(r0)
+  if etm_type == 'dynamic':
+    return etm.FuzzyETM('etm', model, GAINS, Ψ, Ξ, P, θ, λ)
+  return etm.FuzzyETM('etm', model, GAINS, Ψ, Ξ, P)
+
+
+def sweep(etm_type, x0, θ_values=(1.,), λ_values=(0.1,), end_time=30., step=1e-4, r0=R0):
+  """
+  Simulate the closed loop of the oscillator from a set of initial states for every pair
+  (θ, λ) of the dynamic ETM, or once for the static ETM.
+
+  Parameters:
+                  etm_type (str): ETM type ('static' or 'dynamic').
+                  x0 (array): Initial states, shape (N, 2), simulated together as lanes.
+                  θ_values (list): Threshold parameters of the dynamic ETM.
+                  λ_values (list): Decay rates of the dynamic ETM.
+                  end_time (float): End time of simulation.
+                  step (float): Time step for simulation.
+                  r0 (float): Bound on x₁ of the fuzzy model.
+
+  Returns:
+                  dict: Arrays of shape (P·N,), one row per pair and initial state, with the
+                        columns 'θ', 'λ', 'x1_0', 'x2_0', 'final_norm', 'control_effort' and
+                        the keys of `metrics.iet_statistics`. θ and λ are NaN for the static ETM.
+  """
+  x0 = np.atleast_2d(np.asarray(x0, dtype=float))
+  pairs = list(itertools.product(θ_values, λ_values)) if etm_type == 'dynamic' \
+      else [(np.nan, np.nan)]
+  rows = []
+
+  for θ, λ in pairs:
+    t, y, inter_event_times, _ = etm.fuzzy_closed_loop_simulate(
+        create_etm(etm_type, θ, λ, r0), end_time, x0, step)
+    rows += [{
+        'θ': np.full(len(x0), θ), 'λ': np.full(len(x0), λ),
+        'x1_0': x0[:, 0], 'x2_0': x0[:, 1],
+        'final_norm': np.linalg.norm(y[:, :2, -1], axis=1),
+        'control_effort': metrics.control_effort(y[:, 2], t),
+        **metrics.iet_statistics(inter_event_times),
+    }]
+
+  return {column: np.concatenate([row[column] for row in rows]) for column in rows[0]}
+
+
+def main(args):
+  import pandas as pd
+
+  x0 = X0[None]
+  if args.count:
+    factors = ensemble.sample_initial_factors(
+        args.count, (1 - args.spread, 1 + args.spread), (1 - args.spread, 1 + args.spread),
+        seed=args.seed)
+    x0 = np.concatenate((x0, X0 * factors))
+  os.makedirs(args.output, exist_ok=True)
+
+  for etm_type in args.etm.split(','):
+    instrument.log.info(
+        f'[van_der_pol]\t{etm_type.capitalize()} ETM sweep of {len(x0)} initial states started')
+    start = time.perf_counter()
+    table = pd.DataFrame(sweep(etm_type, x0, parse_values(args.theta), parse_values(args.lam),
+                               args.end_time, args.step, args.r0))
+    table.to_csv(os.path.join(args.output, f'van_der_pol_{etm_type}_etm.csv'), index=False)
+    instrument.log.info(f'[van_der_pol]\t{etm_type.capitalize()} ETM sweep finalized in '
+                        f'{time.perf_counter() - start:.1f} s')
+    print(table.to_string(index=False))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description='Simulate the Van der Pol oscillator under the fuzzy ETMs.')
+  parser.add_argument('--etm', type=str, default='static,dynamic',
+                      help='Comma-separated ETM types')
+  parser.add_argument('--theta', type=str, default='1',
+                      help='Comma-separated threshold parameters of the dynamic ETM')
+  parser.add_argument('--lam', type=str, default='0.1',
+                      help='Comma-separated decay rates of the dynamic ETM')
+  parser.add_argument('--end-time', type=float, default=30.,
+                      help='End time of the simulations (s)')
+  parser.add_argument('--step', type=float, default=1e-4,
+                      help='Time step of the simulations (s)')
+  parser.add_argument('--r0', type=float, default=R0,
+                      help='Bound on x1 of the fuzzy model')
+  parser.add_argument('--count', type=int, default=0,
+                      help='Number of random initial states added to the one of the notebooks')
+  parser.add_argument('--spread', type=float, default=0.15,
+                      help='Relative spread of the random initial states around the one of the '
+                      'notebooks, which must keep |x1| within r0')
+  parser.add_argument('--seed', type=int, default=None,
+                      help='Seed of the random initial states')
+  parser.add_argument('--output', type=str, default='./van_der_pol/results',
+                      help='Directory of the CSV files')
+  args = parser.parse_args()
+  instrument.configure_logging()
+  main(args)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import oscillator
+
+
+def test_sweep_covers_every_pair_and_initial_state():
+  x0 = np.array([oscillator.X0, 0.9 * oscillator.X0])
+  table = oscillator.sweep('dynamic', x0, (0.5, 1.), (0.1, 1.), end_time=2., step=1e-3)
+
+  assert np.array_equal(table['θ'], [0.5, 0.5, 0.5, 0.5, 1., 1., 1., 1.])
+  assert np.array_equal(table['λ'], [0.1, 0.1, 1., 1., 0.1, 0.1, 1., 1.])
+  assert np.array_equal(table['x1_0'], np.tile(x0[:, 0], 4))
+  assert np.all(table['iet_count'] > 0)
+  assert np.all(table['final_norm'] < np.linalg.norm(oscillator.X0))
+
+
+def test_dynamic_etm_transmits_less_than_the_static_etm():
+  static = oscillator.sweep('static', oscillator.X0, end_time=2., step=1e-3)
+  dynamic = oscillator.sweep('dynamic', oscillator.X0, end_time=2., step=1e-3)
+
+  assert np.isnan(static['θ']).all()
+  assert dynamic['iet_count'][0] < static['iet_count'][0]
+
+
+def test_lanes_are_simulated_independently():
+  x0 = np.array([oscillator.X0, 0.9 * oscillator.X0])
+  table = oscillator.sweep('dynamic', x0, end_time=2., step=1e-3)
+  single = oscillator.sweep('dynamic', x0[1], end_time=2., step=1e-3)
+
+  for column in ('final_norm', 'control_effort', 'iet_count', 'iet_mean'):
+    assert table[column][1] == pytest.approx(single[column][0], rel=1e-9), column